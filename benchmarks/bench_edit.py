@@ -0,0 +1,167 @@
+# Benchmarks of proof edits on long proofs.
+#
+# Same conventions as bench_traversal.py:
+#   python -m benchmarks.bench_edit
+
+import io
+
+from modules.search_prop import *
+from benchmarks.bench_traversal import long_proof, deep_proof, run
+
+N_LINES = 10000
+
+class LineCounts:
+  """ splice(), lines_changed() and locate() against a full 
+      build_index(). """
+  params = ['long', 'deep']
+  param_names = ['shape']
+
+  def setup(self, shape):
+    if shape == 'long':
+      self.proof = long_proof(N_LINES)
+      self.parent_idx = [0]
+    else:
+      self.proof = deep_proof(N_LINES // 10)
+      self.parent_idx = self.proof.index_dict[f"{N_LINES // 20 * 2}"][:-1]
+    self.parent = self.proof.get_p_node(self.parent_idx)
+    self.last = str(self.proof.n_lines)
+
+  def time_insert_lines_changed(self, shape):
+    blank = ProofNode(NodeLabel(LabelType.BLANK_CONC))
+    self.parent.children.insert(1, blank)
+    self.proof.lines_changed(self.parent_idx)
+    self.proof.locate(self.last)
+    del self.parent.children[1]
+    self.proof.lines_changed(self.parent_idx)
+
+  def time_insert_splice(self, shape):
+    blank = ProofNode(NodeLabel(LabelType.BLANK_CONC))
+    self.proof.splice(self.parent, 1, 0, [blank])
+    self.proof.locate(self.last)
+    self.proof.splice(self.parent, 1, 1, [])
+
+  def time_insert_build_index(self, shape):
+    blank = ProofNode(NodeLabel(LabelType.BLANK_CONC))
+    self.parent.children.insert(1, blank)
+    self.proof.build_index()
+    self.proof.index_dict = self.proof.build_index_dict()
+    del self.parent.children[1]
+    self.proof.build_index()
+    self.proof.index_dict = self.proof.build_index_dict()
+
+class EditLongProof:
+  """ Whole edit methods of ProofNodeS, including revalidation, on flat
+      proofs of growing length. Only the edited lines and the lines 
+      citing them are revalidated, and the line counts are updated in 
+      O(log(n_lines)) time, so the times hardly grow with n_lines. """
+  params = [1000, 10000, 100000]
+  param_names = ['n_lines']
+
+  def setup(self, n_lines):
+    self.proof = ProofNodeS(long_proof(n_lines))
+    self.proof.insert_node(2) # builds the LineTree of the root
+    self.proof.undo()
+    self.fmla = Formula(parse_ast('B imp A'))
+
+  def time_insert_delete(self, n_lines):
+    self.proof.insert_node(2)
+    self.proof.delete_node(2)
+
+  def time_edits_sequential(self, n_lines):
+    for _ in range(10):
+      self.proof.insert_node(2)
+    for _ in range(10):
+      self.proof.delete_node(2)
+
+  def time_edits_transaction(self, n_lines):
+    with self.proof.transaction():
+      for _ in range(10):
+        self.proof.insert_node(2)
+      for _ in range(10):
+        self.proof.delete_node(2)
+
+  def time_edits_far_apart(self, n_lines):
+    for l_num in range(2, n_lines, n_lines // 10):
+      self.proof.insert_node(l_num)
+      self.proof.delete_node(l_num)
+
+  def time_update_formula(self, n_lines):
+    self.proof.update_formula(n_lines // 2, self.fmla)
+
+  def time_undo_redo(self, n_lines):
+    self.proof.insert_node(2)
+    self.proof.undo()
+    self.proof.redo()
+    self.proof.undo()
+
+class RenderAfterEdit:
+  """ Fitch text and LaTeX of a long proof, rendered again after an edit
+      of one line, which reuses the cached formula strings of the others. """
+  def setup(self):
+    self.proof = ProofNodeS(long_proof(N_LINES))
+    self.proof.build_fitch_text()
+    self.proof.build_fitch_latex()
+    self.fmla = Formula(parse_ast('B imp A'))
+
+  def time_fitch_text(self):
+    self.proof.update_formula(2, self.fmla)
+    self.proof.write_fitch_text(io.StringIO())
+
+  def time_fitch_latex(self):
+    self.proof.update_formula(2, self.fmla)
+    self.proof.write_fitch_latex(io.StringIO())
+
+class EditSession:
+  """ An edit and the rows sent back by proof_server /edit, see 
+      ProofNodeS.render_delta(). Only the edited lines and the lines below
+      the first line moved are rendered again, so the times hardly grow 
+      with n_lines when the edits are near the end. """
+  params = [1000, 10000, 100000]
+  param_names = ['n_lines']
+
+  def setup(self, n_lines):
+    self.proof = ProofNodeS(long_proof(n_lines))
+    self.proof.insert_node(2) # builds the LineTree of the root
+    self.proof.undo()
+    self.proof.render_delta()
+    self.fmla = Formula(parse_ast('B imp A'))
+
+  def time_update_formula(self, n_lines):
+    self.proof.update_formula(n_lines // 2, self.fmla)
+    self.proof.render_delta()
+
+  def time_insert_delete_near_end(self, n_lines):
+    self.proof.insert_node(n_lines - 2)
+    self.proof.render_delta()
+    self.proof.delete_node(n_lines - 2)
+    self.proof.render_delta()
+
+class Snapshot:
+  """ ProofNodeS.snapshot() and the edits which follow it, on flat proofs
+      of growing length. The snapshot copies nothing, and the edits keep 
+      only the old states of what they change, so these times hardly 
+      grow with n_lines. The reader pays O(n_lines) for the copy in 
+      time_read_copy. """
+  params = [1000, 10000, 100000]
+  param_names = ['n_lines']
+
+  def setup(self, n_lines):
+    self.proof = ProofNodeS(long_proof(n_lines))
+    self.proof.insert_node(2) # builds the LineTree of the root
+    self.proof.undo()
+    self.view = self.proof.snapshot()
+
+  def time_snapshot(self, n_lines):
+    for _ in range(10):
+      self.proof.snapshot()
+
+  def time_snapshot_edit(self, n_lines):
+    self.proof.snapshot()
+    self.proof.insert_node(2)
+    self.proof.delete_node(2)
+
+  def time_read_copy(self, n_lines):
+    ProofSnapshot(self.proof).proof()
+
+if __name__ == '__main__':
+  run([LineCounts, EditLongProof, RenderAfterEdit, EditSession, Snapshot])
@@ -0,0 +1,57 @@
+# Cold import time of the modules, as paid by each new worker process.
+#
+# The classes follow the conventions of asv (airspeed velocity): the code
+# returned by a timeraw_* method is timed in a fresh interpreter, and a
+# track_* method returns a number to be recorded. They can also be run
+# without asv:
+#   python -m benchmarks.bench_import
+#
+# track_heavy_imports counts the optional libraries which are loaded by
+# the import itself. It should stay 0: they are imported only by the
+# functions that need them, and no module installs or downloads anything
+# when it is imported.
+
+import subprocess, sys
+
+MODULES = ['modules.first_order_logic_parse', 'modules.truth_table',
+           'modules.validate_prop', 'modules.search_prop',
+           'modules.proof_server']
+HEAVY = ['IPython', 'matplotlib', 'graphviz', 'numpy', 'colorama',
+         'httpimport']
+
+class ImportTime:
+  params = MODULES
+  param_names = ['module']
+
+  def timeraw_import(self, module):
+    return f"import {module}"
+
+  def track_heavy_imports(self, module):
+    code = (f"import sys, {module}\n"
+            f"print(sum(name in sys.modules for name in {HEAVY!r}))")
+    return int(subprocess.check_output([sys.executable, '-c', code]))
+
+def run() -> None:
+  """ Minimal stand-in for asv: time each import in a fresh interpreter,
+      less the startup time of the interpreter itself. """
+  import time
+
+  def time_code(code: str) -> float:
+    best = float('inf')
+    for _ in range(5):
+      t0 = time.perf_counter()
+      subprocess.check_call([sys.executable, '-c', code])
+      best = min(best, time.perf_counter() - t0)
+    return best
+
+  t_start = time_code('pass')
+  print(f"interpreter startup: {t_start * 1000:.1f} ms")
+  bench = ImportTime()
+  for module in ImportTime.params:
+    t = time_code(bench.timeraw_import(module)) - t_start
+    n_heavy = bench.track_heavy_imports(module)
+    print(f"ImportTime.timeraw_import({module}): {t * 1000:.1f} ms, "
+          f"heavy imports: {n_heavy}")
+
+if __name__ == '__main__':
+  run()
@@ -0,0 +1,92 @@
+# Benchmarks of the parsers, the renderer, the validator and the proof
+# search on random corpora of several sizes from modules/corpus.py.
+#
+# Same conventions as bench_traversal.py:
+#   python -m benchmarks.bench_parse
+#
+# The corpora are seeded, so every run times the same inputs. Formulas
+# are kept at depth <= 30 because the parsers are recursive descent.
+
+from modules.corpus import *
+from benchmarks.bench_traversal import run as run_classes
+
+SEED = 2024
+N_FORMULAS = 50
+N_PROOFS = 5
+
+class FormulaParse:
+  """ tokenizer(), parse_ast() and build_infix() on formulas with size
+      connectives and quantifiers. """
+  params = [[10, 100, 1000], ['first_order', 'prop']]
+  param_names = ['size', 'logic']
+
+  def setup(self, size, logic):
+    gen = FormulaGenerator(SEED, first_order=logic == 'first_order',
+                           max_depth=30)
+    self.texts = gen.formulas(N_FORMULAS, size)
+    self.asts = [parse_ast(text) for text in self.texts]
+
+  def time_tokenizer(self, size, logic):
+    for text in self.texts:
+      tokenizer(text)
+
+  def time_parse_ast(self, size, logic):
+    for text in self.texts:
+      parse_ast(text)
+
+  def time_infix_text(self, size, logic):
+    for ast in self.asts:
+      ast.build_infix('text')
+
+  def time_infix_latex(self, size, logic):
+    for ast in self.asts:
+      ast.build_infix('latex')
+
+class ProofValidate:
+  """ parse_fitch() and validate_all() on valid proofs and on proofs with
+      a wrong line. """
+  params = [[10, 100, 1000], ['valid', 'invalid']]
+  param_names = ['n_lines', 'kind']
+
+  def setup(self, n_lines, kind):
+    gen = ProofGenerator(SEED)
+    self.texts = gen.proofs(N_PROOFS, n_lines, kind)
+    self.proofs = [parse_fitch(text, validate=False) for text in self.texts]
+
+  def time_parse_fitch(self, n_lines, kind):
+    for text in self.texts:
+      parse_fitch(text, validate=False)
+
+  def time_validate_all(self, n_lines, kind):
+    # cold: the rule checks are not looked up in verify_cache
+    verify_cache.clear()
+    for proof in self.proofs:
+      proof.validate_all()
+
+  def time_validate_all_warm(self, n_lines, kind):
+    for proof in self.proofs:
+      proof.validate_all()
+
+class ProofSearch:
+  """ search_proof() on valid proofs whose annotations are left out. The
+      search fills them in, so each run needs new proofs. """
+  params = [10, 50, 200]
+  param_names = ['n_lines']
+  number = 1 # setup() before each run
+  warmup_time = 0
+
+  def setup(self, n_lines):
+    verify_cache.clear()
+    gen = ProofGenerator(SEED)
+    self.proofs = [ProofNodeS(parse_fitch(text)) for text in
+                   gen.proofs(N_PROOFS, n_lines, 'search')]
+
+  def time_search_proof(self, n_lines):
+    for proof in self.proofs:
+      proof.run_search()
+
+def run() -> None:
+  run_classes([FormulaParse, ProofValidate, ProofSearch])
+
+if __name__ == '__main__':
+  run()
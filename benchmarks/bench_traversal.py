@@ -0,0 +1,176 @@
+# Stress benchmarks of the tree walkers on deeply nested input.
+#
+# The classes follow the conventions of asv (airspeed velocity):
+# setup() builds the input, and each time_* method is timed.
+# They can also be run without asv:
+#   python -m benchmarks.bench_traversal
+#
+# Formulas nested 10,000 deep cannot be parsed from text because the
+# parser is recursive descent, so the trees are built directly.
+
+from modules.validate_prop import *
+from modules.draw_tree import build_ast_svg
+
+DEPTH = 10000
+
+def deep_negation(depth: int) -> Node:
+  """ not not ... not A """
+  node = Node(Token('A'))
+  for _ in range(depth):
+    node = Node(Token('not'), [node])
+  return node
+
+def deep_implication(depth: int) -> Node:
+  """ A1 imp (A2 imp (... imp A0)), nested to the right """
+  node = Node(Token('A0'))
+  for i in range(depth):
+    node = Node(Token('imp'), [Node(Token(f"A_{i % 7}")), node])
+  return node
+
+def deep_conjunction(depth: int) -> Node:
+  """ ((A and B) and B) and .., nested to the left """
+  node = Node(Token('A'))
+  for _ in range(depth):
+    node = Node(Token('and'), [node, Node(Token('B'))])
+  return node
+
+def deep_term(depth: int) -> Node:
+  """ x = f(f(...f(y)...)) + 1 """
+  term = Node(Token('y'))
+  for _ in range(depth):
+    term = Node(Token('f1'), [term])
+  term = Node(Token('+'), [term, Node(Token('1'))])
+  return Node(Token('='), [Node(Token('x')), term])
+
+def long_proof(n_lines: int) -> ProofNode:
+  """ A flat proof with n_lines lines: A .hyp, then repeats of line 1 """
+  lines = ['A .hyp', 'proves'] + ['A .repeat 1'] * (n_lines - 1)
+  return parse_fitch('\n'.join(lines), validate=False)
+
+def deep_proof(depth: int) -> ProofNode:
+  """ Subproofs nested depth deep, each with a hypothesis and a line. """
+  def leaf(line: str) -> ProofNode:
+    label_type = LabelType.FORMULA
+    return ProofNode(NodeLabel(label_type, line))
+  node = ProofNode(NodeLabel(), [leaf('A .hyp'), leaf('A .repeat 1')])
+  for _ in range(depth - 1):
+    node = ProofNode(NodeLabel(), [leaf('A .hyp'), node])
+  node.build_index()
+  node.index_dict = node.build_index_dict()
+  return node
+
+class DeepFormula:
+  params = ['negation', 'implication', 'conjunction', 'term']
+  param_names = ['shape']
+
+  def setup(self, shape):
+    self.node = {'negation': deep_negation,
+                 'implication': deep_implication,
+                 'conjunction': deep_conjunction,
+                 'term': deep_term}[shape](DEPTH)
+
+  def time_infix_text(self, shape):
+    self.node.build_infix('text')
+
+  def time_infix_latex(self, shape):
+    self.node.build_infix('latex')
+
+  def time_polish(self, shape):
+    self.node.build_polish_notation()
+
+  def time_RPN(self, shape):
+    self.node.build_RPN()
+
+  def time_bussproof(self, shape):
+    self.node.build_bussproof()
+
+  def time_svg_tree(self, shape):
+    build_ast_svg(self.node)
+
+  def time_substitute(self, shape):
+    self.node.substitute('A', Node(Token('B')), 'dupl')
+
+  def time_subst_free(self, shape):
+    self.node.subst_free({'x': Node(Token('z'))})
+
+  def time_replace_node_at(self, shape):
+    self.node.replace_node_at([0], Node(Token('B')), 'dupl')
+
+  def time_symbol_sets(self, shape):
+    # cold on the first call only, the sets are cached on the nodes
+    self.node.symbol_sets()
+
+  def time_clone(self, shape):
+    self.node.clone()
+
+class DeepBValues:
+  def setup(self):
+    self.fmla = Formula(deep_implication(DEPTH))
+
+  def time_get_bValues(self):
+    self.fmla.get_bValues()
+
+  def time_label_prime_subs(self):
+    t_table = TruthTable([self.fmla])
+    t_table.label_prime_subs(t_table.get_prime_atoms())
+
+class LongProof:
+  params = [1000, DEPTH]
+  param_names = ['n_lines']
+
+  def setup(self, n_lines):
+    self.proof = long_proof(n_lines)
+
+  def time_build_index(self, n_lines):
+    self.proof.build_index()
+    self.proof.index_dict = self.proof.build_index_dict()
+
+  def time_fitch_text(self, n_lines):
+    self.proof.build_fitch_text()
+
+  def time_fitch_html(self, n_lines):
+    self.proof.build_fitch_html()
+
+class DeepProof:
+  def setup(self):
+    self.proof = deep_proof(DEPTH // 10)
+
+  def time_build_index(self):
+    self.proof.build_index()
+    self.proof.index_dict = self.proof.build_index_dict()
+
+  def time_fitch_text(self):
+    self.proof.build_fitch_text()
+
+  def time_fitch_latex(self):
+    self.proof.build_fitch_latex()
+
+  def time_fitch_html(self):
+    self.proof.build_fitch_html()
+
+def run(classes=None) -> None:
+  """ Minimal stand-in for asv: time every time_* method once. """
+  import time, itertools
+
+  for cls in classes or [DeepFormula, DeepBValues, LongProof, DeepProof]:
+    params = getattr(cls, 'params', None)
+    if params is None:
+      param_li = [()]
+    elif isinstance(params[0], list): # several parameters
+      param_li = list(itertools.product(*params))
+    else:
+      param_li = [(p,) for p in params]
+    for args in param_li:
+      bench = cls()
+      bench.setup(*args)
+      for name in sorted(dir(cls)):
+        if not name.startswith('time_'):
+          continue
+        t0 = time.perf_counter()
+        getattr(bench, name)(*args)
+        t = time.perf_counter() - t0
+        arg_str = f"({', '.join(map(str, args))})" if args else ''
+        print(f"{cls.__name__}.{name}{arg_str}: {t * 1000:.1f} ms")
+
+if __name__ == '__main__':
+  run()
@@ -0,0 +1,6 @@
+# The Proofmood logic modules. Import the submodules directly, e.g.
+#   from modules.validate_prop import *
+# Nothing is imported here, so that importing one submodule stays cheap.
+# Notebook display (IPython), drawing (matplotlib), game trees (graphviz)
+# and finite models (numpy) import their libraries only when used; see
+# the optional dependencies in pyproject.toml.
@@ -1,5 +1,5 @@
 from typing import List, Tuple
-import math, random, copy, graphviz 
+import math, random, copy
 from pprint import pprint
 
 class Node:
@@ -64,6 +64,7 @@ class Node:
     #   is labeled with Max/Min anyway.
 
     from IPython.display import display
+    import graphviz
 
     prefix = "graph {\n"
     suffix = "}"
@@ -0,0 +1,139 @@
+# Parallel batch rendering of formulas and proofs.
+#
+# Usage:
+#   for result in render_batch(formula_strs, 'bussproof'):
+#     print(result['index'], result['output'])
+#   results = render_all(proof_strs, 'html', kind='proof')
+# or from the shell, one formula per line (or one proof per file with
+# --kind proof), writing one JSON object per result:
+#   python -m modules.batch_render --format svg formulas.txt
+#
+# Formats:
+#   kind 'formula'  'text' | 'latex' | 'polish' | 'bussproof' | 'svg'
+#   kind 'proof'    'text' | 'latex' | 'html'
+# The sources are split into chunks, and the chunks are rendered by a
+# pool of worker processes. render_batch() yields the results of each
+# chunk as soon as it is done, so they come in completion order. Each
+# result is a dict which carries the index of its source and either
+# 'output' or 'error'. A source which fails to parse does not stop the
+# others. render_all() collects the results in the order of the sources.
+
+import os, math, multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Dict, Iterable, Iterator, List
+
+from modules.validate_prop import *
+from modules.draw_tree import build_ast_svg
+
+FORMATS = {'formula': ('text', 'latex', 'polish', 'bussproof', 'svg'),
+           'proof': ('text', 'latex', 'html')}
+# errors of a bad source, as in proof_server.py
+SOURCE_ERRORS = (ValueError, SyntaxError, AssertionError, IndexError,
+                 KeyError, TypeError, RecursionError)
+
+def render_source(source: str, kind: str, fmt: str, tabsize: int = 2) -> str:
+  """ Render a single formula or proof source. """
+  if kind == 'formula':
+    ast = parse_ast(source)
+    if fmt in ('text', 'latex'):
+      return ast.build_infix(fmt)
+    elif fmt == 'polish':
+      return ast.build_polish_notation()
+    elif fmt == 'bussproof':
+      return ast.build_bussproof()
+    elif fmt == 'svg':
+      return build_ast_svg(ast)
+  elif kind == 'proof':
+    proof = parse_fitch(source, tabsize=tabsize)
+    if fmt == 'text':
+      return proof.build_fitch_text()
+    elif fmt == 'latex':
+      return proof.build_fitch_latex()
+    elif fmt == 'html':
+      return proof.build_fitch_html()
+  raise ValueError(f"Unknown format '{fmt}' for kind '{kind}'.")
+
+def render_chunk(start: int, sources: List[str], kind: str, fmt: str,
+                 tabsize: int = 2) -> List[Dict]:
+  """ Render sources, whose indices begin with start. Runs in a worker. """
+  results = []
+  for i, source in enumerate(sources, start):
+    try:
+      results.append({'index': i, 'output':
+                      render_source(source, kind, fmt, tabsize)})
+    except SOURCE_ERRORS as e:
+      results.append({'index': i, 'error': f"{type(e).__name__}: {e}"})
+  return results
+
+def render_batch(sources: Iterable[str], fmt: str, kind: str = 'formula',
+                 workers: int | None = None, chunk_size: int | None = None,
+                 tabsize: int = 2) -> Iterator[Dict]:
+  """ Render sources in worker processes and yield the results as they
+      are ready. workers=1 renders in this process. By default, there are
+      about four chunks per worker, of at most 64 sources each. """
+  if kind not in FORMATS or fmt not in FORMATS[kind]:
+    raise ValueError(f"Unknown format '{fmt}' for kind '{kind}'.")
+  sources = list(sources)
+  workers = workers or os.cpu_count() or 1
+  if chunk_size is None:
+    chunk_size = max(1, min(64, math.ceil(len(sources) / (4 * workers))))
+  starts = range(0, len(sources), chunk_size)
+  if workers == 1 or len(starts) <= 1:
+    for start in starts:
+      yield from render_chunk(start, sources[start:start + chunk_size],
+                              kind, fmt, tabsize)
+    return
+
+  methods = multiprocessing.get_all_start_methods()
+  ctx = multiprocessing.get_context('fork' if 'fork' in methods else None)
+  pool = ProcessPoolExecutor(min(workers, len(starts)), mp_context=ctx)
+  try:
+    futures = [pool.submit(render_chunk, start,
+                           sources[start:start + chunk_size], kind, fmt,
+                           tabsize) for start in starts]
+    for future in as_completed(futures):
+      yield from future.result()
+  finally:
+    # also when the caller stops iterating early
+    pool.shutdown(wait=True, cancel_futures=True)
+
+def render_all(sources: Iterable[str], fmt: str, kind: str = 'formula',
+               **kwargs) -> List[Dict]:
+  """ The results of render_batch() in the order of sources. """
+  results = list(render_batch(sources, fmt, kind, **kwargs))
+  results.sort(key=lambda result: result['index'])
+  return results
+
+def main(argv=None) -> None:
+  import argparse, json, sys
+
+  arg_parser = argparse.ArgumentParser(description="Render formulas or "
+                                       "proofs in parallel")
+  arg_parser.add_argument('files', nargs='*',
+                          help="formulas one per line, or one proof per "
+                          "file with --kind proof (default: stdin)")
+  arg_parser.add_argument('--kind', choices=list(FORMATS),
+                          default='formula')
+  arg_parser.add_argument('--format', default=None)
+  arg_parser.add_argument('--workers', type=int, default=None)
+  arg_parser.add_argument('--tabsize', type=int, default=2)
+  args = arg_parser.parse_args(argv)
+  fmt = args.format or ('bussproof' if args.kind == 'formula' else 'html')
+  texts = []
+  for file_name in args.files or ['-']:
+    if file_name == '-':
+      texts.append(sys.stdin.read())
+    else:
+      with open(file_name, encoding='utf-8') as f:
+        texts.append(f.read())
+  if args.kind == 'formula':
+    sources = [line.strip() for text in texts for line in text.splitlines()
+               if line.strip()]
+  else:
+    sources = texts
+  for result in render_batch(sources, fmt, args.kind, args.workers,
+                             tabsize=args.tabsize):
+    print(json.dumps(result, ensure_ascii=False), flush=True)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,424 @@
+# Compact binary encoding of formula ASTs and proof trees.
+#
+# Layout of an encoded object:
+#   magic b'PMF' | version: u8 | kind: u8 | string table | symbol table | body
+# All integers are unsigned LEB128 varints.
+#   string table: n, then n times (byte length, utf-8 bytes)
+#   symbol table: n, then n times
+#     (value: str id, token_type: str id, arity+1, precedence+1, nkids)
+#     where 0 stands for None in arity+1 and precedence+1.
+#   formula: number of nodes, then the symbol ids in postfix order.
+#     Since a symbol carries the number of children of its node, the
+#     postfix stream alone determines the tree.
+#   proof: root index and first line number, then the structure table,
+#     one record per ProofNode in preorder:
+#     (nkids, validated, label type: str id, line: str id, is_hyp,
+#      formula, annotation)
+# Only the syntactic content is stored. The truth table scratch fields of
+# Node (index, bValue, level, alt_str) are not, and ProofNode.index,
+# line_num and index_dict are rebuilt by the decoder in the same pass.
+# Premises are stored as line numbers and bound to their nodes again.
+#
+# Decoding reads directly from bytes, bytearray, memoryview or mmap
+# without copying the buffer. pack() concatenates many encoded objects
+# with an offset table, so that a file of proofs can be memory-mapped and
+# any single proof decoded by unpack_at() on demand.
+#
+# Usage:
+#   data = dumps(proof)  # ProofNode, Formula or Node
+#   proof = loads(data)
+
+import mmap
+from typing import List, Dict, Tuple
+
+from modules.validate_prop import *
+
+MAGIC = b'PMF'
+VERSION = 1
+KIND_NODE, KIND_FORMULA, KIND_PROOF = 1, 2, 3
+PACK_MAGIC = b'PMP'
+
+# tri-state values (None, False, True) <-> 0, 1, 2
+TRI = {None: 0, False: 1, True: 2}
+TRI_INV = (None, False, True)
+RULES = list(RuleInfer)
+
+class CodecError(ValueError):
+  """ Error for malformed or unsupported encoded data. """
+  pass
+
+#region encoder
+
+def write_uint(out: bytearray, n: int) -> None:
+  while n >= 0x80:
+    out.append((n & 0x7f) | 0x80)
+    n >>= 7
+  out.append(n)
+
+def opt_uint(n: int | None) -> int:
+  return 0 if n is None else n + 1
+
+class Encoder:
+  """ Collects the string table and the symbol table while the body is
+      written. A single Encoder may encode several formulas, so that all
+      the lines of a proof share their tables. """
+  def __init__(self):
+    self.strings = {} # type: Dict[str, int]
+    self.symbols = {} # type: Dict[tuple, int]
+    self.body = bytearray()
+
+  def str_id(self, s: str) -> int:
+    id = self.strings.get(s)
+    if id is None:
+      id = self.strings[s] = len(self.strings)
+    return id
+
+  def sym_id(self, node: Node) -> int:
+    token = node.token
+    key = (token.value, token.token_type, token.arity, token.precedence,
+           len(node.children))
+    id = self.symbols.get(key)
+    if id is None:
+      id = self.symbols[key] = len(self.symbols)
+      self.str_id(token.value)
+      self.str_id(token.token_type)
+    return id
+
+  def write_node(self, root: Node) -> None:
+    """ Write the AST in postfix order (without recursion). """
+    postfix = []
+    stack = [(root, False)]
+    while stack:
+      node, visited = stack.pop()
+      if visited:
+        postfix.append(self.sym_id(node))
+      else:
+        stack.append((node, True))
+        for kid in reversed(node.children):
+          stack.append((kid, False))
+    body = self.body
+    write_uint(body, len(postfix))
+    for id in postfix:
+      write_uint(body, id)
+
+  def write_label(self, label: NodeLabel) -> None:
+    body = self.body
+    write_uint(body, self.str_id(label.type.value))
+    write_uint(body, self.str_id(label.line))
+    body.append(TRI[label.is_hyp])
+    formula = label.formula
+    if formula is None:
+      body.append(0)
+    else:
+      body.append(1)
+      self.write_node(formula.ast)
+    ann = label.ann
+    if ann is None:
+      body.append(0)
+    elif isinstance(ann, str): # invalid annotation kept as a string
+      body.append(1)
+      write_uint(body, self.str_id(ann))
+    else:
+      body.append(2)
+      write_uint(body, self.str_id(ann.input_str))
+      write_uint(body, 0 if ann.rule is None else RULES.index(ann.rule) + 1)
+      if ann.premise is None:
+        write_uint(body, 0)
+      else:
+        write_uint(body, len(ann.premise) + 1)
+        for s in ann.premise:
+          write_uint(body, self.str_id(s))
+
+  def write_proof(self, root: ProofNode) -> None:
+    if root.stale:
+      root.refresh_index()
+    body = self.body
+    index = root.index or [0]
+    write_uint(body, len(index))
+    for i in index:
+      write_uint(body, i)
+    l_num = int(root.line_num.split('-')[0]) if root.line_num else 1
+    write_uint(body, l_num)
+    body.append((1 if root.index is not None else 0) |
+                (2 if root.index_dict is not None else 0))
+    stack = [root]
+    while stack:
+      p_node = stack.pop()
+      write_uint(body, len(p_node.children))
+      body.append(TRI[p_node.validated])
+      self.write_label(p_node.label)
+      stack.extend(reversed(p_node.children))
+
+  def getvalue(self, kind: int) -> bytes:
+    out = bytearray(MAGIC)
+    out.append(VERSION)
+    out.append(kind)
+    write_uint(out, len(self.strings))
+    for s in self.strings: # dicts keep the insertion order = id order
+      b = s.encode('utf-8')
+      write_uint(out, len(b))
+      out += b
+    write_uint(out, len(self.symbols))
+    for (value, token_type, arity, precedence, n_kids) in self.symbols:
+      write_uint(out, self.str_id(value))
+      write_uint(out, self.str_id(token_type))
+      write_uint(out, opt_uint(arity))
+      write_uint(out, opt_uint(precedence))
+      write_uint(out, n_kids)
+    # str_id() above only looks up, since sym_id() interned the strings.
+    out += self.body
+    return bytes(out)
+
+def encode_node(node: Node) -> bytes:
+  enc = Encoder()
+  enc.write_node(node)
+  return enc.getvalue(KIND_NODE)
+
+def encode_formula(formula: Formula) -> bytes:
+  enc = Encoder()
+  enc.write_node(formula.ast)
+  return enc.getvalue(KIND_FORMULA)
+
+def encode_proof(proof: ProofNode) -> bytes:
+  enc = Encoder()
+  enc.write_proof(proof)
+  return enc.getvalue(KIND_PROOF)
+
+def dumps(obj: Node | Formula | ProofNode) -> bytes:
+  if isinstance(obj, ProofNode):
+    return encode_proof(obj)
+  elif isinstance(obj, Formula):
+    return encode_formula(obj)
+  elif isinstance(obj, Node):
+    return encode_node(obj)
+  else:
+    raise TypeError(f"dumps(): cannot encode {type(obj).__name__}")
+
+#endregion encoder
+
+#region decoder
+
+class Decoder:
+  """ Reads an encoded object from a buffer, starting at offset pos. """
+  def __init__(self, buf, pos: int=0):
+    self.buf = buf if isinstance(buf, memoryview) else memoryview(buf)
+    self.pos = pos
+    if bytes(self.buf[pos:pos + 3]) != MAGIC:
+      raise CodecError("Decoder(): bad magic number")
+    version = self.buf[pos + 3]
+    if version != VERSION:
+      raise CodecError(f"Decoder(): unsupported version {version}")
+    self.kind = self.buf[pos + 4]
+    self.pos = pos + 5
+    buf = self.buf
+    self.strings = [] # type: List[str]
+    for _ in range(self.read_uint()):
+      n = self.read_uint()
+      self.strings.append(str(buf[self.pos:self.pos + n], 'utf-8'))
+      self.pos += n
+    strings = self.strings
+    # Token prototypes. Each node gets a Token of its own because the
+    # parser (and its users) may mutate tokens in place.
+    self.symbols = [] # type: List[Tuple[dict, int]]
+    for _ in range(self.read_uint()):
+      value = strings[self.read_uint()]
+      token_type = strings[self.read_uint()]
+      arity = self.read_uint() - 1
+      precedence = self.read_uint() - 1
+      proto = {'value': value, 'token_type': token_type,
+               'arity': None if arity < 0 else arity,
+               'precedence': None if precedence < 0 else precedence}
+      self.symbols.append((proto, self.read_uint()))
+
+  def read_uint(self) -> int:
+    buf = self.buf
+    pos = self.pos
+    b = buf[pos]
+    if b < 0x80: # the common case of a single byte
+      self.pos = pos + 1
+      return b
+    n = b & 0x7f
+    shift = 7
+    while b & 0x80:
+      pos += 1
+      b = buf[pos]
+      n |= (b & 0x7f) << shift
+      shift += 7
+    self.pos = pos + 1
+    return n
+
+  def read_node(self) -> Node:
+    """ Rebuild an AST from its postfix stream (without recursion). """
+    symbols = self.symbols
+    stack = []
+    read_uint = self.read_uint
+    new_token = Token.__new__
+    for _ in range(read_uint()):
+      proto, n_kids = symbols[read_uint()]
+      token = new_token(Token)
+      token.__dict__.update(proto)
+      if n_kids:
+        kids = stack[-n_kids:]
+        del stack[-n_kids:]
+      else:
+        kids = None
+      stack.append(Node(token, kids))
+    if len(stack) != 1:
+      raise CodecError("read_node(): malformed postfix stream")
+    return stack[0]
+
+  def read_label(self) -> NodeLabel:
+    strings = self.strings
+    label = NodeLabel.__new__(NodeLabel)
+    label.type = LabelType(strings[self.read_uint()])
+    label.line = strings[self.read_uint()]
+    label.is_hyp = TRI_INV[self.read_uint()]
+    label.formula = Formula(self.read_node()) if self.read_uint() else None
+    ann_kind = self.read_uint()
+    if ann_kind == 0:
+      label.ann = None
+    elif ann_kind == 1:
+      label.ann = strings[self.read_uint()]
+    else:
+      ann = Ann.__new__(Ann)
+      ann.input_str = strings[self.read_uint()]
+      rule = self.read_uint()
+      ann.rule = RULES[rule - 1] if rule else None
+      n_prem = self.read_uint()
+      ann.premise = ([strings[self.read_uint()] for _ in range(n_prem - 1)]
+                     if n_prem else None)
+      ann.removed_with = None
+      label.ann = ann
+    return label
+
+  def read_proof(self) -> ProofNode:
+    """ Rebuild the proof tree from the structure table in preorder.
+        index, line_num and n_lines are set on the way, as build_index()
+        would. """
+    root_index = [self.read_uint() for _ in range(self.read_uint())]
+    l_num = self.read_uint()
+    flags = self.read_uint()
+    indexed, with_dict = flags & 1, flags & 2
+    preorder = []
+    root = None
+    stack = [] # [(p_node, number of kids still to read, first line)]
+    while True:
+      n_kids = self.read_uint()
+      validated = TRI_INV[self.read_uint()]
+      p_node = ProofNode(self.read_label())
+      p_node.validated = validated
+      preorder.append(p_node)
+      if stack:
+        parent = stack[-1][0]
+        if indexed:
+          p_node.index = parent.index + [len(parent.children)]
+          p_node.proof_root = root
+        parent.children.append(p_node)
+        p_node.parent = parent
+        stack[-1][1] -= 1
+      else:
+        root = p_node
+        if indexed:
+          p_node.index = root_index
+          p_node.proof_root = root
+      stack.append([p_node, n_kids, l_num])
+      # close the completed nodes
+      while stack and stack[-1][1] == 0:
+        done, _, first = stack.pop()
+        if indexed:
+          if done.children:
+            done.line_num = f"{first}-{l_num - 1}"
+          else:
+            done.line_num = str(l_num)
+        if not done.children:
+          l_num += 1
+        done.n_lines = l_num - first
+      if not stack:
+        break
+    if indexed and with_dict:
+      root.index_dict = {p_node.line_num: p_node.index
+                         for p_node in preorder}
+      root.bind_premises()
+    return root
+
+def decode(buf, pos: int=0, kind: int | None=None):
+  dec = Decoder(buf, pos)
+  if kind is not None and dec.kind != kind:
+    raise CodecError(f"decode(): expected kind {kind}, found {dec.kind}")
+  if dec.kind == KIND_PROOF:
+    return dec.read_proof()
+  elif dec.kind == KIND_FORMULA:
+    return Formula(dec.read_node())
+  elif dec.kind == KIND_NODE:
+    return dec.read_node()
+  else:
+    raise CodecError(f"decode(): unknown kind {dec.kind}")
+
+def decode_node(buf) -> Node:
+  return decode(buf, kind=KIND_NODE)
+
+def decode_formula(buf) -> Formula:
+  return decode(buf, kind=KIND_FORMULA)
+
+def decode_proof(buf) -> ProofNode:
+  return decode(buf, kind=KIND_PROOF)
+
+def loads(buf):
+  """ Inverse of dumps(). buf may be bytes, bytearray, memoryview or
+      mmap. """
+  return decode(buf)
+
+#endregion decoder
+
+#region bulk pack
+
+# A pack is PACK_MAGIC | version: u8 | count: u32 | offsets: (count + 1) x u64
+# followed by the encoded objects. The fixed width offsets allow random
+# access in O(1) time.
+
+def pack(blobs: List[bytes]) -> bytes:
+  """ Concatenate encoded objects into one buffer with an offset table. """
+  head_size = 3 + 1 + 4 + 8 * (len(blobs) + 1)
+  offsets = [head_size]
+  for b in blobs:
+    offsets.append(offsets[-1] + len(b))
+  out = bytearray(PACK_MAGIC)
+  out.append(VERSION)
+  out += len(blobs).to_bytes(4, 'little')
+  for off in offsets:
+    out += off.to_bytes(8, 'little')
+  for b in blobs:
+    out += b
+  return bytes(out)
+
+def pack_count(buf) -> int:
+  buf = memoryview(buf)
+  if bytes(buf[:3]) != PACK_MAGIC or buf[3] != VERSION:
+    raise CodecError("pack_count(): not a pack of this version")
+  return int.from_bytes(buf[4:8], 'little')
+
+def blob_at(buf, i: int) -> memoryview:
+  """ The i-th encoded object of a pack, as a view (no copy). """
+  buf = memoryview(buf)
+  n = pack_count(buf)
+  if not 0 <= i < n:
+    raise IndexError(f"blob_at(): {i} out of range({n})")
+  pos = 8 + 8 * i
+  start = int.from_bytes(buf[pos:pos + 8], 'little')
+  end = int.from_bytes(buf[pos + 8:pos + 16], 'little')
+  return buf[start:end]
+
+def unpack_at(buf, i: int):
+  """ Decode the i-th object of a pack. """
+  return decode(blob_at(buf, i))
+
+def iter_pack(buf):
+  for i in range(pack_count(buf)):
+    yield unpack_at(buf, i)
+
+def open_pack(path: str) -> mmap.mmap:
+  """ Memory-map a pack file read-only. Use it with unpack_at(). """
+  with open(path, 'rb') as f:
+    return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+#endregion bulk pack
@@ -0,0 +1,428 @@
+# Seeded random corpora of formulas and Fitch proofs, for benchmarks and
+# for stress testing the parser and the validator.
+#
+# Usage:
+#   gen = FormulaGenerator(seed=1, connectives={'and': 3, 'imp': 1})
+#   gen.formula(20)           # text of a formula with 20 connectives
+#   gen.formula_node(20)      # the same as a Node, without parsing
+#   pgen = ProofGenerator(seed=1)
+#   pgen.proof_str(100)             # a valid proof of about 100 lines
+#   pgen.proof_str(100, 'invalid')  # with one line negated
+#   pgen.proof_str(100, 'search')   # no annotations, for search_proof()
+#   pgen.proof(100)                 # a ProofNodeS
+# or from the shell, one formula per line or proofs separated by blank
+# lines:
+#   python -m modules.corpus --formulas 100 --size 30 --seed 7
+#   python -m modules.corpus --proofs 10 --lines 50 --kind invalid
+#
+# The same seed and arguments always give the same corpus. Formulas are
+# built as trees and then printed with build_infix('text'). The text
+# parses back into the same tree, except that A and (B and C) is printed
+# as A and B and C, and likewise for or, iff, xor, + and *. Proofs are
+# propositional. They are built forward, line by line, by applying the
+# rules of validate_prop.py to the lines in scope, and only formulas whose
+# text parses back into the same tree are used, so the proofs are valid
+# by construction.
+
+import random
+from typing import Dict, List
+
+from modules.search_prop import *
+
+# relative weights of the connectives and quantifiers
+CONNECTIVES = {'not': 2, 'and': 3, 'or': 3, 'imp': 3, 'iff': 1, 'xor': 0,
+               'forall': 1, 'exists': 1}
+PROP_CONNECTIVES = {'not': 2, 'and': 3, 'or': 3, 'imp': 3, 'iff': 1}
+QUANTIFIERS = ('forall', 'exists')
+# symbols of the atoms and the terms, with their arities
+PREDICATES = [('P1', 1), ('Q2', 2), ('R1', 1), ('S2', 2), ('T3', 3)]
+PRED_IN = ['<', 'in', 'subseteq']
+# '^' is left out because build_infix('text') writes x^{y}, which is not
+# parsed back.
+FUNCTIONS = [('f', 1), ('g2', 2), ('h3', 3), ('+', 2), ('*', 2)]
+VARIABLES = ['x', 'y', 'z', 'u', 'v', 'w']
+CONST_SYMBOLS = ['a', 'b', 'c', 'd', 'e']
+
+class FormulaGenerator:
+  """ Random well-formed formulas. size is the number of connectives and
+      quantifiers, and max_depth bounds their nesting, so that a formula
+      may be smaller than size. connectives gives the relative weights of
+      the connectives and quantifiers, and term_depth the nesting of
+      function symbols in terms. With first_order=False, the atoms are
+      prop letters only and there are no quantifiers. """
+  def __init__(self, seed: int = 0, connectives: Dict[str, float] | None
+               = None, first_order: bool = True, n_letters: int = 4,
+               n_preds: int = 3, n_vars: int = 3, n_consts: int = 2,
+               term_depth: int = 2, max_depth: int = 50):
+    self.rng = random.Random(seed)
+    weights = dict(CONNECTIVES if first_order else PROP_CONNECTIVES)
+    weights.update(connectives or {})
+    if not first_order:
+      weights = {conn: w for conn, w in weights.items()
+                 if conn not in QUANTIFIERS}
+    self.conns = [conn for conn, w in weights.items() if w > 0]
+    self.weights = [weights[conn] for conn in self.conns]
+    if not self.conns:
+      raise ValueError("FormulaGenerator: no connectives.")
+    self.first_order = first_order
+    self.letters = [chr(ord('A') + i) for i in range(n_letters)]
+    self.preds = PREDICATES[:n_preds]
+    self.vars = VARIABLES[:n_vars]
+    self.consts = CONST_SYMBOLS[:n_consts]
+    self.term_depth = term_depth
+    self.max_depth = max_depth
+
+  def formula(self, size: int, max_depth: int | None = None) -> str:
+    return self.formula_node(size, max_depth).build_infix('text')
+
+  def formulas(self, n: int, size: int) -> List[str]:
+    return [self.formula(size) for _ in range(n)]
+
+  def formula_node(self, size: int, max_depth: int | None = None) -> Node:
+    max_depth = self.max_depth if max_depth is None else max_depth
+    rng = self.rng
+    root = []
+    # (children list to fill, size, depth, bound variables)
+    stack = [(root, size, 0, ())]
+    while stack:
+      kids, n, depth, bound = stack.pop()
+      if n <= 0 or depth >= max_depth:
+        kids.append(self.atom(bound))
+        continue
+      conn = rng.choices(self.conns, self.weights)[0]
+      node = Node(Token(conn))
+      kids.append(node)
+      if conn == 'not':
+        stack.append((node.children, n - 1, depth + 1, bound))
+      elif conn in QUANTIFIERS:
+        var = rng.choice(self.vars)
+        node.children.append(self.var_determiner(var))
+        stack.append((node.children[0].children, n - 1, depth + 1,
+                      bound + (var,)))
+      else:
+        k = rng.randint(0, n - 1)
+        # the right child is pushed first, so that the left one comes first
+        stack.append((node.children, n - 1 - k, depth + 1, bound))
+        stack.append((node.children, k, depth + 1, bound))
+    return root[0]
+
+  @staticmethod
+  def var_determiner(var: str) -> Node:
+    # as made by Parser.comp_fmla2()
+    token = Token(var)
+    token.token_type = 'var_determiner'
+    token.arity = 1
+    return Node(token)
+
+  def atom(self, bound: tuple = ()) -> Node:
+    rng = self.rng
+    kind = rng.randrange(4) if self.first_order else 0
+    if kind == 0 or not self.preds and kind == 1:
+      return Node(Token(rng.choice(self.letters)))
+    elif kind == 1:
+      pred, arity = rng.choice(self.preds)
+      return Node(Token(pred), [self.term(bound) for _ in range(arity)])
+    symbol = '=' if kind == 2 else rng.choice(PRED_IN)
+    # The parser takes '(' at the start of an atom for the start of a
+    # formula, so the left term must not be printed with one.
+    left = self.term(bound)
+    while left.build_infix('text').startswith('('):
+      left = self.term(bound)
+    return Node(Token(symbol), [left, self.term(bound)])
+
+  def term(self, bound: tuple = ()) -> Node:
+    rng = self.rng
+    root = []
+    stack = [(root, 0)]
+    while stack:
+      kids, depth = stack.pop()
+      if depth >= self.term_depth or rng.random() < 0.4:
+        kids.append(Node(Token(self.identifier(bound))))
+        continue
+      func, arity = rng.choice(FUNCTIONS)
+      node = Node(Token(func))
+      kids.append(node)
+      stack.extend([(node.children, depth + 1)] * arity)
+    return root[0]
+
+  def identifier(self, bound: tuple) -> str:
+    # mostly bound variables if there are any
+    rng = self.rng
+    r = rng.random()
+    if bound and r < 0.7:
+      return rng.choice(bound)
+    elif r < 0.8:
+      return rng.choice(self.vars)
+    elif r < 0.9 or not self.consts:
+      return str(rng.randrange(10))
+    return rng.choice(self.consts)
+
+  # end of class FormulaGenerator
+
+def node_size(node: Node) -> int:
+  return sum(1 for _ in node.iter_preorder())
+
+class ProofGenerator:
+  """ Random valid Fitch proofs of propositional logic. A proof starts
+      with n_premises premises, some of which are implications and
+      biconditionals between earlier premises and new formulas. Each
+      next line applies a rule chosen by the weights in rules to the
+      lines in scope, opens a subproof (at most max_nesting deep) or
+      closes the current one with imp intro, not intro or not elim.
+      Formulas built by the rules have at most max_fmla_size nodes, and
+      new formulas have fmla_size connectives. """
+  RULES = {'and intro': 2, 'and elim': 3, 'or intro': 1, 'or elim': 1,
+           'imp elim': 4, 'iff elim': 2, 'bot intro': 4, 'bot elim': 1,
+           'repeat': 1, 'LEM': 1, 'subproof': 2, 'close': 2}
+
+  def __init__(self, seed: int = 0, n_premises: int = 3,
+               fmla_size: int = 2, max_fmla_size: int = 40,
+               max_nesting: int = 3, rules: Dict[str, float] | None = None,
+               n_letters: int = 4):
+    self.fmla_gen = FormulaGenerator(seed, first_order=False,
+                                     n_letters=n_letters)
+    self.rng = self.fmla_gen.rng
+    weights = dict(self.RULES)
+    weights.update(rules or {})
+    self.rules = [rule for rule, w in weights.items() if w > 0]
+    self.weights = [weights[rule] for rule in self.rules]
+    self.n_premises = max(1, n_premises)
+    self.fmla_size = fmla_size
+    self.max_fmla_size = max_fmla_size
+    self.max_nesting = max_nesting
+
+  def proof(self, n_lines: int, kind: str = 'valid') -> 'ProofNodeS':
+    """ The proof_str() parsed and validated, as a ProofNodeS. """
+    return ProofNodeS(parse_fitch(self.proof_str(n_lines, kind)))
+
+  def proof_str(self, n_lines: int, kind: str = 'valid') -> str:
+    """ A proof of about n_lines lines. kind is 'valid', 'invalid' for a
+        proof in which the formula of one line is negated, or 'search'
+        for the valid proof without the annotations of the lines which
+        are not hypotheses. """
+    if kind not in ('valid', 'invalid', 'search'):
+      raise ValueError(f"ProofGenerator: unknown kind '{kind}'.")
+    rows = self.build(n_lines)
+    if kind == 'invalid':
+      self.corrupt(rows)
+    return self.rows_str(rows, annotate=kind != 'search')
+
+  @staticmethod
+  def rows_str(rows: List[list], annotate: bool = True) -> str:
+    # Without annotate, only the hypotheses keep their annotations.
+    out = []
+    for level, fmla, ann in rows:
+      indent = '  ' * level
+      if fmla is None:
+        out.append(indent + 'proves')
+      elif not annotate and ann != 'hyp':
+        out.append(f"{indent}{fmla.build_infix('text')}")
+      else:
+        out.append(f"{indent}{fmla.build_infix('text')} .{ann}")
+    return '\n'.join(out) + '\n'
+
+  def proofs(self, n: int, n_lines: int, kind: str = 'valid') -> List[str]:
+    return [self.proof_str(n_lines, kind) for _ in range(n)]
+
+  def new_fmla(self, size: int | None = None) -> Node:
+    return parse_ast(self.fmla_gen.formula(self.fmla_size if size is None
+                                           else size))
+
+  def compound(self, conn: str, kids: List[Node]) -> Node | None:
+    """ The formula conn(kids), or None if it has more than max_fmla_size
+        nodes or if its text does not parse back into it. """
+    fmla = Node(Token(conn), kids)
+    if sum(node_size(kid) for kid in kids) >= self.max_fmla_size or \
+       parse_ast(fmla.build_infix('text')) != fmla:
+      return None
+    return fmla
+
+  def build(self, n_lines: int) -> List[list]:
+    """ The rows [level, formula, annotation] of a valid proof, where a
+        row [level, None, None] is 'proves'. """
+    rng = self.rng
+    self.rows = []
+    self.n = 0 # number of lines
+    # the open subproofs, the proof itself first: [hyp line number,
+    #   lines in scope as (line number, formula, polish notation)]
+    self.scopes = [[1, []]]
+    for i in range(self.n_premises):
+      premises = self.scopes[0][1]
+      fmla = None
+      if premises and rng.random() < 0.5:
+        conn = 'imp' if rng.random() < 0.7 else 'iff'
+        fmla = self.compound(conn, [rng.choice(premises)[1], 
+                                    self.new_fmla()])
+      self.add(fmla or self.new_fmla(), 'hyp')
+    self.rows.append([0, None, None])
+    while self.n < n_lines - (len(self.scopes) - 1):
+      for rule in rng.choices(self.rules, self.weights, k=5):
+        if self.apply(rule, n_lines):
+          break
+      else:
+        self.apply('repeat', n_lines)
+    while len(self.scopes) > 1:
+      self.apply('close', n_lines)
+    return self.rows
+
+  def add(self, fmla: Node, ann: str) -> int:
+    self.n += 1
+    self.rows.append([len(self.scopes) - 1, fmla, ann])
+    self.scopes[-1][1].append((self.n, fmla, fmla.build_polish_notation()))
+    return self.n
+
+  def in_scope(self) -> List[tuple]:
+    return [line for scope in self.scopes for line in scope[1]]
+
+  def apply(self, rule: str, n_lines: int) -> bool:
+    """ Add the line(s) of rule and return True, or return False if rule
+        can't be applied now. """
+    rng = self.rng
+    lines = self.in_scope()
+    if rule == 'repeat':
+      ln, fmla, _ = rng.choice(lines)
+      self.add(fmla, f"repeat {ln}")
+    elif rule == 'LEM':
+      fmla = self.new_fmla()
+      if not (conc := self.compound('or', [fmla, Node(Token('not'), 
+                                                      [fmla])])):
+        return False
+      self.add(conc, 'LEM')
+    elif rule == 'and intro':
+      (ln1, fmla1, _), (ln2, fmla2, _) = rng.choice(lines), rng.choice(lines)
+      if not (conc := self.compound('and', [fmla1, fmla2])):
+        return False
+      self.add(conc, f"and intro {ln1},{ln2}")
+    elif rule == 'or intro':
+      ln, fmla, _ = rng.choice(lines)
+      other = self.new_fmla()
+      kids = [fmla, other] if rng.random() < 0.5 else [other, fmla]
+      if not (conc := self.compound('or', kids)):
+        return False
+      self.add(conc, f"or intro {ln}")
+    elif rule in ('and elim', 'bot elim'):
+      conn = rule.split()[0]
+      cands = [line for line in lines if line[1].token.value == conn]
+      if not cands:
+        return False
+      ln, fmla, _ = rng.choice(cands)
+      conc = rng.choice(fmla.children) if conn == 'and' else self.new_fmla()
+      self.add(conc, f"{rule} {ln}")
+    elif rule in ('imp elim', 'iff elim', 'bot intro'):
+      # pairs of lines (major, minor) to which rule applies
+      by_polish = {polish: ln for ln, _, polish in lines}
+      cands = []
+      for ln, fmla, _ in lines:
+        conn = fmla.token.value
+        if rule == 'bot intro' and conn == 'not':
+          minor = fmla.children[0].build_polish_notation()
+          if minor in by_polish:
+            cands.append((ln, by_polish[minor], Node(Token('bot'))))
+        elif rule == 'imp elim' and conn == 'imp' or \
+             rule == 'iff elim' and conn == 'iff':
+          for k in range(1 if conn == 'imp' else 2):
+            minor = fmla.children[k].build_polish_notation()
+            if minor in by_polish:
+              cands.append((ln, by_polish[minor], fmla.children[1 - k]))
+      if not cands:
+        return False
+      ln1, ln2, conc = rng.choice(cands)
+      self.add(conc, f"{rule} {ln1},{ln2}")
+    elif rule == 'subproof':
+      if len(self.scopes) > self.max_nesting or \
+         self.n + len(self.scopes) + 2 > n_lines:
+        return False
+      r = rng.random()
+      if r < 0.4:
+        # not A for A in scope, which leads to bot intro and not elim
+        hyp = Node(Token('not'), [rng.choice(lines)[1]])
+      elif r < 0.7 and (cands := [line[1].children[0] for line in lines
+                                   if line[1].token.value == 'imp']):
+        hyp = rng.choice(cands) # the antecedent of an implication
+      else:
+        hyp = self.new_fmla()
+      self.open_subproof(hyp)
+    elif rule == 'close':
+      if len(self.scopes) == 1:
+        return False
+      hyp_ln, scope_lines = self.scopes[-1]
+      if len(scope_lines) == 1: # nothing but the hypothesis
+        self.add(scope_lines[0][1], f"repeat {hyp_ln}")
+      hyp, last = scope_lines[0][1], scope_lines[-1][1]
+      self.scopes.pop()
+      range_str = f"{hyp_ln}-{self.n}"
+      if last.token.value != 'bot':
+        self.add(Node(Token('imp'), [hyp, last]), f"imp intro {range_str}")
+      elif hyp.token.value == 'not' and rng.random() < 0.7:
+        self.add(hyp.children[0], f"not elim {range_str}")
+      else:
+        self.add(Node(Token('not'), [hyp]), f"not intro {range_str}")
+    elif rule == 'or elim':
+      # from A or B, infer B or A by cases
+      cands = [line for line in lines if line[1].token.value == 'or']
+      if not cands or len(self.scopes) > self.max_nesting or \
+         self.n + len(self.scopes) + 5 > n_lines:
+        return False
+      ln, fmla, _ = rng.choice(cands)
+      if not (conc := self.compound('or', fmla.children[::-1])):
+        return False
+      ranges = []
+      for kid in fmla.children:
+        hyp_ln = self.open_subproof(kid)
+        self.add(conc, f"or intro {hyp_ln}")
+        self.scopes.pop()
+        ranges.append(f"{hyp_ln}-{self.n}")
+      self.add(conc, f"or elim {ln},{ranges[0]},{ranges[1]}")
+    else:
+      raise ValueError(f"ProofGenerator: unknown rule '{rule}'.")
+    return True
+
+  def open_subproof(self, hyp: Node) -> int:
+    self.scopes.append([self.n + 1, []])
+    hyp_ln = self.add(hyp, 'hyp')
+    self.rows.append([len(self.scopes) - 1, None, None])
+    return hyp_ln
+
+  def corrupt(self, rows: List[list]) -> None:
+    """ Negate the formula of a random line which is not a hypothesis,
+        so that the line is invalid. The negation may still be valid, as
+        in B from B and not B, and then another line is tried. """
+    cands = [row for row in rows if row[1] is not None and row[2] != 'hyp']
+    self.rng.shuffle(cands)
+    for row in cands:
+      fmla = row[1]
+      row[1] = Node(Token('not'), [fmla])
+      if not parse_fitch(self.rows_str(rows)).verified_all():
+        return
+      row[1] = fmla
+
+  # end of class ProofGenerator
+
+def main(argv=None) -> None:
+  import argparse
+
+  arg_parser = argparse.ArgumentParser(description="Print a random corpus "
+                                       "of formulas or proofs")
+  group = arg_parser.add_mutually_exclusive_group(required=True)
+  group.add_argument('--formulas', type=int, metavar='N')
+  group.add_argument('--proofs', type=int, metavar='N')
+  arg_parser.add_argument('--seed', type=int, default=0)
+  arg_parser.add_argument('--size', type=int, default=10,
+                          help="connectives per formula")
+  arg_parser.add_argument('--prop', action='store_true',
+                          help="propositional formulas only")
+  arg_parser.add_argument('--lines', type=int, default=30,
+                          help="lines per proof")
+  arg_parser.add_argument('--kind', choices=['valid', 'invalid', 'search'],
+                          default='valid')
+  args = arg_parser.parse_args(argv)
+  if args.formulas is not None:
+    gen = FormulaGenerator(args.seed, first_order=not args.prop)
+    for _ in range(args.formulas):
+      print(gen.formula(args.size))
+  else:
+    gen = ProofGenerator(args.seed)
+    print('\n'.join(gen.proofs(args.proofs, args.lines, args.kind)), end='')
+
+if __name__ == '__main__':
+  main()
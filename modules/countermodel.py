@@ -0,0 +1,556 @@
+# Finite countermodels of first-order sequents.
+#
+# A countermodel of premises |- conclusion is a structure, with an
+# assignment of its free variables, in which all premises are true and
+# the conclusion is false. It shows that the sequent is not valid, so no
+# proof of it can be correct. The search tries the domain sizes 1, 2, 3,
+# ... in turn, as Mace and Paradox do:
+#   1. The sequent is grounded over the domain {0, .., size-1} into a
+#      propositional formula. A predicate symbol has one boolean variable
+#      for each tuple of arguments, and a function symbol, a constant or
+#      a free variable has one for each tuple of arguments and each
+#      value, exactly one of which is true. Terms are grounded into such
+#      one-hot vectors of literals, quantifiers into conjunctions and
+#      disjunctions over the domain, and the rest into Tseitin clauses.
+#      As in model_check.py, '=' and '!=' are not interpreted.
+#   2. Symmetry breaking by the least number heuristic: the constants
+#      c_0, c_1, .. (and the free variables) in the order of their first
+#      occurrence take their values in the order of the elements, i.e.,
+#      c_i is at most i, and if c_i = d > 0 then c_j = d-1 for some j < i.
+#      Every model is isomorphic to one of this form.
+#   3. The clauses are solved by SatSolver, a small CDCL solver.
+# The search stops at max_size, after timeout seconds, or when the
+# grounding exceeds max_clauses, and the status tells which.
+#
+# Usage:
+#   search = CountermodelSearch(['forall x exists y R2(x, y)'],
+#                               'exists y forall x R2(x, y)')
+#   structure = search.run() # a model_check.Structure, or None
+#   print(search)            # the status and the model
+# or find_countermodel(premises, conclusion) for the structure only.
+
+import time, heapq
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from modules.first_order_logic_parse import *
+from modules.model_check import Structure, TERM_SYMBOLS, PRED_SYMBOLS
+
+TRUE, FALSE = 1, -1 # the variable 1 of a Grounding is always true
+
+class BudgetExceeded(Exception):
+  pass
+
+class SatSolver:
+  """ A small CDCL SAT solver with two watched literals, first UIP clause
+      learning, activity-based decisions with phase saving, and Luby
+      restarts. Variables are 1, 2, .., and literals are v and -v, as in
+      DIMACS. """
+  def __init__(self):
+    self.n_vars = 0
+    self.clauses = [] # the first two literals of a clause are watched
+    self.watches = [[], []] # at 2*v + (lit < 0): clauses watching lit
+    self.value = [0] # per variable: 1 true, -1 false, 0 unassigned
+    self.level = [0]
+    self.reason = [None] # index of the clause which implied the variable
+    self.activity = [0.0]
+    self.phase = [False]
+    self.units = [] # unit clauses, assigned when solve() starts
+    self.trail = [] # assigned literals in order
+    self.trail_lim = [] # start of each decision level in trail
+    self.q_head = 0 # trail[q_head:] are not propagated yet
+    self.heap = [] # (-activity, var), with stale entries
+    self.var_inc = 1.0
+    self.ok = True
+    self.n_conflict = 0
+
+  def new_var(self) -> int:
+    self.n_vars += 1
+    self.watches += [[], []]
+    self.value.append(0)
+    self.level.append(0)
+    self.reason.append(None)
+    self.activity.append(0.0)
+    self.phase.append(False)
+    heapq.heappush(self.heap, (0.0, self.n_vars))
+    return self.n_vars
+
+  def add_clause(self, lits) -> None:
+    # to be called before solve()
+    lits = list(dict.fromkeys(lits))
+    if any(-lit in lits for lit in lits):
+      return # tautology
+    if not lits:
+      self.ok = False
+    elif len(lits) == 1:
+      self.units.append(lits[0])
+    else:
+      self.watch_clause(lits)
+
+  def watch_clause(self, lits: List[int]) -> int:
+    self.clauses.append(lits)
+    ci = len(self.clauses) - 1
+    for lit in lits[:2]:
+      self.watches[2 * abs(lit) + (lit < 0)].append(ci)
+    return ci
+
+  def lit_value(self, lit: int) -> int:
+    return self.value[lit] if lit > 0 else -self.value[-lit]
+
+  def enqueue(self, lit: int, reason) -> None:
+    var = abs(lit)
+    self.value[var] = 1 if lit > 0 else -1
+    self.level[var] = len(self.trail_lim)
+    self.reason[var] = reason
+    self.trail.append(lit)
+
+  def propagate(self):
+    # Return the index of a conflicting clause, or None.
+    value, clauses, watches = self.value, self.clauses, self.watches
+    while self.q_head < len(self.trail):
+      false_lit = -self.trail[self.q_head]
+      self.q_head += 1
+      ws = watches[2 * abs(false_lit) + (false_lit < 0)]
+      i = j = 0
+      while i < len(ws):
+        ci = ws[i]
+        i += 1
+        c = clauses[ci]
+        if c[0] == false_lit:
+          c[0], c[1] = c[1], false_lit
+        first = c[0]
+        v_first = value[first] if first > 0 else -value[-first]
+        if v_first == 1:
+          ws[j] = ci
+          j += 1
+          continue
+        for k in range(2, len(c)):
+          lit = c[k]
+          if (value[lit] if lit > 0 else -value[-lit]) != -1:
+            c[1], c[k] = lit, false_lit
+            watches[2 * abs(lit) + (lit < 0)].append(ci)
+            break
+        else: # c is unit or conflicting
+          ws[j] = ci
+          j += 1
+          if v_first == -1:
+            while i < len(ws):
+              ws[j] = ws[i]
+              j += 1
+              i += 1
+            del ws[j:]
+            return ci
+          self.enqueue(first, ci)
+      del ws[j:]
+    return None
+
+  def bump(self, var: int) -> None:
+    self.activity[var] += self.var_inc
+    if self.activity[var] > 1e100:
+      self.activity = [a * 1e-100 for a in self.activity]
+      self.var_inc *= 1e-100
+      self.heap = [(-self.activity[v], v) for v in range(1, self.n_vars + 1)
+                   if self.value[v] == 0]
+      heapq.heapify(self.heap)
+    elif self.value[var] == 0:
+      heapq.heappush(self.heap, (-self.activity[var], var))
+
+  def analyze(self, ci: int) -> Tuple[List[int], int]:
+    # The first UIP clause learnt from the conflicting clause ci, with the
+    # asserting literal first, and the level to jump back to.
+    cur_level = len(self.trail_lim)
+    learnt = [0]
+    seen = set()
+    n_open = 0 # literals of the current level still to be resolved
+    p = None
+    i = len(self.trail) - 1
+    while True:
+      c = self.clauses[ci]
+      for lit in (c if p is None else c[1:]):
+        var = abs(lit)
+        if var not in seen and self.level[var] > 0:
+          seen.add(var)
+          self.bump(var)
+          if self.level[var] == cur_level:
+            n_open += 1
+          else:
+            learnt.append(lit)
+      while abs(self.trail[i]) not in seen:
+        i -= 1
+      p = self.trail[i]
+      i -= 1
+      n_open -= 1
+      if n_open == 0:
+        break
+      ci = self.reason[abs(p)]
+    learnt[0] = -p
+    if len(learnt) == 1:
+      return learnt, 0
+    k = max(range(1, len(learnt)), key=lambda k: self.level[abs(learnt[k])])
+    learnt[1], learnt[k] = learnt[k], learnt[1]
+    return learnt, self.level[abs(learnt[1])]
+
+  def backtrack(self, level: int) -> None:
+    if len(self.trail_lim) <= level:
+      return
+    start = self.trail_lim[level]
+    for lit in self.trail[start:]:
+      var = abs(lit)
+      self.value[var] = 0
+      self.reason[var] = None
+      self.phase[var] = lit > 0
+      heapq.heappush(self.heap, (-self.activity[var], var))
+    del self.trail[start:]
+    del self.trail_lim[level:]
+    self.q_head = len(self.trail)
+
+  def decide(self) -> bool:
+    # Assign an unassigned variable, or return False if there is none.
+    while self.heap:
+      _, var = heapq.heappop(self.heap)
+      if self.value[var] == 0:
+        self.trail_lim.append(len(self.trail))
+        self.enqueue(var if self.phase[var] else -var, None)
+        return True
+    return False
+
+  def solve(self, deadline: float | None = None):
+    """ True if the clauses are satisfiable, False if not, and None if the
+        deadline (in time.monotonic()) passed first. """
+    if not self.ok:
+      return False
+    for lit in self.units:
+      if self.lit_value(lit) == -1:
+        self.ok = False
+        return False
+      if self.lit_value(lit) == 0:
+        self.enqueue(lit, None)
+    n_restart = 0
+    budget = 100 * luby(n_restart)
+    while True:
+      ci = self.propagate()
+      if ci is not None:
+        self.n_conflict += 1
+        if not self.trail_lim:
+          self.ok = False
+          return False
+        learnt, level = self.analyze(ci)
+        self.backtrack(level)
+        if len(learnt) == 1:
+          self.enqueue(learnt[0], None)
+        else:
+          self.enqueue(learnt[0], self.watch_clause(learnt))
+        self.var_inc /= 0.95
+        budget -= 1
+        if deadline is not None and self.n_conflict % 64 == 0 and \
+           time.monotonic() > deadline:
+          return None
+      elif budget <= 0:
+        n_restart += 1
+        budget = 100 * luby(n_restart)
+        self.backtrack(0)
+      elif not self.decide():
+        return True
+
+  def model(self) -> List[bool]:
+    # model()[v] is the value of the variable v after solve() is True.
+    return [value == 1 for value in self.value]
+
+def luby(i: int) -> int:
+  # the i-th term (from 0) of 1, 1, 2, 1, 1, 2, 4, 1, 1, 2, ..
+  size, seq = 1, 0
+  while size < i + 1:
+    seq += 1
+    size = 2 * size + 1
+  while size - 1 != i:
+    size = (size - 1) // 2
+    seq -= 1
+    i %= size
+  return 2 ** seq
+
+class Grounding:
+  """ The clauses of the sequent over the domain {0, .., size-1} in a
+      SatSolver. The value of a term is a one-hot tuple of literals, one
+      for each element. """
+  def __init__(self, size: int, signature: Dict, consts: List[str],
+               max_clauses: int, deadline: float | None):
+    self.size = size
+    self.solver = SatSolver()
+    self.max_clauses = max_clauses
+    self.deadline = deadline
+    self.n_clause = 0
+    self.solver.new_var() # TRUE
+    self.solver.add_clause([TRUE])
+    self.gates = {} # (op, frozenset of literals) -> literal
+    self.memo = {} # (id(node), values of its free vars) -> value
+    self.elements = [tuple(TRUE if b == e else FALSE for b in range(size))
+                     for e in range(size)]
+    # tables[(symbol, arity)][args] is a one-hot tuple for a function,
+    # and a literal for a predicate
+    self.tables = {}
+    for (symbol, arity), b_pred in signature.items():
+      table = self.tables[(symbol, arity)] = {}
+      for args in np.ndindex((size,) * arity):
+        table[args] = self.new_var() if b_pred else self.one_hot()
+    self.break_symmetry(consts)
+
+  def add_clause(self, lits) -> None:
+    if TRUE in lits:
+      return
+    self.solver.add_clause([lit for lit in lits if lit != FALSE])
+    self.n_clause += 1
+    if self.n_clause > self.max_clauses:
+      raise BudgetExceeded('too_large')
+    if self.n_clause % 4096 == 0 and self.deadline is not None and \
+       time.monotonic() > self.deadline:
+      raise BudgetExceeded('timeout')
+
+  def new_var(self) -> int:
+    return self.solver.new_var()
+
+  def one_hot(self) -> tuple:
+    lits = tuple(self.new_var() for _ in range(self.size))
+    self.add_clause(lits)
+    for i, lit in enumerate(lits):
+      for lit2 in lits[i + 1:]:
+        self.add_clause([-lit, -lit2])
+    return lits
+
+  def break_symmetry(self, consts: List[str]) -> None:
+    for i, symbol in enumerate(consts):
+      lits = self.tables[(symbol, 0)][()]
+      for d in range(i + 1, self.size):
+        self.add_clause([-lits[d]])
+      for d in range(1, min(i + 1, self.size)):
+        self.add_clause([-lits[d]] + [self.tables[(c, 0)][()][d - 1]
+                                      for c in consts[:i]])
+
+  # gates with constant folding and sharing
+  def and_(self, lits):
+    lits = frozenset(lits)
+    if FALSE in lits:
+      return FALSE
+    lits = lits - {TRUE}
+    if not lits:
+      return TRUE
+    if len(lits) == 1:
+      return next(iter(lits))
+    if any(-lit in lits for lit in lits):
+      return FALSE
+    key = ('and', lits)
+    gate = self.gates.get(key)
+    if gate is None:
+      gate = self.gates[key] = self.new_var()
+      for lit in lits:
+        self.add_clause([-gate, lit])
+      self.add_clause([gate] + [-lit for lit in lits])
+    return gate
+
+  def or_(self, lits):
+    return -self.and_(-lit for lit in lits)
+
+  def iff_(self, a, b):
+    if abs(a) == TRUE:
+      return b if a == TRUE else -b
+    if abs(b) == TRUE:
+      return a if b == TRUE else -a
+    if a == b:
+      return TRUE
+    if a == -b:
+      return FALSE
+    key = ('iff', frozenset((a, b)))
+    gate = self.gates.get(key)
+    if gate is None:
+      gate = self.gates[key] = self.new_var()
+      self.add_clause([-gate, -a, b])
+      self.add_clause([-gate, a, -b])
+      self.add_clause([gate, a, b])
+      self.add_clause([gate, -a, -b])
+    return gate
+
+  def apply(self, table: Dict, kids: List[tuple], b_pred: bool):
+    # The value of a symbol applied to the one-hot values kids: the
+    # disjunction over the possible arguments.
+    options = [[(e, lit) for e, lit in enumerate(kid) if lit != FALSE]
+               for kid in kids]
+    cases = [((), [])]
+    for opts in options:
+      cases = [(args + (e,), conds + [lit]) for args, conds in cases
+               for e, lit in opts]
+    if b_pred:
+      return self.or_(self.and_(conds + [table[args]])
+                      for args, conds in cases)
+    return tuple(self.or_(self.and_(conds + [table[args][b]])
+                          for args, conds in cases)
+                 for b in range(self.size))
+
+  def ground(self, node: Node, env: Dict):
+    """ The literal of the formula node, or the one-hot value of the term
+        node, where env maps the free variables of node to one-hot values.
+        An explicit stack is used, and shared results are memoized. """
+    values = []
+    stack = [(node, env, False)]
+    while stack:
+      node, env, b_kids_done = stack.pop()
+      key = (id(node),) + tuple(env[var] for var in
+                                sorted(node.free_vars()))
+      if not b_kids_done:
+        if key in self.memo:
+          values.append(self.memo[key])
+          continue
+        stack.append((node, env, True))
+        if node.token.token_type == 'quantifier':
+          det = node.children[0]
+          var, scope = det.token.value, det.children[0]
+          stack.extend((scope, {**env, var: element}, False)
+                       for element in reversed(self.elements))
+        else:
+          stack.extend((kid, env, False) for kid in reversed(node.children))
+        continue
+      n_kid = self.size if node.token.token_type == 'quantifier' \
+              else len(node.children)
+      kids = values[len(values) - n_kid:]
+      del values[len(values) - n_kid:]
+      value = self.memo[key] = self.gate(node, kids, env)
+      values.append(value)
+    return values.pop()
+
+  def gate(self, node: Node, kids: List, env: Dict):
+    token = node.token
+    value, token_type = token.value, token.token_type
+    if token_type == 'var':
+      return env[value]
+    elif token_type == 'equality' or value == '!=':
+      equal = self.or_(self.and_(pair) for pair in zip(*kids))
+      return equal if value == '=' else -equal
+    elif token_type in TERM_SYMBOLS or token_type in PRED_SYMBOLS:
+      table = self.tables[(value, len(kids))]
+      return self.apply(table, kids, token_type in PRED_SYMBOLS)
+    elif token_type == 'conn_0ary':
+      return TRUE if value == 'top' else FALSE
+    elif value == 'not':
+      return -kids[0]
+    elif value == 'and':
+      return self.and_(kids)
+    elif value == 'or':
+      return self.or_(kids)
+    elif value == 'imp':
+      return self.or_([-kids[0], kids[1]])
+    elif value == 'iff':
+      return self.iff_(kids[0], kids[1])
+    elif value == 'xor':
+      return -self.iff_(kids[0], kids[1])
+    elif value == 'forall':
+      return self.and_(kids)
+    elif value == 'exists':
+      return self.or_(kids)
+    raise ValueError(f"Grounding: can't ground '{value}'.")
+
+class CountermodelSearch:
+  """ Search for a finite countermodel of premises |- conclusion, where
+      the formulas are strings or Nodes. Free variables are shared by the
+      formulas and get values like constants. """
+  def __init__(self, premises: List, conclusion, max_size: int = 8,
+               timeout: float = 10.0, max_clauses: int = 1_000_000):
+    self.premises = [parse_ast(f) if isinstance(f, str) else f
+                     for f in premises]
+    self.conclusion = parse_ast(conclusion) \
+                      if isinstance(conclusion, str) else conclusion
+    self.max_size = max_size
+    self.timeout = timeout
+    self.max_clauses = max_clauses
+    self.status = 'not_run' # | found | exhausted | timeout | too_large
+    self.size = 0 # the last domain size tried
+    self.structure = None # type: Structure | None
+    self.assignment = {} # type: Dict[str, int]
+
+  def signature(self) -> Tuple[Dict, List[str], List[str]]:
+    # {(symbol, arity): is a predicate}, the constants in the order of
+    # first occurrence, and the free variables
+    signature = {}
+    consts = []
+    for fmla in self.premises + [self.conclusion]:
+      stack = [fmla]
+      while stack:
+        node = stack.pop()
+        token = node.token
+        key = (token.value, len(node.children))
+        if key not in signature and token.value != '!=' and \
+           (token.token_type in TERM_SYMBOLS or
+            token.token_type in PRED_SYMBOLS):
+          signature[key] = token.token_type in PRED_SYMBOLS
+          if key[1] == 0 and not signature[key]:
+            consts.append(token.value)
+        stack.extend(reversed(node.children))
+    free_vars = set()
+    for fmla in self.premises + [self.conclusion]:
+      free_vars |= fmla.free_vars()
+    return signature, consts, sorted(free_vars)
+
+  def run(self):
+    """ Try the domain sizes 1, 2, .. up to max_size. Return the
+        countermodel found, or None, and set self.status. """
+    deadline = time.monotonic() + self.timeout
+    signature, consts, free_vars = self.signature()
+    # the free variables are grounded as constants, under their own names
+    for var in free_vars:
+      signature[(var, 0)] = False
+    self.status = 'exhausted'
+    for size in range(1, self.max_size + 1):
+      self.size = size
+      try:
+        grounding = Grounding(size, signature, consts + free_vars,
+                              self.max_clauses, deadline)
+        env = {var: grounding.tables[(var, 0)][()] for var in free_vars}
+        for fmla in self.premises:
+          grounding.add_clause([grounding.ground(fmla, env)])
+        grounding.add_clause([-grounding.ground(self.conclusion, env)])
+      except BudgetExceeded as e:
+        self.status = str(e)
+        return None
+      result = grounding.solver.solve(deadline)
+      if result is None:
+        self.status = 'timeout'
+        return None
+      if result:
+        self.status = 'found'
+        self.read_model(grounding, signature, free_vars)
+        return self.structure
+    return None
+
+  def read_model(self, grounding: Grounding, signature: Dict,
+                 free_vars: List[str]) -> None:
+    model = grounding.solver.model()
+    def lit_value(lit: int) -> bool:
+      return model[abs(lit)] == (lit > 0)
+
+    self.structure = Structure(grounding.size)
+    for (symbol, arity), b_pred in signature.items():
+      table = grounding.tables[(symbol, arity)]
+      arr = np.zeros((grounding.size,) * arity,
+                     dtype=bool if b_pred else np.intp)
+      for args, lits in table.items():
+        arr[args] = lit_value(lits) if b_pred else \
+                    [lit_value(lit) for lit in lits].index(True)
+      if symbol in free_vars:
+        self.assignment[symbol] = int(arr)
+      else:
+        self.structure[symbol] = arr
+
+  def __str__(self):
+    if self.status == 'found':
+      lines = [f"countermodel of size {self.size}", str(self.structure)]
+      lines += [f"{var} := {self.structure.name(element)}"
+                for var, element in sorted(self.assignment.items())]
+      return '\n'.join(lines)
+    return {'not_run': "not run yet",
+            'exhausted': f"no countermodel of size <= {self.max_size}",
+            'timeout': f"timeout while trying size {self.size}",
+            'too_large': f"grounding too large at size {self.size}"
+            }[self.status]
+
+def find_countermodel(premises: List, conclusion, **budgets):
+  """ A finite countermodel of premises |- conclusion, or None if none was
+      found within the budgets of CountermodelSearch. """
+  return CountermodelSearch(premises, conclusion, **budgets).run()
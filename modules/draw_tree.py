@@ -1,14 +1,21 @@
+from typing import List, Tuple, Any
+
 from modules.first_order_logic_parse import *
 
 #region (1/2) Utils for rendering AST ## ------------------------------
 
-def draw_ast(ast: Node, verbose=False):
+def draw_ast(ast: Node, verbose=False, dpi=300, fontset='cm', usetex=True):
+  ast_figure(ast, verbose, dpi, fontset, usetex)
+
+def ast_figure(ast: Node, verbose=False, dpi=300, fontset='cm', 
+               usetex=True):
+  # The matplotlib figure drawn by draw_ast().
   import matplotlib.pyplot as plt
 
-  plt.rcParams["mathtext.fontset"] = "cm" 
+  plt.rcParams["mathtext.fontset"] = fontset
     # cm = computer modern by Donald Knuth
-  plt.rcParams["figure.dpi"] = 300 # default 100
-  plt.rcParams["text.usetex"] = True 
+  plt.rcParams["figure.dpi"] = dpi # default 100
+  plt.rcParams["text.usetex"] = usetex
     # without this, some LaTeX commands do not work
   fig, ax = plt.subplots(1, 1, figsize=(3, 1.5))
   ax.set(aspect='equal')
@@ -25,6 +32,20 @@ def draw_ast(ast: Node, verbose=False):
     print(tree)
 
   tree.draw_tree_GNode(plt)
+  return fig
+
+def render_ast_image(ast: Node, fmt='png', dpi=300, fontset='cm', 
+                     usetex=True) -> bytes:
+  """ The image of draw_ast() as bytes in the format fmt of savefig(), 
+      without showing it. See render_cache.py. """
+  import io
+  import matplotlib.pyplot as plt
+
+  fig = ast_figure(ast, False, dpi, fontset, usetex)
+  buf = io.BytesIO()
+  fig.savefig(buf, format=fmt, bbox_inches='tight')
+  plt.close(fig)
+  return buf.getvalue()
 
 def build_GNode(ast: Node, xpos, ypos, ax, r):
   # Node has 3 attributes: token: Token, children: list of Nodes, 
@@ -235,3 +256,158 @@ class GNode: # graph node
       for kid in self.children:
         kid.draw_tree_GNode(plt1)
 # endregion
+
+#region (3/3) SVG trees without matplotlib ## -------------------------
+# build_ast_svg() draws the same bussproof style trees as draw_ast(), but
+# needs neither matplotlib nor TeX. Label widths are estimated from 
+# GLYPH_WIDTHS instead of being measured by a renderer, and the layout is
+# a Reingold-Tilford pass over the contours of the subtrees. The trees 
+# are walked with explicit stacks since formulas built by programs can be
+# nested far beyond Python's recursion limit.
+
+# Advance widths in em of a Times-like serif font. Others are 0.5em.
+GLYPH_WIDTHS = {
+  **dict.fromkeys("ijlt'", 0.28), **dict.fromkeys('fr()[]{}|', 0.33),
+  **dict.fromkeys(' ,.:;', 0.25), **dict.fromkeys('mw', 0.75),
+  **dict.fromkeys('ABCDEFGHKLNOPQRSTUVXYZ', 0.68), 
+  **dict.fromkeys('IJ', 0.36), **dict.fromkeys('MW', 0.9),
+  **dict.fromkeys('+-=<>*/^~', 0.56), **dict.fromkeys('¬≤≥', 0.6),
+  **dict.fromkeys('∧∨∀∃∈∉∅', 0.7), **dict.fromkeys('⊥⊤⊕', 0.78),
+  **dict.fromkeys('→↔', 1.0)}
+
+def text_width(text: str, font_size: float = 14) -> float:
+  """ Estimated width in px of text in a serif font of font_size px. """
+  return font_size * sum(GLYPH_WIDTHS.get(c, 0.5) for c in text)
+
+def svg_label(ast: Node) -> str:
+  """ The label of ast in build_ast_svg(). Unicode counterpart of the 
+      labels of build_GNode(). """
+  token = ast.token
+  if ast.type != 'formula':
+    return ast.build_infix_term('text')
+  elif token.token_type in ('pred_pre', 'prop_letter'):
+    return Node.ident2latex(token, 'text')
+  elif token.token_type == 'quantifier':
+    kid1 = ast.children[0] # a variable for the determiner
+    return Node.UNICODE_DICT[token.value] + Node.ident2latex(kid1.token, 
+                                                            'text')
+  else:
+    return Node.UNICODE_DICT.get(token.value, token.value)
+
+def svg_tree(ast: Node) -> Tuple[List[str], List[List[int]]]:
+  """ The labels and the children of the nodes of the tree drawn for ast,
+      numbered in pre-order. As in build_GNode(), terms are leaves and a 
+      quantifier node has the scope of its determiner as its only kid. """
+  labels, kids = [], [] # type: List[str], List[List[int]]
+  stack = [(ast, -1)]
+  while stack:
+    node, parent = stack.pop()
+    i = len(labels)
+    labels.append(svg_label(node))
+    kids.append([])
+    if parent >= 0:
+      kids[parent].append(i)
+    if node.type == 'formula' and node.children:
+      if node.token.token_type == 'quantifier':
+        sub = [node.children[0].children[0]]
+      else:
+        sub = node.children
+      stack.extend((kid, i) for kid in reversed(sub))
+  return labels, kids
+
+def tidy_layout(widths: List[float], kids: List[List[int]], gap: float,
+                overhang: float) -> Tuple[List[float], List[float], 
+                                          List[float], float, float, int]:
+  """ Reingold-Tilford layout of a tree whose nodes are numbered in 
+      pre-order, node i being a box of widths[i] with kids[i] above it.
+      Return the x of the center of each node relative to the root, 
+      the extents of the inference line of each node relative to its 
+      center, the leftmost and rightmost x of the tree and its height.
+
+      Each subtree keeps its left and right contours, one entry per 
+      level, stored from the deepest level up so that a parent appends 
+      its own level. A contour (lefts, rights, base) means x = entry + 
+      base. Sibling subtrees are pushed apart level by level, and the 
+      merged contour reuses the lists of the taller one, so a merge costs
+      the height of the shorter one only. """
+  n = len(widths)
+  rel = [0.0] * n # x of node i relative to its parent
+  line_lo, line_hi = [0.0] * n, [0.0] * n
+  contours = [None] * n # type: List[Any]
+  for i in reversed(range(n)): # kids before their parent
+    w2 = widths[i] / 2
+    if not kids[i]:
+      contours[i] = ([-w2], [w2], 0.0)
+      continue
+    # Place the kids side by side, the first one at 0.
+    first, last = kids[i][0], kids[i][-1]
+    lefts, rights, base = contours[first]
+    pos = [0.0]
+    for k in kids[i][1:]:
+      lefts2, rights2, base2 = contours[k]
+      m = min(len(rights), len(lefts2))
+      shift = max(rights[-1-d] + base - lefts2[-1-d] - base2 
+                  for d in range(m)) + gap
+      pos.append(shift)
+      base2 += shift
+      if len(lefts2) > len(lefts): # k is taller
+        for d in range(m):
+          lefts2[-1-d] = lefts[-1-d] + base - base2
+        lefts, rights, base = lefts2, rights2, base2
+      else:
+        for d in range(m):
+          rights[-1-d] = rights2[-1-d] + base2 - base
+    for k in kids[i]:
+      contours[k] = None
+    # Center the root over the labels of the kids, as draw_tree_GNode().
+    center = (pos[0] - widths[first]/2 + pos[-1] + widths[last]/2) / 2
+    for k, x in zip(kids[i], pos):
+      rel[k] = x - center
+    base -= center
+    line_lo[i] = min(-w2, rel[first] - widths[first]/2) - overhang
+    line_hi[i] = max(w2, rel[last] + widths[last]/2) + overhang
+    lefts.append(line_lo[i] - base)
+    rights.append(line_hi[i] - base)
+    contours[i] = (lefts, rights, base)
+  # absolute positions, parents before their kids
+  xs = [0.0] * n
+  for i in range(n):
+    for k in kids[i]:
+      xs[k] = xs[i] + rel[k]
+  lefts, rights, base = contours[0]
+  return xs, line_lo, line_hi, min(lefts) + base, max(rights) + base, \
+         len(lefts)
+
+def build_ast_svg(ast: Node, font_size: float = 14) -> str:
+  """ SVG source of the bussproof style tree of ast, with the root at the
+      bottom. Pure Python and linear in the size of the tree. """
+  import html
+
+  labels, kids = svg_tree(ast)
+  widths = [text_width(label, font_size) for label in labels]
+  xs, line_lo, line_hi, x_min, x_max, n_levels = \
+    tidy_layout(widths, kids, gap=font_size, overhang=0.2 * font_size)
+  margin = font_size / 2
+  row = 2 * font_size # the height of a level
+  width = x_max - x_min + 2 * margin
+  height = n_levels * row + 2 * margin
+
+  items = [f'<svg xmlns="http://www.w3.org/2000/svg" width="{width:.1f}" '
+           f'height="{height:.1f}" viewBox="0 0 {width:.1f} {height:.1f}">'
+           f'<g font-family="serif" font-size="{font_size}" '
+           'text-anchor="middle" stroke="black" stroke-width="0.5">']
+  levels = [0] * len(labels)
+  for i, label in enumerate(labels):
+    for k in kids[i]:
+      levels[k] = levels[i] + 1
+    x = xs[i] - x_min + margin
+    top = margin + (n_levels - 1 - levels[i]) * row
+    items.append(f'<text x="{x:.1f}" y="{top + 1.7 * font_size:.1f}" '
+                 f'stroke="none">{html.escape(label)}</text>')
+    if kids[i]:
+      y = top + 0.35 * font_size
+      items.append(f'<line x1="{x + line_lo[i]:.1f}" y1="{y:.1f}" '
+                   f'x2="{x + line_hi[i]:.1f}" y2="{y:.1f}"/>')
+  items.append('</g></svg>')
+  return '\n'.join(items)
+# endregion
@@ -69,7 +69,7 @@
 
 #endregion
 
-import re
+import re, functools
 
 class Token:
   CONSTS = [ "emptyset", "infty" ]
@@ -87,6 +87,8 @@ class Token:
   RESERVED_WORDS = set(CONSTS + OPER_PRE + OPER_POST + OPER_IN_1 + 
                       OPER_IN_2 + OPER_IN_3 + PRED_IN)
   SPECIAL_CHARS = "-!'^#+*/%=<>()[]{},"
+  VAR_LETTERS = "uvw" + "xyz" + "ijk" + "lmn"
+    # we use concatenation to avoid the stupid cSpell warning
   FMLA_TOKENS = ("pred_pre", "pred_in", "equality", "prop_letter", 
     'conn_0ary') 
     # an expression is a formula iff it has a token in FMLA_TOKENS
@@ -176,11 +178,8 @@ class Token:
       if self.isnumeral(value):
         self.token_type = 'numeral'
         self.precedence = 9
-      elif value[0] in "uvw" + "xyz" + "ijk" + "lmn":
-        # we use concatenation to avoid the stupid cSpell warning
-        if (len_s==1 or 
-            (len_s >= 3 and value[1]=='_' 
-             and Token.isword(value[2:], "decimal"))):
+      elif value[0] in Token.VAR_LETTERS:
+        if Token.is_var_str(value):
           self.token_type = 'var'
           self.precedence = 9
         else:
@@ -195,6 +194,7 @@ class Token:
         if len_s==1 or Token.isword(value[1:]):
           self.token_type = 'func_pre'
           self.arity = self.get_arity(value)
+          self.precedence = 9 # f(..) is atomic like an identifier
         else:
           raise ValueError(f"'{value}' is invalid function symbol (Token)")
       elif Token.isword(value, "upper"):
@@ -206,6 +206,12 @@ class Token:
       else:
         raise ValueError(f"'{value}' is invalid (Token)")
   
+  @staticmethod
+  def is_var_str(s: str) -> bool:
+    # x, or x_ followed by decimal digits, for x in VAR_LETTERS
+    return s[:1] in Token.VAR_LETTERS and (len(s) == 1 or 
+      (len(s) >= 3 and s[1] == '_' and Token.isword(s[2:], "decimal")))
+
   @staticmethod
   def isnumeral(s: str) -> bool:
     # str is assumed to be isascii().
@@ -288,7 +294,7 @@ def tokenizer(input_text):
   # split the input text into a list of tokens at word boundaries and 
   # whitespaces then remove empty strings and strip off leading and 
   # trailing whitespaces
-  li = [s.strip() for s in re.split(r"\b|\s", input_text, re.ASCII) 
+  li = [s.strip() for s in re.split(r"\b|\s", input_text, flags=re.ASCII) 
                   if s.strip()]
   for s in li: # s is a string
     if not s.isascii():
@@ -340,6 +346,41 @@ def print_in_chunk(li, chunk_size=5): # li is any iterable
     print(s, end=" " if i % chunk_size != chunk_size-1 else "\n")
 #endregion token class helper
 
+#region iterative traversal
+# Formulas and proofs generated by programs can be nested far beyond 
+# Python's recursion limit. So the tree walkers use an explicit stack 
+# instead of recursion. The output of a node is given by a list of items,
+# where an item is either a string, which is output as it is, or a tree 
+# node, which is expanded in its place. The strings are collected in a 
+# list and joined only once at the end, or written to a stream one by one.
+def iter_items(root, expand, items=None):
+  """ Generate the strings of the output of root in order, where 
+      expand(node) returns the list of items of node. If items is given, 
+      it is used as the items of root instead of expand(root). """
+  stack = [root] if items is None else list(reversed(items))
+  while stack:
+    item = stack.pop()
+    if isinstance(item, str):
+      yield item
+    else:
+      stack.extend(reversed(expand(item)))
+
+def emit_items(root, expand, items=None) -> str:
+  """ Return the concatenation of the output of root. See iter_items(). """
+  return ''.join(iter_items(root, expand, items))
+#endregion iterative traversal
+
+def fresh_var(avoid, base: str = 'x') -> str:
+  """ A variable symbol not in avoid, with the letter of base if it is a
+      variable, like x_1, x_2, ... for base x or x_7. """
+  letter = base[0] if Token.is_var_str(base) else 'x'
+  if letter not in avoid:
+    return letter
+  k = 1
+  while f"{letter}_{k}" in avoid:
+    k += 1
+  return f"{letter}_{k}"
+
 #region Comment
 # <formula> ::= { <comp_fmla1> "imp" } <comp_fmla1> | 
 #                 <comp_fmla1> { ( "iff" | "xor") <comp_fmla1> }
@@ -363,6 +404,53 @@ def print_in_chunk(li, chunk_size=5): # li is any iterable
 # #   func_pre, const, numeral, var are defined in the Token class.
 #endregion
 
+class SymbolSets:
+  """ The free and bound variables and the constant, function and 
+      predicate symbols of a formula or a term, as frozensets of token 
+      values. Numerals count as constants, operators as function symbols,
+      and prop letters, infix predicates and '=' as predicate symbols.
+      See Node.symbol_sets(). """
+  __slots__ = ('free_vars', 'bound_vars', 'consts', 'funcs', 'preds')
+  EMPTY = frozenset()
+
+  def __init__(self, free_vars=EMPTY, bound_vars=EMPTY, consts=EMPTY,
+               funcs=EMPTY, preds=EMPTY):
+    self.free_vars = free_vars # type: frozenset
+    self.bound_vars = bound_vars # type: frozenset
+    self.consts = consts # type: frozenset
+    self.funcs = funcs # type: frozenset
+    self.preds = preds # type: frozenset
+
+  def __repr__(self):
+    return ("SymbolSets(" + ", ".join(f"{name}={sorted(getattr(self, name))}"
+                                       for name in self.__slots__) + ")")
+
+  @staticmethod
+  def union(sets_li: list) -> 'SymbolSets':
+    # Union of SymbolSets. If a member contains all the others, it is 
+    # returned as it is, so that equal sets are shared between nodes.
+    sets_li = list({id(ss): ss for ss in sets_li}.values())
+    if len(sets_li) == 1:
+      return sets_li[0]
+    fields = []
+    for name in SymbolSets.__slots__:
+      big = max((getattr(ss, name) for ss in sets_li), key=len)
+      for ss in sets_li:
+        if not getattr(ss, name) <= big:
+          big = big | getattr(ss, name)
+      fields.append(big)
+    for ss in sets_li:
+      if all(getattr(ss, name) is field 
+             for name, field in zip(SymbolSets.__slots__, fields)):
+        return ss
+    return SymbolSets(*fields)
+
+  @staticmethod
+  @functools.lru_cache(maxsize=None)
+  def leaf(field: str, value: str) -> 'SymbolSets':
+    # SymbolSets of a single symbol, shared by all its occurrences
+    return SymbolSets(**{field: frozenset([value])})
+
 class Node:
   from typing import List
 
@@ -408,6 +496,14 @@ class Node:
     # For user-defined tokens, use the static method ident2latex(opt).
     #endregion
 
+  # Unicode symbols for the text form, used where neither TeX nor MathJax
+  # is available (HTML proofs and SVG trees).
+  UNICODE_DICT = dict(
+      [("not", "¬"), ("and", "∧"), ("or", "∨"), ("imp", "→"), 
+      ("iff", "↔"), ("xor", "⊕"), ("nin", "∉"), ("bot", "⊥"), 
+      ("top", "⊤"), ("emptyset", "∅"), ("<=", "≤"), (">=", "≥"), 
+      ("forall", "∀"), ("exists", "∃")])
+
   @staticmethod
   def token2latex(token: Token, opt: str='latex') -> str:
     # for oper_*, pred_in (declared in Token class)
@@ -463,230 +559,232 @@ class Node:
       return label
 
   @staticmethod
-  def display_latex_li(str_li: List[str]) -> None:
-    from IPython.display import display, Math
+  def latex_li_str(str_li: List[str]) -> str:
+    # LaTeX of the list of formulas str_li, shown by display_latex_li()
     node_li = [parse_ast(s) for s in str_li]
     latex_str_li = [node.build_infix('latex') for node in node_li]
     latex_str = ',\\: '.join(latex_str_li)
-    display(Math('$[\\,' + latex_str + '\\,]$'))
+    return '$[\\,' + latex_str + '\\,]$'
+
+  @staticmethod
+  def display_latex_li(str_li: List[str]) -> None:
+    from IPython.display import display, Math
+    display(Math(Node.latex_li_str(str_li)))
+
+  def iter_preorder(self):
+    stack = [self]
+    while stack:
+      node = stack.pop()
+      yield node
+      stack.extend(reversed(node.children))
+
+  def iter_postorder(self):
+    stack = [(self, False)]
+    while stack:
+      node, visited = stack.pop()
+      if visited:
+        yield node
+      else:
+        stack.append((node, True))
+        stack.extend([(kid, False) for kid in reversed(node.children)])
 
   def build_polish_notation(self, verbose=False) -> str:
-    ret_str = f"{self.token}" if verbose else f"{self.token.value}"
-    if self.children:
-      ret_str += ' '
-      ret_str += ' '.join(child.build_polish_notation(verbose) 
-                        for child in self.children)
-    return ret_str
+    if verbose:
+      return ' '.join([f"{node.token}" for node in self.iter_preorder()])
+    else:
+      return ' '.join([node.token.value for node in self.iter_preorder()])
   
   def build_RPN(self, verbose=False) -> str:
-    ret_str = ''
-    if self.children:
-      ret_str += ' '.join(child.build_RPN(verbose) 
-                          for child in self.children) + ' '
-      
-    ret_str += f"{self.token}" if verbose else f"{self.token.value}"
-    
-    return ret_str
+    if verbose:
+      return ' '.join([f"{node.token}" for node in self.iter_postorder()])
+    else:
+      return ' '.join([node.token.value for node in self.iter_postorder()])
+
+  @staticmethod
+  def paren_items(node, b_paren: bool) -> list:
+    return ['(', node, ')'] if b_paren else [node]
+
+  @staticmethod
+  def comma_items(nodes) -> list:
+    # [kid1, ', ', kid2, ', ', ..]
+    items = []
+    for i, kid in enumerate(nodes):
+      if i:
+        items.append(', ')
+      items.append(kid)
+    return items
 
   def build_infix(self, opt: str='latex') -> str:
+    return emit_items(self, lambda node: node.infix_items(opt))
+
+  def infix_items(self, opt: str) -> list:
     if self.type == 'term':
-      return self.build_infix_term(opt)
+      return self.infix_term_items(opt)
     else: # self.type == 'formula'
-      return self.build_infix_formula(opt)
-            
+      return self.infix_formula_items(opt)
+
   def build_infix_term(self, opt: str) -> str:
-    LATEX_DICT = self.LATEX_DICT
-    if not self.children: # leaf node ::= variable | const | numeral
-      return self.ident2latex(self.token, opt)
-    else: # non-leaf node
-      # token_type ::= func_pre | oper_in_1 | oper_in_2 | oper_in_3 |
-      #                oper_pre | oper_post 
-      ret_str = ''
-      if self.token.token_type == 'func_pre':
-        label = self.ident2latex(self.token, opt)
-        args = ', '.join(kid.build_infix(opt) for kid in self.children)
-        ret_str += label + '(' + args + ')'
-      else: # token is an operator with various arities and precedences
-        if self.token.precedence == 1: 
-          # oper_pre(unary) or oper_in_1(binary, +, -, cap, cup, oplus)
-          if self.token.token_type == 'oper_pre':
-            kid1 = self.children[0]
-            kid1_str = kid1.build_infix(opt)
-            if kid1.token.precedence == 1:
-              kid1_str = '(' + kid1_str + ')'
-            # else pass
-            ret_str += self.token2latex(self.token, opt) + kid1_str
-          else: # oper_in_1
-            kid1, kid2 = self.children
-            kid1_str = kid1.build_infix(opt)
-            kid2_str = kid2.build_infix(opt)
-            if ((self.token.value in Token.OPER_PRE and kid2.token.precedence == 1) or
-                kid2.token.token_type == 'oper_pre'):
-              kid2_str = '(' + kid2_str + ')'
-            # else pass
-            ret_str += kid1_str + ' ' + self.token2latex(self.token, opt) + ' ' + kid2_str
-        elif self.token.precedence == 2: # oper_in_2(binary, *, /, %, ...)
-          kid1, kid2 = self.children
-          kid1_str = kid1.build_infix(opt)
-          kid2_str = kid2.build_infix(opt)
-          # determine if parentheses are needed
-          if (kid2.token.precedence < self.token.precedence or
-              # '/', '%', 'div' are non-associative
-              (kid2.token.precedence == self.token.precedence and 
-               self.token.value in Token.OPER_IN_2N)): 
-            kid2_str = '(' + kid2_str + ')'
-          if kid1.token.precedence < self.token.precedence:
-            kid1_str = '(' + kid1_str + ')'
-          ret_str += kid1_str + ' ' + self.token2latex(self.token, opt) + \
-                     ' ' + kid2_str
-        elif self.token.precedence == 3: # oper_in_3(binary, ^ exponentiation)
-          kid1, kid2 = self.children
-          kid1_str = kid1.build_infix(opt)
-          kid2_str = kid2.build_infix(opt)
-          # determine if parentheses are needed
-          if kid1.token.precedence <= 4:
-            # '^' is right-associative, and we want parentheses in (a')^2
-            kid1_str = '(' + kid1_str + ')'
-          if kid2.token.precedence < self.token.precedence:
-            pass # In a^(b+c), we don't need parentheses around b+c
-                 # when it is LaTeXed. 
-          ret_str += kid1_str + '^' + '{' + kid2_str + '}'
-        else: # precedence = 4. Must be of type OPER_POST.
-          kid1 = self.children[0]
-          kid1_str = kid1.build_infix(opt)
-          if kid1.token.precedence <= self.token.precedence: 
-            # true unless kid1 is an atomic term
-            kid1_str = '(' + kid1_str + ')'
-          ret_str += kid1_str + self.token2latex(self.token, opt)
-      return ret_str
+    return emit_items(self, lambda node: node.infix_items(opt),
+                      self.infix_term_items(opt))
 
   def build_infix_formula(self, opt: str='text') -> str:  
+    return emit_items(self, lambda node: node.infix_items(opt),
+                      self.infix_formula_items(opt))
+
+  def infix_term_items(self, opt: str) -> list:
+    paren_items = self.paren_items
+    token = self.token
+    if not self.children: # leaf node ::= variable | const | numeral
+      return [self.ident2latex(token, opt)]
+    # non-leaf node
+    # token_type ::= func_pre | oper_in_1 | oper_in_2 | oper_in_3 |
+    #                oper_pre | oper_post 
+    if token.token_type == 'func_pre':
+      label = self.ident2latex(token, opt)
+      return [label, '('] + self.comma_items(self.children) + [')']
+    # token is an operator with various arities and precedences
+    token_str = self.token2latex(token, opt)
+    if token.precedence == 1: 
+      # oper_pre(unary) or oper_in_1(binary, +, -, cap, cup, oplus)
+      if token.token_type == 'oper_pre':
+        kid1 = self.children[0]
+        return [token_str] + paren_items(kid1, kid1.token.precedence == 1)
+      else: # oper_in_1
+        kid1, kid2 = self.children
+        b_paren2 = ((token.value in Token.OPER_PRE and 
+                     kid2.token.precedence == 1) or
+                    kid2.token.token_type == 'oper_pre')
+        return [kid1, ' ' + token_str + ' '] + paren_items(kid2, b_paren2)
+    elif token.precedence == 2: # oper_in_2(binary, *, /, %, ...)
+      kid1, kid2 = self.children
+      # determine if parentheses are needed
+      b_paren2 = (kid2.token.precedence < token.precedence or
+                  # '/', '%', 'div' are non-associative
+                  (kid2.token.precedence == token.precedence and 
+                   token.value in Token.OPER_IN_2N))
+      b_paren1 = kid1.token.precedence < token.precedence
+      return (paren_items(kid1, b_paren1) + [' ' + token_str + ' '] + 
+              paren_items(kid2, b_paren2))
+    elif token.precedence == 3: # oper_in_3(binary, ^ exponentiation)
+      kid1, kid2 = self.children
+      # '^' is right-associative, and we want parentheses in (a')^2.
+      # In a^(b+c), we don't need parentheses around b+c when it is 
+      # LaTeXed. 
+      return (paren_items(kid1, kid1.token.precedence <= 4) + 
+              ['^{', kid2, '}'])
+    else: # precedence = 4. Must be of type OPER_POST.
+      kid1 = self.children[0]
+      # true unless kid1 is an atomic term
+      b_paren1 = kid1.token.precedence <= token.precedence
+      return paren_items(kid1, b_paren1) + [token_str]
+
+  def infix_formula_items(self, opt: str='text') -> list:
     LATEX_DICT = self.LATEX_DICT
+    paren_items = self.paren_items
+    token = self.token
 
     # 1. atomic formulas and bot, top
     if not self.children: # 'prop_letter' or 'conn_0ary'
       # 1.1 terminal nodes
-      if self.token.token_type == 'prop_letter':
-        return self.ident2latex(self.token, opt)
-      else: # self.token.value must be 'bot' or 'top'
-        return (LATEX_DICT[self.token.value] if opt=='latex' 
-                else self.token.value)
-    elif self.token.token_type in Token.FMLA_TOKENS: 
+      if token.token_type == 'prop_letter':
+        return [self.ident2latex(token, opt)]
+      else: # token.value must be 'bot' or 'top'
+        return [LATEX_DICT[token.value] if opt=='latex' else token.value]
+    elif token.token_type in Token.FMLA_TOKENS: 
       # 'pred_pre', 'pred_in', 'equality'
       # 1.2 internal nodes
-      if self.token.token_type == 'pred_pre': # prefix predicate
-        label = self.ident2latex(self.token, opt)
-        args = ', '.join(kid.build_infix(opt) for kid in self.children)
-        return label + '(' + args + ')'
+      if token.token_type == 'pred_pre': # prefix predicate
+        label = self.ident2latex(token, opt)
+        return [label, '('] + self.comma_items(self.children) + [')']
       else: # 'pred_in' or 'equality' # infix predicate
         kid1, kid2 = self.children
-        kid1_str = kid1.build_infix(opt)
-        kid2_str = kid2.build_infix(opt)
-        return (kid1_str + ' ' + self.token2latex(self.token, opt) + 
-                ' ' + kid2_str)
+        return [kid1, ' ' + self.token2latex(token, opt) + ' ', kid2]
     # 2. compound formulas except bot and top -- i.e., connectives 
     #    and quantifiers
-    else: 
-      ret_str = ''
-      if self.token.arity == 2:
-        # 2.1 binary connectives
-        token_str = (' ' + LATEX_DICT[self.token.value] + ' '
-                     if opt=='latex' else f" {self.token.value} ")
-        kid1, kid2 = self.children
-        kid1_str = kid1.build_infix(opt)
-        kid2_str = kid2.build_infix(opt)
-        if self.token.token_type == 'conn_arrow': # 'imp', 'iff', 'xor'
-          # determine whether we need parentheses around kid1
-          if kid1.token.token_type == 'conn_arrow':
-            if self.token.value != kid1.token.value:
-              kid1_str = f"({kid1_str})"
-            else:
-              if self.token.value == "imp":
-                kid1_str = f"({kid1_str})"
-              else:
-                pass # iff and xor are associative
-          # determine whether we need parentheses around kid2
-          if kid2.token.token_type == 'conn_arrow':
-            if self.token.value != kid2.token.value:
-              kid2_str = f"({kid2_str})"
-            else:
-              pass # even 'imp' is right-associative
-        else: # 'and', 'or' (precedence == 2)
-          # determine whether we need parentheses around kid1
-          if kid1.token.token_type == 'conn_arrow':
-            kid1_str = f"({kid1_str})"
-          elif (kid1.token.token_type == 'conn_2ary' and 
-                self.token.value != kid1.token.value):
-            kid1_str = f"({kid1_str})"
-          # determine whether we need parentheses around kid2
-          if kid2.token.token_type == 'conn_arrow':
-            kid2_str = f"({kid2_str})"
-          elif (kid2.token.token_type == 'conn_2ary' and
-                self.token.value != kid2.token.value):
-              kid2_str = f"({kid2_str})"
-          # x < y = z case
-          if self.token.value == 'and':
-            if (v_str := self.seq_infix(opt)):
-              return v_str 
-            else:
-              pass
-        ret_str += kid1_str + token_str + kid2_str
-      elif self.token.token_type == 'conn_1ary': 
-        # 2.2 unary connectives (actually, negation only)
-        token_str = (LATEX_DICT[self.token.value] + r'\, ' if opt=='latex'
-                     else self.token.value + ' ')
-        kid1 = self.children[0]
-        kid1_str = kid1.build_infix(opt)
-        # determine whether we need parentheses around kid1
-        if kid1.token.token_type in ('conn_2ary', 'conn_arrow', 'pred_in', 'equality'):
-          kid1_str = f"({kid1_str})"
-        ret_str += token_str + kid1_str
-      else:
-         # 2.3 quantifier
-        token_str = (LATEX_DICT[self.token.value] if opt=='latex'
-                     else self.token.value) + ' '
-        kid1 = self.children[0] # a variable for determiner
-        kid1_str = self.ident2latex(kid1.token, opt)
-        kid11 = kid1.children[0]
-        kid11_str = kid11.build_infix(opt)
-        # determine whether we need parentheses around kid11
-        if kid11.token.token_type in ('pred_in', 'equality'):
-          kid11_str = f"({kid11_str})"
-        ret_str += (token_str + kid1_str + (r"\, " if opt=='latex' else " ") + 
-                    kid11_str)
-      return ret_str  
+    elif token.arity == 2:
+      # 2.1 binary connectives
+      token_str = (' ' + LATEX_DICT[token.value] + ' '
+                   if opt=='latex' else f" {token.value} ")
+      kid1, kid2 = self.children
+      type1, type2 = kid1.token.token_type, kid2.token.token_type
+      if token.token_type == 'conn_arrow': # 'imp', 'iff', 'xor'
+        # iff and xor are associative, and even 'imp' is right-associative
+        b_paren1 = (type1 == 'conn_arrow' and 
+                    (token.value != kid1.token.value or token.value == 'imp'))
+        b_paren2 = type2 == 'conn_arrow' and token.value != kid2.token.value
+      else: # 'and', 'or' (precedence == 2)
+        b_paren1 = (type1 == 'conn_arrow' or 
+                    (type1 == 'conn_2ary' and token.value != kid1.token.value))
+        b_paren2 = (type2 == 'conn_arrow' or
+                    (type2 == 'conn_2ary' and token.value != kid2.token.value))
+        # x < y = z case
+        if token.value == 'and' and (items := self.seq_items(opt)):
+          return items
+      return paren_items(kid1, b_paren1) + [token_str] + \
+             paren_items(kid2, b_paren2)
+    elif token.token_type == 'conn_1ary': 
+      # 2.2 unary connectives (actually, negation only)
+      token_str = (LATEX_DICT[token.value] + r'\, ' if opt=='latex'
+                   else token.value + ' ')
+      kid1 = self.children[0]
+      b_paren1 = kid1.token.token_type in ('conn_2ary', 'conn_arrow', 
+                                           'pred_in', 'equality')
+      return [token_str] + paren_items(kid1, b_paren1)
+    else:
+      # 2.3 quantifier
+      token_str = (LATEX_DICT[token.value] if opt=='latex'
+                   else token.value) + ' '
+      kid1 = self.children[0] # a variable for determiner
+      kid1_str = self.ident2latex(kid1.token, opt)
+      kid11 = kid1.children[0]
+      # the scope of a quantifier is a comp_fmla2, see the grammar above
+      b_paren11 = kid11.token.token_type in ('pred_in', 'equality', 
+                                             'conn_2ary', 'conn_arrow')
+      return ([token_str + kid1_str + (r"\, " if opt=='latex' else " ")] + 
+              paren_items(kid11, b_paren11))
 
   def seq_infix(self, opt) -> str:
     # sequence of terms connected by infix operators: i.e., x < y = z, which
     #   is parsed as x < y and y = z.
     # This method is called iff self.token.value == 'and'.
-    kid1, kid2 = self.children
-    if kid2.token.token_type in ('pred_in', 'equality'):
+    items = self.seq_items(opt)
+    return emit_items(self, lambda node: node.infix_items(opt), items) \
+           if items else ''
+
+  def seq_items(self, opt) -> list:
+    # Items of seq_infix(). Return [] if self is not such a sequence.
+    # x < y = z < w is parsed as ((x < y and y = z) and z < w), so we 
+    # walk down the left spine collecting the right kids.
+    tails = [] # right kids from the top to the bottom
+    node = self
+    while True:
+      kid1, kid2 = node.children
+      if kid2.token.token_type not in ('pred_in', 'equality'):
+        return []
+      tails.append(kid2)
       if kid1.token.token_type in ('pred_in', 'equality'):
-        if kid1.children[1] == kid2.children[0]:
-          kid1_str = kid1.build_infix(opt)
-          kid2_token_str = kid2.token2latex(kid2.token, opt)
-          kid22_str = kid2.children[1].build_infix(opt)
-          return ' '.join([kid1_str, kid2_token_str, kid22_str])
-        else:
-          return ''
+        if kid1.children[1] != kid2.children[0]:
+          return []
+        break
       elif kid1.token.value == 'and':
-        if (kid1.children[1].children[1] == kid2.children[0] and
-            (kid1_str := kid1.seq_infix(opt))):
-          kid2_token_str = kid2.token2latex(kid2.token, opt)
-          kid22_str = kid2.children[1].build_infix(opt)
-          return ' '.join([kid1_str, kid2_token_str, kid22_str])
-        else:
-          return ''
+        kid12 = kid1.children[1]
+        if kid12.token.token_type not in ('pred_in', 'equality') or \
+           kid12.children[1] != kid2.children[0]:
+          return []
+        node = kid1
       else:
-        return ''
-    else:
-      return ''
+        return []
+    items = [kid1]
+    for kid2 in reversed(tails):
+      items += [' ' + kid2.token2latex(kid2.token, opt) + ' ', 
+                kid2.children[1]]
+    return items
 
   def display_infix(self, opt: str='latex'):
-    from IPython.display import display, Math
+    # build_infix(opt) is the headless version
     s = self.build_infix(opt)
     if opt == 'latex':
+      from IPython.display import display, Math
       display(Math(f"${s}$")) 
     else:
       print(s)
@@ -706,12 +804,16 @@ class Node:
     return r"\begin{prooftree}" + "\n" + the_str + r"\end{prooftree}" + "\n"
 
   def build_bussproof_rec(self):
+    return emit_items(self, Node.bussproof_items)
+
+  def bussproof_items(self) -> list:
+    # The lines of the kids come first, followed by the line of self.
     LATEX_DICT = self.LATEX_DICT
 
     if self.type == 'term':
       # terminal node. use \AxiomC{..}
       label = self.build_infix_term('latex')
-      the_str = r"\AxiomC" + r"{$" + label + "$}\n"
+      return [r"\AxiomC" + r"{$" + label + "$}\n"]
     # self.type == 'formula'
     elif not self.children: 
       # terminal node. use \AxiomC{..}
@@ -719,7 +821,7 @@ class Node:
         label = self.ident2latex(self.token)
       else: # self.token.value must be 'bot' or 'top'
         label = LATEX_DICT[self.token.value]
-      the_str = r"\AxiomC" + r"{$" + label + "$}\n"
+      return [r"\AxiomC" + r"{$" + label + "$}\n"]
     else: # pred_pre, pred_in, equality, 
           # conn_1ary, conn_2ary, conn_arrow, quantifier
       label = (self.ident2latex(self.token) 
@@ -729,34 +831,35 @@ class Node:
       if arity == 1: # not, forall, exists, unary predicate
         if self.token.token_type in ('conn_1ary', 'pred_pre'):
           kid1 = self.children[0]
-          kid1_str = kid1.build_bussproof_rec()
-          the_str = kid1_str + r"\UnaryInfC" + r"{$" + label + "$}\n"
+          return [kid1, r"\UnaryInfC" + r"{$" + label + "$}\n"]
         else: # quantifier
           kid1 = self.children[0] # a variable for determiner
           kid1_str = self.ident2latex(kid1.token)
           kid11 = kid1.children[0]
-          kid11_str = kid11.build_bussproof_rec()
-          the_str = (kid11_str + r"\UnaryInfC" + r"{$" + label + ' ' +
-                     kid1_str + "$}\n")
+          return [kid11, r"\UnaryInfC" + r"{$" + label + ' ' +
+                         kid1_str + "$}\n"]
       elif arity == 2:
         kid1, kid2 = self.children
-        kid1_str = kid1.build_bussproof_rec()
-        kid2_str = kid2.build_bussproof_rec()
-        the_str = (kid1_str + kid2_str + r"\BinaryInfC" + r"{$" +
-                    label + "$}\n")
+        return [kid1, kid2, r"\BinaryInfC" + r"{$" + label + "$}\n"]
       elif arity == 3:
         kid1, kid2, kid3 = self.children
-        kid1_str = kid1.build_bussproof_rec()
-        kid2_str = kid2.build_bussproof_rec()
-        kid3_str = kid3.build_bussproof_rec()
-        the_str = (kid1_str + kid2_str + kid3_str + r"\TrinaryInfC" + r"{$" +
-                    label + "$}\n")
+        return [kid1, kid2, kid3, 
+                r"\TrinaryInfC" + r"{$" + label + "$}\n"]
       else:
         raise ValueError(f"arity of predicate symbol cannot be {arity}")
 
-    return the_str
-
-  def draw_tree(self, verbose=False):
+  def draw_tree(self, verbose=False, cache=True):
+    """ Draw self as a bussproof style tree with matplotlib. Unless 
+        verbose, the image is shown from the render cache, which draws
+        each formula only once (see render_cache.py). """
+    if cache and not verbose:
+      try:
+        from modules.render_cache import show_ast
+      except ImportError:
+        pass
+      else:
+        show_ast(self)
+        return
     try:
       from modules.draw_tree import draw_ast
     except ImportError: 
@@ -767,7 +870,142 @@ class Node:
         from draw_tree1 import draw_ast 
     draw_ast(self, verbose)
 
+  #region variables and symbols
+  def symbol_sets(self) -> SymbolSets:
+    """ The SymbolSets of self, computed bottom-up once per node and 
+        cached on the node, so that scope checks are set operations.
+        The cache of a node is dropped when its children list is replaced,
+        as the in-place methods do, and a copy made by copy_label() 
+        computes its own. Nodes are not to be changed in place otherwise,
+        see the copy-on-write methods below. """
+    cache = getattr(self, 'sym_cache', None)
+    if cache is not None and cache[0] is self.children:
+      return cache[1]
+    # post-order walk over the nodes without a valid cache
+    stack = [(self, False)]
+    while stack:
+      node, b_kids_done = stack.pop()
+      cache = getattr(node, 'sym_cache', None)
+      if cache is not None and cache[0] is node.children:
+        continue
+      if not b_kids_done:
+        stack.append((node, True))
+        stack.extend((kid, False) for kid in node.children)
+        continue
+      node.sym_cache = (node.children, node.own_symbol_sets())
+    return self.sym_cache[1]
+
+  def own_symbol_sets(self) -> SymbolSets:
+    # SymbolSets of self from those of its children, already computed.
+    token = self.token
+    value, token_type = token.value, token.token_type
+    kid_sets = [kid.sym_cache[1] for kid in self.children]
+    if token_type == 'var_determiner': # binds value in its scope
+      scope = kid_sets[0]
+      if value not in scope.free_vars and value in scope.bound_vars:
+        return scope
+      return SymbolSets(scope.free_vars - {value}, 
+                        scope.bound_vars | {value}, scope.consts, 
+                        scope.funcs, scope.preds)
+    elif token_type == 'var':
+      own = SymbolSets.leaf('free_vars', value)
+    elif token_type in ('const', 'numeral'):
+      own = SymbolSets.leaf('consts', value)
+    elif token_type == 'func_pre' or token_type.startswith('oper_'):
+      own = SymbolSets.leaf('funcs', value)
+    elif token_type in ('pred_pre', 'pred_in', 'equality', 'prop_letter'):
+      own = SymbolSets.leaf('preds', value)
+    elif kid_sets: # connectives and quantifiers
+      return SymbolSets.union(kid_sets)
+    else: # bot, top
+      return SymbolSets()
+    return SymbolSets.union([own] + kid_sets)
+
+  def free_vars(self) -> frozenset:
+    return self.symbol_sets().free_vars
+
+  def bound_vars(self) -> frozenset:
+    return self.symbol_sets().bound_vars
+
+  def consts(self) -> frozenset:
+    return self.symbol_sets().consts
+
+  def funcs(self) -> frozenset:
+    return self.symbol_sets().funcs
+
+  def preds(self) -> frozenset:
+    return self.symbol_sets().preds
+
+  def is_sentence(self) -> bool:
+    """ True iff self is a formula without free variables. """
+    return self.type == 'formula' and not self.free_vars()
+
+  def alpha_key(self) -> tuple:
+    """ A hashable key of self up to renaming of bound variables, so that
+        forall x P1(x) and forall y P1(y) have the same key. It lists
+        (token_type, value, number of children) of the nodes in pre-order,
+        where an occurrence of a bound variable has the de Bruijn index
+        as its value, i.e., the number of binders between it and its own
+        binder, and a var_determiner has no value. Free variables keep
+        their names. The key is cached on self like symbol_sets(). """
+    cache = getattr(self, 'alpha_cache', None)
+    if cache is not None and cache[0] is self.children:
+      return cache[1]
+    items = []
+    binders = {} # var -> depths of the binders of var in scope
+    depth = 0 # number of binders in scope
+    stack = [self] # nodes, and the vars whose scope ends there
+    while stack:
+      node = stack.pop()
+      if isinstance(node, str): # end of the scope of the binder of node
+        binders[node].pop()
+        depth -= 1
+        continue
+      token = node.token
+      if token.token_type == 'var_determiner':
+        depth += 1
+        binders.setdefault(token.value, []).append(depth)
+        stack.append(token.value)
+        items += ('var_determiner', '', 1)
+      elif token.token_type == 'var' and binders.get(token.value):
+        items += ('var', depth - binders[token.value][-1], 0)
+      else:
+        items += (token.token_type, token.value, len(node.children))
+      stack.extend(reversed(node.children))
+    self.alpha_cache = (self.children, tuple(items))
+    return self.alpha_cache[1]
+  #endregion variables and symbols
+
   #region syntactic manipulations
+  def copy_label(self):
+    """ New node with the same attributes as self, its own copy of the
+        token, and no children yet. """
+    cls = self.__class__
+    new_node = cls.__new__(cls)
+    new_node.__dict__.update(self.__dict__)
+    token = self.token
+    new_node.token = token.__class__.__new__(token.__class__)
+    new_node.token.__dict__.update(token.__dict__)
+    new_node.children = []
+    return new_node
+
+  def clone(self):
+    """ Deep copy of self like copy.deepcopy(self), but without 
+        recursion. Every attribute is copied as it is, except that each 
+        node gets its own token and children list. """
+    root = self.copy_label()
+    memo = {id(self): root} # shared subtrees stay shared as in deepcopy
+    stack = [(self, root)]
+    while stack:
+      node, new_node = stack.pop()
+      for kid in node.children:
+        new_kid = memo.get(id(kid))
+        if new_kid is None:
+          new_kid = memo[id(kid)] = kid.copy_label()
+          stack.append((kid, new_kid))
+        new_node.children.append(new_kid)
+    return root
+
   def node_at(self, pos: List[int]):
     # The return value may be a term or a formula.
     if pos == []:
@@ -778,6 +1016,20 @@ class Node:
         ast = ast.children[i]
       return ast
     
+  def shallow_copy(self):
+    """ New node with the label of self (see copy_label()) sharing the 
+        children of self. """
+    new_node = self.copy_label()
+    new_node.children = list(self.children)
+    return new_node
+
+  # The methods below are copy-on-write. Only the nodes on the path from
+  # the root to a changed position are copied, and every untouched 
+  # subtree, as well as new_node itself, is shared by the old and the new
+  # tree. So the trees must be treated as immutable, except for the 
+  # in-place versions (dupl == ''), which only ever change the children
+  # list of the node they are called on. The root returned with 'dupl' 
+  # is always a new node.
   def replace_node_at(self, pos: List[int], new_node, 
                       dupl: str = ''):
     # Make sure to replace subformula by a formula and
@@ -786,55 +1038,136 @@ class Node:
     # and return None.  In the 2nd case, we create a new node by 
     # the replacement and return the new node.
     # pos must be nonempty.
-    import copy
-
     assert isinstance(new_node, Node), \
       "Node.replace_node_at(): new_node must be a Node object"
     # I had to type check in this way. 
     # type hinting "new_node: Node" does not work.
 
-    node0 = self if dupl == '' else copy.deepcopy(self)
-    node = node0
+    root = self.shallow_copy()
+    node = root
     for i in pos[:-1]:
       assert len(node.children) > i, \
         "Node.replace_node_at(): pos is out of range"
-      node = node.children[i]
-    node.children[pos[-1]] = copy.deepcopy(new_node)
+      node.children[i] = node = node.children[i].shallow_copy()
+    node.children[pos[-1]] = new_node
     if dupl == 'dupl':
-      return node0
+      return root
+    self.children = root.children
 
   def replace_nodes_at(self, pos_li: List[List[int]],
                       new_node_li, dupl: str=''):
     # This method is a multiple version of replace_node_at().
     # Members of pos_li must be incomparable.
-    import copy
-
     assert len(pos_li) == len(new_node_li)
-    if dupl != 'dupl':
-      for i in range(len(pos_li)):
-        self.replace_node_at(pos_li[i], new_node_li[i])
-    else: 
-      node0 = copy.deepcopy(self)
-      for i in range(len(pos_li)):
-        node0.replace_node_at(pos_li[i], new_node_li[i])
+    node0 = self.shallow_copy() if dupl == 'dupl' else self
+    for i in range(len(pos_li)):
+      node0.replace_node_at(pos_li[i], new_node_li[i])
+    if dupl == 'dupl':
       return node0  
 
   def substitute(self, var: str, new_node, dupl: str = ''):
     # Input argument var is a string, which can be either an individual 
     # variable/constant or a propositional variable.
-    # There is no difference in the code for handling these two cases.
-    import copy
-
-    node = copy.deepcopy(self) if dupl == 'dupl' else self
-    if node.token.value == var:
-      node = copy.deepcopy(new_node)
-    elif node.children:
+    # If dupl == 'dupl', return a new node with every node labeled var
+    # replaced by new_node. Otherwise, do the same to the children of 
+    # self in place and return None.
+    # An individual variable is replaced only where it occurs free, and
+    # bound variables are renamed where new_node would be captured. 
+    # See subst_free().
+    if Token.is_var_str(var):
+      root = self.subst_free({var: new_node})
+      if dupl == 'dupl':
+        return root
+      self.token, self.children = root.token, root.children
+      return
+    if dupl == 'dupl' and self.token.value == var:
+      return new_node.shallow_copy()
+    # Post-order walk. new_kids[id(node)] is the new children list of a
+    # node below which var occurs. The other nodes are shared.
+    new_kids = {}
+    seen = set()
+    stack = [(self, False)]
+    while stack:
+      node, b_kids_done = stack.pop()
+      if not b_kids_done:
+        if id(node) not in seen:
+          seen.add(id(node))
+          stack.append((node, True))
+          stack.extend((kid, False) for kid in node.children 
+                       if kid.children and kid.token.value != var)
+        continue
+      kids = None
       for i, kid in enumerate(node.children):
-        # note that dupl=='dupl' is passed to the recursive call
-        node.children[i] = kid.substitute(var, new_node, 'dupl')
-    
+        if kid.token.value == var:
+          new_kid = new_node
+        elif id(kid) in new_kids:
+          new_kid = kid.copy_label()
+          new_kid.children = new_kids[id(kid)]
+        else:
+          continue
+        if kids is None:
+          kids = list(node.children)
+        kids[i] = new_kid
+      if kids is not None:
+        new_kids[id(node)] = kids
+
+    kids = new_kids.get(id(self))
     if dupl == 'dupl':
-      return node
+      root = self.shallow_copy()
+      if kids is not None:
+        root.children = kids
+      return root
+    elif kids is not None: # self keeps its own label
+      self.children = kids
+
+  def subst_free(self, mapping: dict):
+    """ Capture-avoiding simultaneous substitution: the free occurrences
+        of each variable in mapping are replaced by its term (a Node).
+        A quantified variable is renamed by fresh_var() only when one of
+        the terms substituted in its scope has it free. Subtrees in which
+        no variable of mapping is free are shared, found by the cached 
+        free_vars() without scanning them. The root is always new. """
+    # Pre-order pass: frames[i] = [node, sigma, renamed, kid frames],
+    # where sigma is mapping restricted to the free variables of node.
+    frames = []
+    stack = [(self, mapping, -1)]
+    while stack:
+      node, sigma, parent = stack.pop()
+      free_vars = node.free_vars()
+      sigma = {v: t for v, t in sigma.items() if v in free_vars}
+      frame = [node, sigma, None, []]
+      if parent >= 0:
+        frames[parent][3].append(len(frames))
+      frames.append(frame)
+      if not sigma or not node.children: # shared, or a variable replaced
+        continue
+      if node.token.token_type == 'var_determiner':
+        var = node.token.value
+        if any(var in t.free_vars() for t in sigma.values()):
+          scope = node.children[0]
+          avoid = free_vars.union(scope.bound_vars(), 
+                                  *[t.free_vars() for t in sigma.values()])
+          frame[2] = fresh_var(avoid, var)
+          sigma[var] = Node(Token(frame[2]))
+      stack.extend((kid, sigma, len(frames) - 1) 
+                   for kid in reversed(node.children))
+    # Post-order pass: build the new nodes from the bottom up.
+    results = [None] * len(frames)
+    for i in reversed(range(len(frames))):
+      node, sigma, renamed, kids = frames[i]
+      if not sigma:
+        results[i] = node
+      elif not node.children:
+        results[i] = sigma[node.token.value]
+      else:
+        new_node = node.copy_label()
+        if renamed is not None:
+          new_node.token.value = renamed
+        new_node.children = [results[k] for k in kids]
+        results[i] = new_node
+    # results[0] is new unless self is unchanged or replaced by a term
+    b_new = frames[0][1] and self.children
+    return results[0] if b_new else results[0].shallow_copy()
 
   #endregion syntactic manipulations
 
@@ -1145,19 +1478,22 @@ def parse_ast(input_text=''):
       f"\tat {parser.index}, while end of input expected.")
   return ast
 
-def show_formula(input_text: str='', node: Node=None):
+def formula_latex(input_text: str='', node: Node=None) -> str:
+  """ The math-mode LaTeX shown by show_formula(). Parse errors are 
+      raised. """
   if not isinstance(input_text, str):
     node = input_text
-  if node is not None:
-    ast = node
-  else:
-    try:
-      ast = parse_ast(input_text)
-    except ValueError as e:
-      print(e)
-    
-  s = ast.build_infix('latex') # type: ignore
+  ast = node if node is not None else parse_ast(input_text)
+  s = ast.build_infix('latex')
   # Empty formula is parsed as 'top', and we don't want to display it.
   s = r'\,' if s == r'\top' else s
+  return f"${s}$"
+
+def show_formula(input_text: str='', node: Node=None):
+  try:
+    s = formula_latex(input_text, node)
+  except ValueError as e:
+    print(e)
+    return
   from IPython.display import display, Math
-  display(Math(f"${s}$"))
+  display(Math(s))
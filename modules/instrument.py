@@ -0,0 +1,265 @@
+# Instrumentation of the hot paths: parsing, validation, proof search and
+# proof edits.
+#
+# Usage:
+#   with Profile() as prof:
+#     proof = ProofNodeS(parse_fitch(proof_str))
+#     proof.run_search()
+#   print(prof.summary())                  # calls and times by span
+#   prof.write_chrome_trace('trace.json')  # for chrome://tracing, Perfetto
+#   print(prof.prometheus())               # Prometheus text format
+# or from the shell, for a proof in a file:
+#   python -m modules.instrument proof.txt --search --trace trace.json
+#
+# Each call of a hooked function (see HOOKS) is a span, named after the
+# function, or after the function and the rule for the rule checks, e.g.
+# 'try_rule:and intro'. For a span which returns a bool, the results are
+# counted too, e.g. how often a rule was tried and failed in the search.
+# The hits and misses of verify_cache during the profile are counted.
+#
+# The hooked functions are wrapped only while a Profile is active: the
+# wrappers are put in when the first Profile starts and the originals are
+# put back when the last one stops, so profiling costs nothing when it is
+# off. A module-level function is replaced in every module which has it,
+# since the modules import each other with *. A function referenced
+# elsewhere before the Profile starts, e.g. by a bound method, is not
+# hooked.
+
+import os, sys, json, time, functools, threading
+from typing import Dict, List, Tuple
+
+from modules.search_prop import *
+
+def by_rule(name: str, pos: int, key: str):
+  """ Span name function of a method whose argument pos (counting self),
+      or keyword argument key, is a RuleInfer. """
+  def span_name(args, kwargs) -> str:
+    rule = args[pos] if len(args) > pos else kwargs[key]
+    return f"{name}:{rule.value}"
+  return span_name
+
+def edit_methods() -> List[str]:
+  return [name for name, method in vars(ProofNodeS).items()
+          if getattr(method, 'undoable', False)] + \
+         ['undo', 'redo', 'apply_ops', 'revalidate', 'render_delta']
+
+# (module, attribute, span name or a function of (args, kwargs) giving it)
+HOOKS = [
+  ('modules.first_order_logic_parse', 'tokenizer', 'tokenizer'),
+  ('modules.first_order_logic_parse', 'parse_ast', 'parse_ast'),
+  ('modules.validate_prop', 'get_str_li', 'get_str_li'),
+  ('modules.validate_prop', 'parse_fitch', 'parse_fitch'),
+  ('modules.validate_prop', 'ProofNode.validate_all', 'validate_all'),
+  ('modules.validate_prop', 'ProofNode.verified_by',
+   by_rule('verified_by', 2, 'rule_inf')),
+  # the rule checks not found in verify_cache
+  ('modules.validate_prop', 'FormulaProp.check_rule',
+   by_rule('check_rule', 1, 'rule_inf')),
+  ('modules.search_prop', 'ProofNodeS.run_search', 'run_search'),
+  ('modules.search_prop', 'ProofNodeS.try_rule',
+   by_rule('try_rule', 1, 'rule')),
+] + [('modules.search_prop', f"ProofNodeS.{name}", name)
+     for name in edit_methods()]
+
+active = [] # the running Profiles
+installed = [] # (namespace, attribute, original) of the wrappers put in
+local = threading.local() # local.stack: time of the child spans
+
+def make_wrapper(func, span):
+  @functools.wraps(func)
+  def wrapper(*args, **kwargs):
+    name = span if isinstance(span, str) else span(args, kwargs)
+    stack = local.__dict__.setdefault('stack', [])
+    stack.append(0)
+    result = Profile.ERROR
+    t0 = time.perf_counter_ns()
+    try:
+      result = func(*args, **kwargs)
+      return result
+    finally:
+      dur = time.perf_counter_ns() - t0
+      child = stack.pop()
+      if stack:
+        stack[-1] += dur
+      for prof in active:
+        prof.record(name, t0, dur, dur - child, result)
+  return wrapper
+
+def install() -> None:
+  for module_name, attr, span in HOOKS:
+    module = sys.modules[module_name]
+    if '.' in attr: # a method
+      cls_name, name = attr.split('.')
+      cls = getattr(module, cls_name)
+      original = cls.__dict__[name]
+      installed.append((cls, name, original))
+      setattr(cls, name, make_wrapper(original, span))
+    else:
+      original = getattr(module, attr)
+      wrapper = make_wrapper(original, span)
+      for mod in list(sys.modules.values()):
+        if getattr(mod, '__dict__', {}).get(attr) is original:
+          installed.append((mod, attr, original))
+          setattr(mod, attr, wrapper)
+
+def uninstall() -> None:
+  while installed:
+    namespace, attr, original = installed.pop()
+    setattr(namespace, attr, original)
+
+class Profile:
+  """ Spans and counters of the hooked functions called while the
+      Profile is active. At most max_events spans are kept for the trace,
+      but all of them are counted. """
+  ERROR = object() # the result of a span which raised an exception
+
+  def __init__(self, max_events: int = 1_000_000):
+    self.max_events = max_events
+    self.spans = {} # type: Dict[str, List[int]] # [calls, total, self] ns
+    self.results = {} # type: Dict[Tuple[str, str], int]
+    self.events = [] # type: List[tuple] # (span, start ns, ns, thread id)
+    self.dropped = 0
+    self.counters = {} # type: Dict[str, int]
+    self.t_start = self.t_stop = None # type: int | None
+
+  def start(self) -> 'Profile':
+    if self in active:
+      raise RuntimeError("Profile.start(): already started.")
+    if not active:
+      install()
+    active.append(self)
+    self.cache_stats = (verify_cache.hits, verify_cache.misses)
+    self.t_start = time.perf_counter_ns()
+    return self
+
+  def stop(self) -> None:
+    self.t_stop = time.perf_counter_ns()
+    active.remove(self)
+    if not active:
+      uninstall()
+    hits, misses = self.cache_stats
+    for key, n in (('verify_cache_hits', verify_cache.hits - hits),
+                   ('verify_cache_misses', verify_cache.misses - misses)):
+      self.counters[key] = self.counters.get(key, 0) + n
+
+  def __enter__(self) -> 'Profile':
+    return self.start()
+
+  def __exit__(self, *exc_info) -> None:
+    self.stop()
+
+  def record(self, span: str, t0: int, dur: int, self_dur: int,
+             result) -> None:
+    stats = self.spans.get(span)
+    if stats is None:
+      stats = self.spans[span] = [0, 0, 0]
+    stats[0] += 1
+    stats[1] += dur
+    stats[2] += self_dur
+    if result is Profile.ERROR or isinstance(result, bool):
+      key = (span, 'error' if result is Profile.ERROR
+                   else str(result).lower())
+      self.results[key] = self.results.get(key, 0) + 1
+    if len(self.events) < self.max_events:
+      self.events.append((span, t0, dur, threading.get_ident()))
+    else:
+      self.dropped += 1
+
+  def summary(self, limit: int | None = None) -> str:
+    """ The spans by total time, with their self time, which leaves out
+        the spans within them, and their results. """
+    lines = [f"{'span':<28} {'calls':>8} {'total ms':>10} {'self ms':>10}"
+             "  results"]
+    for span, (calls, total, self_dur) in sorted(
+        self.spans.items(), key=lambda item: -item[1][1])[:limit]:
+      results = ' '.join(f"{result}={n}" for (name, result), n in
+                         sorted(self.results.items()) if name == span)
+      lines.append(f"{span:<28} {calls:>8} {total / 1e6:>10.2f} "
+                   f"{self_dur / 1e6:>10.2f}  {results}".rstrip())
+    lines.append(' '.join(f"{key}={n}" for key, n in
+                          sorted(self.counters.items())))
+    if self.dropped:
+      lines.append(f"{self.dropped} spans are not in the trace.")
+    return '\n'.join(lines)
+
+  def chrome_trace(self) -> dict:
+    """ The spans as complete events of the Trace Event Format, which
+        chrome://tracing and Perfetto load. Times are in microseconds. """
+    pid = os.getpid()
+    t_start = self.t_start or 0
+    events = [{'name': span, 'cat': span.split(':')[0], 'ph': 'X',
+               'ts': (t0 - t_start) / 1000, 'dur': dur / 1000,
+               'pid': pid, 'tid': tid}
+              for span, t0, dur, tid in
+              sorted(self.events, key=lambda e: (e[1], -e[2]))]
+    return {'traceEvents': events, 'displayTimeUnit': 'ms',
+            'otherData': {'dropped_spans': self.dropped, **self.counters}}
+
+  def write_chrome_trace(self, path: str) -> None:
+    with open(path, 'w', encoding='utf-8') as f:
+      json.dump(self.chrome_trace(), f)
+
+  def prometheus(self, prefix: str = 'proofmood') -> str:
+    """ The counts and times in the Prometheus text exposition format. """
+    def label(value: str) -> str:
+      return (value.replace('\\', '\\\\').replace('"', '\\"')
+              .replace('\n', '\\n'))
+
+    lines = []
+    def metric(name: str, help_str: str, samples) -> None:
+      lines.append(f"# HELP {prefix}_{name} {help_str}")
+      lines.append(f"# TYPE {prefix}_{name} counter")
+      for labels, value in samples:
+        label_str = ','.join(f'{key}="{label(v)}"' for key, v in labels)
+        lines.append(f"{prefix}_{name}{{{label_str}}} {value}")
+
+    spans = sorted(self.spans.items())
+    metric('span_calls_total', "Calls of the span.",
+           [((('span', span),), stats[0]) for span, stats in spans])
+    metric('span_seconds_total', "Time in the span.",
+           [((('span', span),), stats[1] / 1e9) for span, stats in spans])
+    metric('span_self_seconds_total',
+           "Time in the span but not in the spans within it.",
+           [((('span', span),), stats[2] / 1e9) for span, stats in spans])
+    metric('span_results_total',
+           "Results of the spans returning a bool, or error.",
+           [((('span', span), ('result', result)), n)
+            for (span, result), n in sorted(self.results.items())])
+    metric('verify_cache_lookups_total', "Lookups in verify_cache.",
+           [((('result', key.rsplit('_', 1)[1]),), n)
+            for key, n in sorted(self.counters.items())
+            if key.startswith('verify_cache_')])
+    return '\n'.join(lines) + '\n'
+
+  # end of class Profile
+
+def main(argv=None) -> None:
+  import argparse
+
+  arg_parser = argparse.ArgumentParser(description="Profile the parsing, "
+                                       "validation and search of a proof")
+  arg_parser.add_argument('file', help="the proof (default: stdin)",
+                          nargs='?', default='-')
+  arg_parser.add_argument('--tabsize', type=int, default=2)
+  arg_parser.add_argument('--search', action='store_true',
+                          help="also search for the missing annotations")
+  arg_parser.add_argument('--trace', metavar='PATH',
+                          help="write a Chrome trace to PATH")
+  arg_parser.add_argument('--prometheus', action='store_true',
+                          help="print the Prometheus text instead")
+  args = arg_parser.parse_args(argv)
+  if args.file == '-':
+    proof_str = sys.stdin.read()
+  else:
+    with open(args.file, encoding='utf-8') as f:
+      proof_str = f.read()
+  with Profile() as prof:
+    proof = ProofNodeS(parse_fitch(proof_str, tabsize=args.tabsize))
+    if args.search:
+      proof.run_search()
+  print(prof.prometheus().rstrip('\n') if args.prometheus else prof.summary())
+  if args.trace:
+    prof.write_chrome_trace(args.trace)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,226 @@
+# Evaluation of first-order formulas in finite structures with NumPy.
+#
+# A Structure has the domain {0, 1, ..., size-1} and interprets
+#   constants, numerals      elements, i.e., ints in range(size)
+#   function symbols f, g1,  int arrays of shape (size,)*arity
+#     operators +, -, ^inv
+#   predicate symbols P1,    bool arrays of shape (size,)*arity
+#     infix predicates <, in
+#   prop letters A, B        bools
+# The symbols '=' and '!=' are always the identity and its complement.
+# A numeral without an interpretation denotes itself if it is in the
+# domain. The operator '-' may be interpreted both as a unary and as a
+# binary function.
+#
+# A formula is not evaluated node by node for each assignment. It is
+# compiled once, bottom-up, into array expressions. Each unassigned free
+# variable and each quantifier depth has its own axis, and the value of a
+# subformula is a bool array which has the full size only on the axes of
+# the variables occurring in it, so that the operations broadcast. A term
+# f(t1, .., tk) is the fancy indexing F[t1, .., tk], and forall and exists
+# are all() and any() reductions along the axis of their variable. So
+# there are no Python loops over the domain. Note that the arrays can grow
+# to size ** (number of variables in scope) elements.
+#
+# Usage:
+#   M = Structure(3, {'c': 0, 'f': [1, 2, 0], 'R2': [[0, 1, 0], [0, 0, 1],
+#                     [1, 0, 0]]})
+#   M.satisfies(parse_ast('forall x R2(x, f(x))'))  # True
+#   M.evaluate(parse_ast('R2(x, c)'))  # array([False, False,  True])
+#   M.evaluate(parse_ast('R2(x, y)'), {'x': 2})  # array([ True, False, ..
+
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from modules.first_order_logic_parse import *
+
+TERM_SYMBOLS = ('const', 'numeral', 'func_pre', 'oper_pre', 'oper_post',
+                'oper_in_1', 'oper_in_2', 'oper_in_3')
+PRED_SYMBOLS = ('pred_pre', 'pred_in', 'prop_letter')
+
+class Structure:
+  """ A finite structure for first-order formulas. interp maps symbols to
+      their interpretations, and names, if given, are the names of the
+      elements used for printing and in assignments. """
+  def __init__(self, size: int, interp: Dict | None = None,
+               names: List[str] | None = None):
+    if size < 1:
+      raise ValueError("Structure: the domain must not be empty.")
+    if names is not None and len(names) != size:
+      raise ValueError(f"Structure: {len(names)} names for {size} "
+                       "elements.")
+    self.size = size
+    self.names = names
+    self.interp = {} # (symbol, arity) -> np.ndarray
+    for symbol, value in (interp or {}).items():
+      self[symbol] = value
+
+  def __setitem__(self, symbol: str, value) -> None:
+    token = Token(symbol)
+    token_type = token.token_type
+    if token_type not in TERM_SYMBOLS + PRED_SYMBOLS or symbol == '!=':
+      raise ValueError(f"Structure: '{symbol}' can't be interpreted.")
+    arr = np.asarray(value)
+    if token_type in ('const', 'numeral', 'prop_letter'):
+      arity = 0
+    elif token_type == 'oper_in_1' and symbol in Token.OPER_PRE:
+      arity = arr.ndim # '-' is both binary and unary
+    elif token_type in ('oper_in_1', 'oper_in_2', 'oper_in_3', 'pred_in'):
+      arity = 2
+    elif token_type == 'oper_post':
+      arity = 1
+    else: # func_pre, pred_pre
+      arity = token.arity
+    if arr.shape != (self.size,) * arity:
+      raise ValueError(f"Structure: '{symbol}' needs shape "
+                       f"{(self.size,) * arity}, not {arr.shape}.")
+    if token_type in PRED_SYMBOLS:
+      arr = arr.astype(bool)
+    else:
+      arr = arr.astype(np.intp)
+      if arr.size and (arr.min() < 0 or arr.max() >= self.size):
+        raise ValueError(f"Structure: '{symbol}' has values outside the "
+                         "domain.")
+    self.interp[(symbol, arity)] = arr
+
+  def __getitem__(self, key: Tuple[str, int]) -> np.ndarray:
+    # key = (symbol, arity)
+    arr = self.interp.get(key)
+    if arr is None:
+      symbol, arity = key
+      if arity == 0 and Token.isnumeral(symbol) and \
+         int(symbol) < self.size:
+        return np.asarray(int(symbol), dtype=np.intp)
+      raise ValueError(f"Structure: no interpretation of '{symbol}'" +
+                       (f" with arity {arity}." if arity else "."))
+    return arr
+
+  def element(self, value) -> int:
+    # an element given by its name or by itself
+    if isinstance(value, str):
+      if self.names is None or value not in self.names:
+        raise ValueError(f"Structure: unknown element '{value}'.")
+      return self.names.index(value)
+    if not 0 <= value < self.size:
+      raise ValueError(f"Structure: {value} is not in the domain.")
+    return int(value)
+
+  def evaluate(self, expr: Node, env: Dict | None = None):
+    """ The value of the formula or term expr, where env assigns elements
+        to free variables. If all free variables of expr are assigned, it
+        is a bool for a formula and an int for a term. Otherwise, it is an
+        array with one axis for each unassigned free variable, in the
+        order of sorted(free_vars), and the entry at (a, b, ..) is the
+        value when the variables are assigned a, b, .. respectively. """
+    env = {var: self.element(value) for var, value in (env or {}).items()}
+    free = sorted(expr.free_vars() - set(env))
+    n_free = len(free)
+
+    # pre-order pass: resolve the variables and the quantifier axes
+    frames = [] # (node, axis of the variable or element of env)
+    max_depth = 0
+    stack = [(expr, {var: k for k, var in enumerate(free)}, 0)]
+    while stack:
+      node, scope, depth = stack.pop()
+      token = node.token
+      ref = None
+      if token.token_type == 'var':
+        ref = scope[token.value] if token.value in scope \
+              else -1 - env[token.value]
+      elif token.token_type == 'quantifier':
+        ref = n_free + depth
+      elif token.token_type == 'var_determiner':
+        scope = dict(scope)
+        scope[token.value] = n_free + depth
+        depth += 1
+        max_depth = max(max_depth, depth)
+      frames.append((node, ref))
+      stack.extend((kid, scope, depth) for kid in reversed(node.children))
+
+    # post-order pass: the frames in reverse pre-order leave the values of
+    # the children of a node on the stack, the first one on top
+    n_axis = n_free + max_depth
+    ones = (1,) * n_axis
+    axes = []
+    for k in range(n_axis):
+      shape = list(ones)
+      shape[k] = self.size
+      axes.append(np.arange(self.size).reshape(shape))
+    values = []
+    for node, ref in reversed(frames):
+      token = node.token
+      value, token_type = token.value, token.token_type
+      kids = [values.pop() for _ in node.children]
+      if token_type == 'var':
+        arr = axes[ref] if ref >= 0 else np.full(ones, -1 - ref)
+      elif value == '!=':
+        arr = kids[0] != kids[1]
+      elif token_type in TERM_SYMBOLS or token_type in PRED_SYMBOLS:
+        table = self[(value, len(kids))]
+        arr = table[tuple(kids)] if kids else table.reshape(ones)
+      elif token_type == 'equality':
+        arr = kids[0] == kids[1]
+      elif token_type == 'conn_0ary':
+        arr = np.full(ones, value == 'top')
+      elif value == 'not':
+        arr = ~kids[0]
+      elif value == 'and':
+        arr = kids[0] & kids[1]
+      elif value == 'or':
+        arr = kids[0] | kids[1]
+      elif value == 'imp':
+        arr = ~kids[0] | kids[1]
+      elif value == 'iff':
+        arr = kids[0] == kids[1]
+      elif value == 'xor':
+        arr = kids[0] != kids[1]
+      elif token_type == 'var_determiner':
+        arr = kids[0]
+      elif value == 'forall':
+        arr = kids[0].all(axis=ref, keepdims=True)
+      elif value == 'exists':
+        arr = kids[0].any(axis=ref, keepdims=True)
+      else:
+        raise ValueError(f"Structure: can't evaluate '{value}'.")
+      values.append(arr)
+
+    arr = values.pop()
+    arr = np.broadcast_to(arr.reshape(arr.shape[:n_free]),
+                          (self.size,) * n_free)
+    if n_free == 0:
+      return bool(arr) if expr.type == 'formula' else int(arr)
+    return arr
+
+  def satisfies(self, fmla: Node, env: Dict | None = None) -> bool:
+    """ Whether fmla is true in self under env, which must assign all the
+        free variables of fmla. """
+    unassigned = fmla.free_vars() - set(env or {})
+    if unassigned:
+      raise ValueError("Structure.satisfies(): free variables "
+                       f"{sorted(unassigned)} are not assigned.")
+    return self.evaluate(fmla, env)
+
+  def name(self, element: int) -> str:
+    return str(element) if self.names is None else self.names[element]
+
+  def __str__(self):
+    def tuple_str(tup) -> str:
+      return self.name(tup[0]) if len(tup) == 1 else \
+        '(' + ', '.join(self.name(e) for e in tup) + ')'
+
+    lines = ['domain = {' + ', '.join(self.name(e) for e in
+                                      range(self.size)) + '}']
+    for (symbol, arity), arr in sorted(self.interp.items()):
+      label = f"{symbol}/{arity}" if symbol in Token.OPER_PRE else symbol
+      if arity == 0:
+        text = str(bool(arr)).lower() if arr.dtype == bool \
+               else self.name(int(arr))
+      elif arr.dtype == bool:
+        text = '{' + ', '.join(tuple_str(tup) for tup in
+                               zip(*np.nonzero(arr))) + '}'
+      else:
+        text = ', '.join(f"{tuple_str(tup)} -> {self.name(arr[tup])}"
+                         for tup in np.ndindex(arr.shape))
+      lines.append(f"{label} = {text}")
+    return '\n'.join(lines)
@@ -0,0 +1,196 @@
+# Content-addressed on-disk cache of parsed and validated proofs.
+#
+# The key of an entry is the SHA-256 hash of
+#   (library version, tabsize, normalized proof text).
+# The value is the parsed ProofNode tree with its validation flags
+# already set, in the binary format of codec.py, together with the per-line validation results.
+# So a cache hit skips get_str_li(), ProofParser, build_index() and
+# validate_all() entirely.
+#
+# The library version is a hash of the source code of the logic modules.
+# Whenever the parser or the verifier changes, all old entries are
+# simply missed and can be removed with purge_stale().
+#
+# A hit only reads the file. The hit counts and last use times of the
+# entries are kept in memory and written together with the next put(),
+# every FLUSH_SIZE entries or FLUSH_INTERVAL seconds, and by close().
+#
+# Usage:
+#   cache = ProofCache('proofs.sqlite3')
+#   proof = cache.parse_fitch(prf_str) # instead of parse_fitch(prf_str)
+
+import sqlite3, hashlib, json, time, os, functools
+from typing import List, Dict
+
+from modules.validate_prop import *
+from modules.codec import dumps, loads
+
+CACHE_FORMAT = 2 # bump this when the stored format changes
+LOGIC_MODULES = ('first_order_logic_parse.py', 'truth_table.py',
+                 'validate_prop.py', 'codec.py')
+FLUSH_SIZE = 256 # entries whose hits are kept in memory at most
+FLUSH_INTERVAL = 60.0 # seconds between writes of the hits at most
+
+@functools.lru_cache(maxsize=None)
+def lib_version() -> str:
+  """ Hash of the source code of the modules that parse and validate
+      proofs, together with CACHE_FORMAT. """
+  h = hashlib.sha256(f"format {CACHE_FORMAT}\n".encode())
+  dir_name = os.path.dirname(os.path.abspath(__file__))
+  for file_name in LOGIC_MODULES:
+    with open(os.path.join(dir_name, file_name), 'rb') as f:
+      h.update(f.read())
+  return h.hexdigest()[:16]
+
+def normalize_proof_str(proof_str: str) -> str:
+  """ Normalize proof_str so that the texts which parse_fitch() cannot
+      tell apart get the same hash. We follow get_str_li():
+      the first and the last line are dropped if they are blank, and
+      trailing spaces are removed from non-blank lines. Blank lines in
+      the middle are kept because their indentation is significant. """
+  str_li = proof_str.replace('\r\n', '\n').split('\n')
+  if len(str_li[0]) == 0 or str_li[0].isspace():
+    str_li = str_li[1:]
+  if str_li and (len(str_li[-1]) == 0 or str_li[-1].isspace()):
+    str_li = str_li[:-1]
+  return '\n'.join([s if s.isspace() else s.rstrip() for s in str_li])
+
+def line_results(proof: ProofNode) -> List[Dict]:
+  """ Per-line validation results of a validated proof.
+      proof must be the root of the whole proof. """
+  lines = []
+  for node_code in proof.index_dict:
+    if bSubproof(node_code):
+      continue
+    p_node = proof.get_p_node(node_code)
+    label = p_node.label
+    lines.append({'line_num': node_code,
+                  'type': label.type.value,
+                  'text': f"{label}",
+                  'is_hyp': bool(label.is_hyp),
+                  'validated': bool(p_node.validated)})
+  return lines
+
+class ProofCache:
+  """ Persistent cache of parsed and validated proofs in SQLite.
+      path=':memory:' gives a cache that lives only in this process. """
+  SCHEMA = """
+    CREATE TABLE IF NOT EXISTS proofs (
+      key TEXT PRIMARY KEY,
+      lib_version TEXT NOT NULL,
+      tree BLOB NOT NULL,
+      lines TEXT NOT NULL,
+      valid INTEGER NOT NULL,
+      created REAL NOT NULL,
+      last_used REAL NOT NULL,
+      hits INTEGER NOT NULL DEFAULT 0
+    )"""
+
+  def __init__(self, path: str=':memory:'):
+    self.path = path
+    self.conn = sqlite3.connect(path, timeout=30)
+    if path != ':memory:':
+      # several worker processes may share the same file
+      self.conn.execute("PRAGMA journal_mode=WAL")
+    self.conn.execute(self.SCHEMA)
+    self.conn.commit()
+    self.n_hit = 0
+    self.n_miss = 0
+    self.used = {} # type: Dict[str, List] # key -> [hits, last_used]
+    self.t_flush = time.time()
+
+  def key(self, proof_str: str, tabsize: int=2) -> str:
+    text = normalize_proof_str(proof_str)
+    h = hashlib.sha256(f"{lib_version()}\n{tabsize}\n".encode())
+    h.update(text.encode())
+    return h.hexdigest()
+
+  def lookup(self, key: str, column: str):
+    row = self.conn.execute(f"SELECT {column} FROM proofs WHERE key = ?",
+                            (key,)).fetchone()
+    if row is None:
+      self.n_miss += 1
+      return None
+    self.n_hit += 1
+    now = time.time()
+    if key in self.used:
+      self.used[key][0] += 1
+      self.used[key][1] = now
+    else:
+      self.used[key] = [1, now]
+    if len(self.used) >= FLUSH_SIZE or now - self.t_flush > FLUSH_INTERVAL:
+      self.flush()
+    return row
+
+  def write_used(self) -> None:
+    # in the transaction of the caller
+    self.conn.executemany(
+      "UPDATE proofs SET hits = hits + ?, last_used = max(last_used, ?) "
+      "WHERE key = ?", [(n, t, key) for key, (n, t) in self.used.items()])
+    self.used.clear()
+    self.t_flush = time.time()
+
+  def flush(self) -> None:
+    """ Write the hit counts and last use times kept in memory. """
+    if self.used:
+      self.write_used()
+      self.conn.commit()
+
+  def get(self, proof_str: str, tabsize: int=2) -> ProofNode | None:
+    """ Return the cached proof tree, or None if not cached. """
+    row = self.lookup(self.key(proof_str, tabsize), "tree")
+    return None if row is None else loads(row[0])
+
+  def get_result(self, proof_str: str, tabsize: int=2) -> Dict | None:
+    """ Return {'valid': bool, 'lines': [..]} without loading the tree,
+        or None if not cached. """
+    row = self.lookup(self.key(proof_str, tabsize), "valid, lines")
+    if row is None:
+      return None
+    return {'valid': bool(row[0]), 'lines': json.loads(row[1])}
+
+  def put(self, proof_str: str, proof: ProofNode, tabsize: int=2) -> None:
+    """ Store proof, which must be the parsed and validated tree of
+        proof_str. """
+    now = time.time()
+    lines = line_results(proof)
+    valid = all([line['validated'] for line in lines])
+    tree = dumps(proof)
+    self.conn.execute(
+      "INSERT OR REPLACE INTO proofs (key, lib_version, tree, lines, valid, "
+      "created, last_used) VALUES (?, ?, ?, ?, ?, ?, ?)",
+      (self.key(proof_str, tabsize), lib_version(), tree, json.dumps(lines),
+       int(valid), now, now))
+    self.write_used()
+    self.conn.commit()
+
+  def parse_fitch(self, proof_str: str='', tabsize: int=2) -> ProofNode:
+    """ Drop-in replacement of parse_fitch(proof_str, True, tabsize).
+        Parse and validate on a miss, and store the result. """
+    proof = self.get(proof_str, tabsize)
+    if proof is None:
+      proof = parse_fitch(proof_str, validate=True, tabsize=tabsize)
+      self.put(proof_str, proof, tabsize)
+    return proof
+
+  def purge_stale(self) -> int:
+    """ Delete the entries made by other library versions.
+        Return the number of deleted entries. """
+    cur = self.conn.execute("DELETE FROM proofs WHERE lib_version != ?",
+                            (lib_version(),))
+    self.conn.commit()
+    return cur.rowcount
+
+  def clear(self) -> None:
+    self.conn.execute("DELETE FROM proofs")
+    self.conn.commit()
+
+  def stats(self) -> Dict:
+    n_entry = self.conn.execute("SELECT COUNT(*) FROM proofs").fetchone()[0]
+    n_lookup = self.n_hit + self.n_miss
+    return {'entries': n_entry, 'hits': self.n_hit, 'misses': self.n_miss,
+            'hit_rate': self.n_hit / n_lookup if n_lookup else 0.0}
+
+  def close(self) -> None:
+    self.flush()
+    self.conn.close()
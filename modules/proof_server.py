@@ -0,0 +1,437 @@
+# A local validation service for Fitch proofs.
+#
+# Usage:
+#   python -m modules.proof_server --port 8000 --workers 4
+#
+# The server speaks plain HTTP/1.1 with JSON bodies and uses nothing but
+# the standard library, so it runs fully offline on localhost.
+# Endpoints (all POST except /health):
+#   /validate     {"proof": str, "tabsize": int}
+#   /annotate     {"proof": str, "tabsize": int}
+#   /truth_table  {"formulas": [str, ..], "opt": "text" | "latex"}
+#   /render       {"proof": str, "format": "text" | "latex" | "html"} or
+#                 {"formula": str, "format": "text" | "latex" |
+#                                           "polish" | "bussproof"}
+#   /edit         {"session": str, "proof": str, "tabsize": int} opens
+#                 an editing session, then
+#                 {"session": str, "ops": [op records]} applies the op
+#                 records of ProofNodeS.take_ops() to the session's copy
+#                 of the proof. Either way, only the rows which changed
+#                 are sent back (ProofNodeS.render_delta()).
+#   /health       (GET)
+# With --cache PATH, parsed and validated proofs are also kept in an
+# on-disk cache (see proof_cache.py) shared by all workers and restarts.
+# Every POST body may also carry "timeout" (seconds), which is capped by
+# the server's own deadline.
+#
+# The asyncio front end only reads requests and writes responses.  The
+# real work (parsing, validation, proof search) is done by a pool of
+# worker processes which are forked once at startup and kept alive, so
+# that the imports and the parse caches of each worker stay warm.
+# Backpressure: at most max_pending requests may be in flight. Beyond
+# that, the server answers 503 immediately instead of queueing forever.
+# Each worker is a pool of its own. Requests of an editing session always
+# go to the same worker, which keeps the session's proof in memory. The
+# other requests go to the least busy worker.
+# A worker whose job runs past the deadline, or which dies, is killed and
+# replaced by a new one, so that no request waits behind an abandoned job.
+# The editing sessions of that worker are lost: their next /edit is
+# answered 400 and has to send 'proof' again.
+
+import asyncio, json, functools, zlib
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Dict, List, Tuple
+
+from modules.search_prop import *
+from modules.proof_cache import *
+
+#region worker side (runs in the worker processes)
+
+WARM_PROOF = '''
+1. A imp B .hyp
+proves
+  2. A .hyp
+  proves
+  3. B .imp elim 1,2
+4. A imp B .imp intro 2-3
+'''
+
+class RequestError(Exception):
+  """ Error caused by a bad request. Reported to the client as 400. """
+  pass
+
+disk_cache = None # type: ProofCache | None
+
+def init_worker(cache_path: str | None=None) -> None:
+  """ Initializer of each worker process. Open the disk cache if any,
+      and parse, validate and search a small proof once, so that the
+      first real request does not pay for the cold start. """
+  global disk_cache
+  if cache_path:
+    # a connection of its own for each process, opened after the fork
+    disk_cache = ProofCache(cache_path)
+  handle_validate({'proof': WARM_PROOF})
+  handle_annotate({'proof': WARM_PROOF})
+  handle_render({'formula': 'forall x (P1(x) imp Q1(x))'})
+
+def get_proof_str(payload: dict) -> Tuple[str, int]:
+  proof_str = payload.get('proof')
+  if not isinstance(proof_str, str):
+    raise RequestError("'proof' must be a string.")
+  tabsize = payload.get('tabsize', 2)
+  if not isinstance(tabsize, int) or tabsize <= 0:
+    raise RequestError("'tabsize' must be a positive integer.")
+  return (proof_str, tabsize)
+
+# The handlers below return plain dicts, which are sent back to the
+# front end through the pool. The results of validation and rendering are
+# pure functions of the input text, so we keep them in a per-worker LRU
+# cache. This is the "warm" state of a worker.
+
+def load_proof(proof_str: str, tabsize: int) -> ProofNode:
+  """ Parse and validate proof_str, through the disk cache if any.
+      The disk cache returns a fresh tree on every hit. """
+  if disk_cache is not None:
+    return disk_cache.parse_fitch(proof_str, tabsize)
+  return parse_fitch(proof_str, tabsize=tabsize)
+
+@functools.lru_cache(maxsize=512)
+def validate_cached(proof_str: str, tabsize: int) -> dict:
+  proof = load_proof(proof_str, tabsize)
+  return {'valid': proof.verified_all(),
+          'lines': line_results(proof),
+          'text': proof.build_fitch_text()}
+
+def handle_validate(payload: dict) -> dict:
+  return validate_cached(*get_proof_str(payload))
+
+@functools.lru_cache(maxsize=512)
+def annotate_cached(proof_str: str, tabsize: int) -> dict:
+  proof = ProofNodeS(load_proof(proof_str, tabsize))
+  b_done = proof.run_search()
+  return {'valid': proof.verified_all(),
+          'lines': line_results(proof),
+          'text': proof.build_fitch_text(),
+          'log': ProofNodeS.SEARCH_MESSAGES[b_done]}
+
+def handle_annotate(payload: dict) -> dict:
+  return annotate_cached(*get_proof_str(payload))
+
+SESSION_LIMIT = 64 # editing sessions kept by a worker
+sessions = OrderedDict() # type: OrderedDict[str, ProofNodeS]
+
+def handle_edit(payload: dict) -> dict:
+  sid = payload.get('session')
+  if not isinstance(sid, str) or not sid:
+    raise RequestError("'session' must be a nonempty string.")
+  ops = payload.get('ops', [])
+  if not isinstance(ops, list):
+    raise RequestError("'ops' must be a list of op records.")
+  if 'proof' in payload:
+    proof = ProofNodeS(load_proof(*get_proof_str(payload)))
+    sessions[sid] = proof
+  elif sid in sessions:
+    proof = sessions[sid]
+  else:
+    raise RequestError(f"Unknown session '{sid}'. Send 'proof' to "
+                       "open it again.")
+  sessions.move_to_end(sid)
+  while len(sessions) > SESSION_LIMIT:
+    sessions.popitem(last=False)
+  try:
+    proof.apply_ops(ops)
+  except Exception:
+    # The copy may be out of step with the client now.
+    del sessions[sid]
+    raise
+  proof.take_ops() # the records of the server's copy are not needed
+  rows = proof.render_delta() # keeps n_invalid up to date
+  return {'session': sid, 'valid': proof.n_invalid == 0, 'rows': rows}
+
+def handle_truth_table(payload: dict) -> dict:
+  fmla_li = payload.get('formulas')
+  if isinstance(fmla_li, str):
+    fmla_li = [fmla_li]
+  if not fmla_li or not all([isinstance(s, str) for s in fmla_li]):
+    raise RequestError("'formulas' must be a nonempty list of strings.")
+  opt = payload.get('opt', 'text')
+  if opt not in ('text', 'latex'):
+    raise RequestError("'opt' must be either 'text' or 'latex'.")
+  return truth_table_cached(tuple(fmla_li), opt)
+
+@functools.lru_cache(maxsize=512)
+def truth_table_cached(fmla_li: tuple, opt: str) -> dict:
+  # Formula() prints parse errors instead of raising them, so we parse
+  # the inputs ourselves first.
+  f_list = [Formula(parse_ast(s)) for s in fmla_li]
+  result = TruthTable(f_list).build_truth_table(opt)
+  return {'formulas': result.formulas, 'table': result.text}
+
+@functools.lru_cache(maxsize=2048)
+def parse_ast_cached(input_text: str) -> Node:
+  # The returned Node is shared. Callers must not mutate it.
+  return parse_ast(input_text)
+
+def handle_render(payload: dict) -> dict:
+  fmt = payload.get('format')
+  if isinstance(payload.get('formula'), str):
+    ast = parse_ast_cached(payload['formula'])
+    fmt = fmt or 'latex'
+    if fmt in ('latex', 'text'):
+      out = ast.build_infix(fmt)
+    elif fmt == 'polish':
+      out = ast.build_polish_notation()
+    elif fmt == 'bussproof':
+      out = ast.build_bussproof()
+    else:
+      raise RequestError(f"Unknown format '{fmt}' for a formula.")
+  elif 'proof' in payload:
+    proof_str, tabsize = get_proof_str(payload)
+    fmt = fmt or 'text'
+    if fmt == 'text':
+      out = validate_cached(proof_str, tabsize)['text']
+    elif fmt in ('latex', 'html'):
+      out = render_proof_cached(proof_str, tabsize, fmt)
+    else:
+      raise RequestError(f"Unknown format '{fmt}' for a proof.")
+  else:
+    raise RequestError("Either 'formula' or 'proof' is required.")
+  return {'format': fmt, 'output': out}
+
+@functools.lru_cache(maxsize=512)
+def render_proof_cached(proof_str: str, tabsize: int, fmt: str) -> str:
+  proof = parse_fitch(proof_str, tabsize=tabsize)
+  return proof.build_fitch_html() if fmt == 'html' \
+         else proof.build_fitch_latex()
+
+HANDLERS = {
+  '/validate': handle_validate,
+  '/annotate': handle_annotate,
+  '/truth_table': handle_truth_table,
+  '/render': handle_render,
+  '/edit': handle_edit,
+}
+
+def run_job(path: str, payload: dict) -> Tuple[int, dict]:
+  """ Entry point of a job in a worker process.
+      Return (HTTP status, response body). """
+  try:
+    return (200, HANDLERS[path](payload))
+  except RequestError as e:
+    return (400, {'error': f"{e}"})
+  except (ValueError, SyntaxError, AssertionError, IndexError, 
+          KeyError, TypeError) as e:
+    # parse errors of formulas and proofs
+    return (400, {'error': f"{type(e).__name__}: {e}"})
+
+def ping() -> bool:
+  return True
+
+#endregion worker side
+
+#region front end (runs in the main process)
+
+REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found',
+           405: 'Method Not Allowed', 413: 'Payload Too Large',
+           500: 'Internal Server Error', 503: 'Service Unavailable',
+           504: 'Gateway Timeout'}
+
+class ProofServer:
+  """ asyncio HTTP/JSON front end with a warm worker pool. """
+  def __init__(self, host: str='127.0.0.1', port: int=8000,
+               workers: int=2, max_pending: int | None=None,
+               timeout: float=10.0, max_body: int=1 << 20,
+               cache_path: str | None=None):
+    self.host = host
+    self.port = port
+    self.n_workers = workers
+    self.max_pending = max_pending or 4 * workers
+    self.timeout = timeout # deadline of a request in seconds
+    self.max_body = max_body # maximum size of a request body in bytes
+    self.cache_path = cache_path # path of the disk cache of proofs
+    # one single process pool per worker, see dispatch()
+    self.pools = [] # type: List[ProcessPoolExecutor]
+    self.loads = [] # type: List[int] # requests in flight per worker
+    # restarts per worker, so that the requests of a killed worker don't
+    # touch the load of the new one
+    self.epochs = [] # type: List[int]
+    self.server = None # type: asyncio.AbstractServer | None
+    self.n_pending = 0
+    self.stats = {'requests': 0, 'rejected': 0, 'timeouts': 0,
+                  'restarts': 0}
+
+  def new_pool(self) -> ProcessPoolExecutor:
+    # A worker forked from the front end would inherit its open sockets,
+    # and a connection would not be closed until that worker exits. The
+    # fork server is started by start() before we listen, so the workers
+    # it forks, also those of restart_worker(), have none. It imports
+    # the modules once, which the workers share.
+    methods = multiprocessing.get_all_start_methods()
+    if 'forkserver' in methods:
+      ctx = multiprocessing.get_context('forkserver')
+      ctx.set_forkserver_preload(['modules.search_prop',
+                                  'modules.proof_cache'])
+    else:
+      ctx = multiprocessing.get_context()
+    return ProcessPoolExecutor(1, mp_context=ctx, initializer=init_worker,
+                               initargs=(self.cache_path,))
+
+  def restart_worker(self, i: int) -> None:
+    """ Kill worker i and put a new one in its place. The jobs still
+        queued for it fail with BrokenProcessPool. """
+    pool = self.pools[i]
+    # ProcessPoolExecutor has no public way to stop a running job.
+    for process in list((pool._processes or {}).values()):
+      process.terminate()
+    pool.shutdown(wait=False)
+    self.pools[i] = self.new_pool()
+    self.loads[i] = 0
+    self.epochs[i] += 1
+    self.stats['restarts'] += 1
+
+  async def start(self) -> None:
+    """ Fork the workers, warm them up and start listening. """
+    self.pools = [self.new_pool() for _ in range(self.n_workers)]
+    self.loads = [0] * self.n_workers
+    self.epochs = [0] * self.n_workers
+    # The pools spawn their workers on demand. Submit one job to each
+    # so that all of them are forked and initialized before we listen.
+    loop = asyncio.get_running_loop()
+    await asyncio.gather(*[loop.run_in_executor(pool, ping)
+                           for pool in self.pools])
+    self.server = await asyncio.start_server(self.handle_conn,
+                                             self.host, self.port)
+    self.port = self.server.sockets[0].getsockname()[1]
+
+  async def stop(self) -> None:
+    if self.server is not None:
+      self.server.close()
+      await self.server.wait_closed()
+    for pool in self.pools:
+      pool.shutdown(wait=False, cancel_futures=True)
+
+  async def serve_forever(self) -> None:
+    await self.start()
+    print(f"Proof server listening on http://{self.host}:{self.port} "
+          f"with {self.n_workers} workers")
+    try:
+      await self.server.serve_forever() # type: ignore
+    finally:
+      await self.stop()
+
+  async def handle_conn(self, reader: asyncio.StreamReader,
+                        writer: asyncio.StreamWriter) -> None:
+    try:
+      status, body = await self.handle_request(reader)
+    except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+      status, body = (400, {'error': 'Malformed HTTP request.'})
+    data = json.dumps(body).encode()
+    head = (f"HTTP/1.1 {status} {REASONS.get(status, '')}\r\n"
+            "Content-Type: application/json\r\n"
+            f"Content-Length: {len(data)}\r\n"
+            + ("Retry-After: 1\r\n" if status == 503 else "") +
+            "Connection: close\r\n\r\n")
+    try:
+      writer.write(head.encode() + data)
+      await writer.drain()
+      writer.close()
+      await writer.wait_closed()
+    except ConnectionError:
+      pass
+
+  async def handle_request(self, reader) -> Tuple[int, dict]:
+    request_line = (await reader.readline()).decode('latin-1').split()
+    if len(request_line) != 3:
+      raise ValueError("bad request line")
+    method, path, _ = request_line
+    headers = {} # type: Dict[str, str]
+    while (line := await reader.readline()) not in (b'\r\n', b'\n', b''):
+      key, _, value = line.decode('latin-1').partition(':')
+      headers[key.strip().lower()] = value.strip()
+    self.stats['requests'] += 1
+
+    if path == '/health':
+      return (200, {'status': 'ok', 'workers': self.n_workers,
+                    'pending': self.n_pending, **self.stats})
+    if path not in HANDLERS:
+      return (404, {'error': f"Unknown endpoint '{path}'."})
+    if method != 'POST':
+      return (405, {'error': 'Use POST.'})
+    length = int(headers.get('content-length', '0'))
+    if length > self.max_body:
+      return (413, {'error': f"Body exceeds {self.max_body} bytes."})
+    try:
+      payload = json.loads(await reader.readexactly(length) or b'{}')
+    except json.JSONDecodeError as e:
+      return (400, {'error': f"Invalid JSON: {e}"})
+    if not isinstance(payload, dict):
+      return (400, {'error': 'JSON body must be an object.'})
+    return await self.dispatch(path, payload)
+
+  async def dispatch(self, path: str, payload: dict) -> Tuple[int, dict]:
+    # backpressure
+    if self.n_pending >= self.max_pending:
+      self.stats['rejected'] += 1
+      return (503, {'error': 'Server is busy. Try again later.'})
+    timeout = self.timeout
+    if isinstance(payload.get('timeout'), (int, float)):
+      timeout = max(0.0, min(timeout, payload['timeout']))
+    loop = asyncio.get_running_loop()
+    # An editing session sticks to one worker, which keeps its proof.
+    if isinstance(sid := payload.get('session'), str):
+      i = zlib.crc32(sid.encode()) % self.n_workers
+    else:
+      i = min(range(self.n_workers), key=self.loads.__getitem__)
+    epoch = self.epochs[i]
+    self.n_pending += 1
+    self.loads[i] += 1
+    try:
+      fut = loop.run_in_executor(self.pools[i], run_job, path, payload)
+      return await asyncio.wait_for(fut, timeout)
+    except asyncio.TimeoutError:
+      # The worker would keep running the job, and the next requests
+      # would wait behind it.
+      self.stats['timeouts'] += 1
+      if self.epochs[i] == epoch:
+        self.restart_worker(i)
+      return (504, {'error': f"Deadline of {timeout}s exceeded."})
+    except BrokenProcessPool as e:
+      if self.epochs[i] != epoch: # killed by restart_worker()
+        return (503, {'error': 'Worker was restarted. Try again.'})
+      self.restart_worker(i) # the worker died
+      return (500, {'error': f"{type(e).__name__}: {e}"})
+    except Exception as e:
+      return (500, {'error': f"{type(e).__name__}: {e}"})
+    finally:
+      self.n_pending -= 1
+      if self.epochs[i] == epoch:
+        self.loads[i] -= 1
+
+#endregion front end
+
+def main(argv=None) -> None:
+  import argparse
+
+  arg_parser = argparse.ArgumentParser(description="Proofmood local "
+                                       "validation service")
+  arg_parser.add_argument('--host', default='127.0.0.1')
+  arg_parser.add_argument('--port', type=int, default=8000)
+  arg_parser.add_argument('--workers', type=int, default=2)
+  arg_parser.add_argument('--max-pending', type=int, default=None)
+  arg_parser.add_argument('--timeout', type=float, default=10.0)
+  arg_parser.add_argument('--cache', default=None,
+                          help="path of the disk cache of proofs")
+  args = arg_parser.parse_args(argv)
+  server = ProofServer(args.host, args.port, args.workers,
+                       args.max_pending, args.timeout,
+                       cache_path=args.cache)
+  try:
+    asyncio.run(server.serve_forever())
+  except KeyboardInterrupt:
+    pass
+
+if __name__ == '__main__':
+  main()
@@ -49,7 +49,7 @@ def tokenizer(input_text):
   tokens = []
   # Split the input text into a list of tokens at word boundries and whitespaces
   # then remove empty strings and strip off leading and trailing whitespaces.
-  li = [s.strip() for s in re.split(r"\b|\s", input_text, re.ASCII) 
+  li = [s.strip() for s in re.split(r"\b|\s", input_text, flags=re.ASCII) 
                   if s.strip()]
   for s in li: # s is a nonempty string
     if not s.isascii():
@@ -368,8 +368,6 @@ def parse_ast(input_text):
 
 ## (2/2) Draw bussproof style Trees ## ------------------------------------
 
-from matplotlib import pyplot as plt
-
 class Tbox: # text object together with its position and size
   def __init__(self, txt, ax, r):
     # txt is a text object
@@ -0,0 +1,226 @@
+# Content-addressed cache of rendered formula images.
+#
+# The key of an entry is the SHA-256 hash of
+#   (renderer version, image format, render options, encoded AST),
+# where the AST is encoded by codec.py. So structurally equal formulas
+# share one image however they were written, e.g. 'A imp (B and C)' and
+# '(A imp B and C)'. The value is the image itself:
+#   'png', 'pdf'  draw_tree.render_ast_image() through matplotlib, with
+#                 the options dpi, fontset and usetex
+#   'svg'         draw_tree.build_ast_svg(), with the option font_size
+# Images are kept in a memory LRU in front of an optional SQLite store,
+# so notebooks and pages showing the same formulas reuse the bytes
+# instead of running matplotlib and LaTeX again.
+#
+# The renderer version is a hash of the source code of the drawing
+# modules. Whenever they change, all old entries are simply missed and
+# can be removed with purge_stale().
+#
+# A hit only reads the file. The hit counts and last use times of the
+# stored images are kept in memory and written together with the next
+# put(), every FLUSH_SIZE images or FLUSH_INTERVAL seconds, and by close().
+#
+# Usage:
+#   cache = RenderCache('images.sqlite3')
+#   png = cache.render(parse_ast('A imp B'), 'png', dpi=200)
+#   svg = cache.render(parse_ast('A imp B'), 'svg')
+# Node.draw_tree() goes through default_cache().
+
+import sqlite3, hashlib, json, time, os, functools
+from collections import OrderedDict
+from typing import Dict
+
+from modules.first_order_logic_parse import *
+from modules.codec import encode_node
+
+CACHE_FORMAT = 1 # bump this when the stored format changes
+RENDER_MODULES = ('first_order_logic_parse.py', 'draw_tree.py')
+FORMATS = {'png': ('dpi', 'fontset', 'usetex'),
+           'pdf': ('dpi', 'fontset', 'usetex'),
+           'svg': ('font_size',)}
+FLUSH_SIZE = 256 # images whose hits are kept in memory at most
+FLUSH_INTERVAL = 60.0 # seconds between writes of the hits at most
+
+@functools.lru_cache(maxsize=None)
+def render_version() -> str:
+  """ Hash of the source code of the modules that draw formulas,
+      together with CACHE_FORMAT. """
+  h = hashlib.sha256(f"format {CACHE_FORMAT}\n".encode())
+  dir_name = os.path.dirname(os.path.abspath(__file__))
+  for file_name in RENDER_MODULES:
+    with open(os.path.join(dir_name, file_name), 'rb') as f:
+      h.update(f.read())
+  return h.hexdigest()[:16]
+
+def render_image(ast: Node, fmt: str, options: Dict) -> bytes:
+  """ Render ast without any cache. """
+  from modules.draw_tree import render_ast_image, build_ast_svg
+  if fmt == 'svg':
+    return build_ast_svg(ast, **options).encode()
+  return render_ast_image(ast, fmt, **options)
+
+class RenderCache:
+  """ Cache of formula images, in memory and, if path is given, in
+      SQLite. max_items bounds the memory LRU only. """
+  SCHEMA = """
+    CREATE TABLE IF NOT EXISTS images (
+      key TEXT PRIMARY KEY,
+      version TEXT NOT NULL,
+      fmt TEXT NOT NULL,
+      data BLOB NOT NULL,
+      created REAL NOT NULL,
+      last_used REAL NOT NULL,
+      hits INTEGER NOT NULL DEFAULT 0
+    )"""
+
+  def __init__(self, path: str | None = None, max_items: int = 512):
+    self.path = path
+    self.max_items = max_items
+    self.memory = OrderedDict() # key -> bytes, most recently used last
+    self.conn = None
+    if path is not None:
+      self.conn = sqlite3.connect(path, timeout=30)
+      if path != ':memory:':
+        # several processes may share the same file
+        self.conn.execute("PRAGMA journal_mode=WAL")
+      self.conn.execute(self.SCHEMA)
+      self.conn.commit()
+    self.n_hit = 0
+    self.n_miss = 0
+    self.used = {} # type: Dict[str, list] # key -> [hits, last_used]
+    self.t_flush = time.time()
+
+  def key(self, ast: Node, fmt: str, options: Dict) -> str:
+    if fmt not in FORMATS:
+      raise ValueError(f"RenderCache: unknown image format '{fmt}'.")
+    unknown = set(options) - set(FORMATS[fmt])
+    if unknown:
+      raise ValueError(f"RenderCache: unknown options {sorted(unknown)} "
+                       f"for '{fmt}'.")
+    h = hashlib.sha256(f"{render_version()}\n{fmt}\n".encode())
+    h.update(json.dumps(options, sort_keys=True).encode() + b'\n')
+    h.update(encode_node(ast))
+    return h.hexdigest()
+
+  def get(self, key: str) -> bytes | None:
+    """ Return the cached image, or None if not cached. """
+    data = self.memory.get(key)
+    if data is not None:
+      self.memory.move_to_end(key)
+    elif self.conn is not None:
+      row = self.conn.execute("SELECT data FROM images WHERE key = ?",
+                              (key,)).fetchone()
+      if row is not None:
+        data = bytes(row[0])
+        self.note_used(key)
+        self.remember(key, data)
+    if data is None:
+      self.n_miss += 1
+    else:
+      self.n_hit += 1
+    return data
+
+  def note_used(self, key: str) -> None:
+    now = time.time()
+    if key in self.used:
+      self.used[key][0] += 1
+      self.used[key][1] = now
+    else:
+      self.used[key] = [1, now]
+    if len(self.used) >= FLUSH_SIZE or now - self.t_flush > FLUSH_INTERVAL:
+      self.flush()
+
+  def write_used(self) -> None:
+    # in the transaction of the caller
+    self.conn.executemany( # type: ignore
+      "UPDATE images SET hits = hits + ?, last_used = max(last_used, ?) "
+      "WHERE key = ?", [(n, t, key) for key, (n, t) in self.used.items()])
+    self.used.clear()
+    self.t_flush = time.time()
+
+  def flush(self) -> None:
+    """ Write the hit counts and last use times kept in memory. """
+    if self.conn is not None and self.used:
+      self.write_used()
+      self.conn.commit()
+
+  def remember(self, key: str, data: bytes) -> None:
+    self.memory[key] = data
+    self.memory.move_to_end(key)
+    while len(self.memory) > self.max_items:
+      self.memory.popitem(last=False)
+
+  def put(self, key: str, data: bytes, fmt: str) -> None:
+    self.remember(key, data)
+    if self.conn is not None:
+      now = time.time()
+      self.conn.execute(
+        "INSERT OR REPLACE INTO images (key, version, fmt, data, created, "
+        "last_used) VALUES (?, ?, ?, ?, ?, ?)",
+        (key, render_version(), fmt, data, now, now))
+      self.write_used()
+      self.conn.commit()
+
+  def render(self, ast: Node, fmt: str = 'png', **options) -> bytes:
+    """ The image of ast in the format fmt. Render it on a miss, and
+        store the result. """
+    key = self.key(ast, fmt, options)
+    data = self.get(key)
+    if data is None:
+      data = render_image(ast, fmt, options)
+      self.put(key, data, fmt)
+    return data
+
+  def purge_stale(self) -> int:
+    """ Delete the stored images made by other renderer versions.
+        Return the number of deleted entries. """
+    if self.conn is None:
+      return 0
+    cur = self.conn.execute("DELETE FROM images WHERE version != ?",
+                            (render_version(),))
+    self.conn.commit()
+    return cur.rowcount
+
+  def clear(self) -> None:
+    self.memory.clear()
+    if self.conn is not None:
+      self.conn.execute("DELETE FROM images")
+      self.conn.commit()
+
+  def stats(self) -> Dict:
+    n_entry = len(self.memory) if self.conn is None else \
+      self.conn.execute("SELECT COUNT(*) FROM images").fetchone()[0]
+    n_lookup = self.n_hit + self.n_miss
+    return {'entries': n_entry, 'in_memory': len(self.memory),
+            'hits': self.n_hit, 'misses': self.n_miss,
+            'hit_rate': self.n_hit / n_lookup if n_lookup else 0.0}
+
+  def close(self) -> None:
+    if self.conn is not None:
+      self.flush()
+      self.conn.close()
+
+@functools.lru_cache(maxsize=None)
+def default_cache() -> RenderCache:
+  """ The cache shared by Node.draw_tree() and show_ast(). It is stored in
+      $PROOFMOOD_RENDER_CACHE, or else in ~/.cache/proofmood/render.sqlite3
+      if that can be created, or else in memory only. """
+  path = os.environ.get('PROOFMOOD_RENDER_CACHE')
+  if path is None:
+    dir_name = os.path.join(os.environ.get('XDG_CACHE_HOME') or
+                            os.path.expanduser('~/.cache'), 'proofmood')
+    path = os.path.join(dir_name, 'render.sqlite3')
+    try:
+      os.makedirs(dir_name, exist_ok=True)
+    except OSError:
+      path = None
+  try:
+    return RenderCache(path)
+  except sqlite3.Error:
+    return RenderCache()
+
+def show_ast(ast: Node, fmt: str = 'png', **options) -> None:
+  """ Display the cached image of ast in IPython. fmt is 'png' or 'svg'. """
+  from IPython.display import display, Image, SVG
+  data = default_cache().render(ast, fmt, **options)
+  display(SVG(data) if fmt == 'svg' else Image(data))
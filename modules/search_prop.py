@@ -1,19 +1,268 @@
+import collections
+import contextlib
+import functools
+import itertools
+import threading
+import weakref
+
 try:
   from modules.validate_prop import *
-except ImportError:
-  url = 'https://raw.githubusercontent.com/jhjeong314/Proofmood/main/modules'
-  import httpimport
-  with httpimport.remote_repo(url):
-    from validate_prop import *  
+except ImportError: # loaded as a top-level module, e.g. by httpimport
+  from validate_prop import *  
+
+UNDO_LIMIT = 1000 # number of edits kept for undo()
 
 def mykey(x: str):
   """ This is a key function for sorting the list of line numbers. """
   return int(x.split("-")[0])
 
+def undoable(method):
+  """ Decorator for the edit methods of ProofNodeS. The edit is recorded
+      as a single step for undo(), and undone if it raises an exception.
+      The op record of the edit (see log_op()) goes to the op log. """
+  @functools.wraps(method)
+  def wrapper(self, *args, **kwargs):
+    with self.recording():
+      if self.op_depth == 0:
+        self.op_record = None
+      self.op_depth += 1
+      try:
+        ret = method(self, *args, **kwargs)
+      finally:
+        self.op_depth -= 1
+      if self.op_depth == 0 and self.op_record is not None:
+        self.step_ops.append(self.op_record)
+      return ret
+  wrapper.undoable = True # the edit methods, see instrument.py
+  return wrapper
+
+def dump_nodes(p_node_li, cut_refs: Dict[int, list] = {}) -> list:
+  """ JSON-friendly records of the subtrees p_node_li, for op records.
+      A line is [label type, text] and a subproof is 
+      ['subproof', [records of the kids]]. The premises are written as
+      line numbers. A formula line whose premises refer to nodes cut out
+      of the proof is [label type, text, premise records], see 
+      dump_premises(). A node which was cut out of the proof is written
+      as cut_refs[id(node)] = ['cut', cut number, path in the cut], so
+      that the other copy inserts its own node, together with the 
+      premises which refer to it (see ProofNodeS.mark_removed()).
+      load_nodes() is the inverse. """
+  out = []
+  stack = [(p_node, out) for p_node in reversed(p_node_li)]
+  while stack:
+    p_node, dest = stack.pop()
+    label = p_node.label
+    if id(p_node) in cut_refs:
+      dest.append(cut_refs[id(p_node)])
+    elif label.type == LabelType.SUBPROOF:
+      kids = []
+      dest.append([label.type.value, kids])
+      stack.extend([(kid, kids) for kid in reversed(p_node.children)])
+    elif label.type == LabelType.FORMULA and isinstance(label.ann, Ann):
+      (ann_str, premises) = dump_premises(label.ann, cut_refs)
+      rec = [label.type.value, f"{label.formula_str()}\t .{ann_str}"]
+      dest.append(rec if premises is None else rec + [premises])
+    elif label.type == LabelType.FORMULA:
+      dest.append([label.type.value, f"{label}"])
+    else:
+      dest.append([label.type.value, label.line])
+  return out
+
+def dump_premises(ann: Ann, cut_refs: Dict[int, list] = {}) \
+      -> Tuple[str, list | None]:
+  """ The text of ann with all its premises, and the records of the 
+      premises if any of them refers to a node cut out of the proof, 
+      which the text of ann leaves out (see Ann.premise). A premise
+      record is a line number, or cut_refs[id(node)] for a node cut out.
+      Such a premise is written in the text by its last line number, so
+      that the text can be parsed, and load_premises() puts the nodes
+      back from the records. A premise referring to a cut which is no 
+      longer known is left out of the records. """
+  refs = ann.premise_refs
+  if not refs or all([isinstance(ref, str) or ref.removed_with is None
+                      for ref in refs]):
+    return (f"{ann}", None)
+  codes, premises = [], []
+  for ref in refs:
+    if isinstance(ref, str):
+      codes.append(ref)
+      premises.append(ref)
+    elif ref.removed_with is None:
+      codes.append(ref.line_num)
+      premises.append(ref.line_num)
+    else:
+      codes.append(ref.line_num or 
+                   ('1-2' if ref.label.type == LabelType.SUBPROOF else '1'))
+      if id(ref) in cut_refs:
+        premises.append(cut_refs[id(ref)])
+  return (f"{ann.rule.value} {','.join(codes)}", premises)
+
+def load_cut(rec: list, cuts: Dict[int, list]) -> ProofNode: # type: ignore
+  # the node of the record ['cut', cut number, path in the cut]
+  if rec[1] not in cuts:
+    raise ValueError(f"load_nodes(): cut {rec[1]} is not known.")
+  path = rec[2]
+  p_node = cuts[rec[1]][path[0]]
+  for i in path[1:]:
+    p_node = p_node.children[i]
+  return p_node
+
+def load_premises(ann: Ann, premises: list, 
+                  cuts: Dict[int, list] = {}) -> None:
+  """ Set the premises of ann from the records of dump_premises(). The
+      line numbers are bound to the nodes when ann is put into the 
+      proof, as those of the text are. """
+  ann.premise_refs = [ref if isinstance(ref, str) else load_cut(ref, cuts)
+                      for ref in premises]
+
+def load_nodes(data: list, cuts: Dict[int, list] = {}) \
+      -> List[ProofNode]: # type: ignore
+  """ Rebuild the subtrees from the records of dump_nodes(). cuts maps
+      cut numbers to the nodes cut out of the proof. The premises are 
+      bound to the nodes when the subtrees are inserted. """
+  out = []
+  preorder = []
+  stack = [(rec, out) for rec in reversed(data)]
+  while stack:
+    rec, dest = stack.pop()
+    if rec[0] == 'cut':
+      dest.append(load_cut(rec, cuts))
+      continue
+    (type_str, content) = rec[:2]
+    label_type = LabelType(type_str)
+    if label_type == LabelType.SUBPROOF:
+      p_node = ProofNode(NodeLabel())
+      stack.extend([(rec, p_node.children) for rec in reversed(content)])
+    else:
+      p_node = ProofNode(NodeLabel(label_type, content))
+      if len(rec) > 2:
+        load_premises(p_node.label.ann, rec[2], cuts)
+    dest.append(p_node)
+    preorder.append(p_node)
+  for p_node in reversed(preorder): # the kids have been counted first
+    if p_node.children:
+      p_node.n_lines = sum([kid.n_lines for kid in p_node.children])
+      for kid in p_node.children:
+        kid.parent = p_node
+  return out
+
+class ProofSnapshot:
+  """ The proof as it was when ProofNodeS.snapshot() was called, for 
+      readers, e.g., threads which render or check it while the proof is
+      being edited. Nothing is copied then. Until proof() is called, the
+      edits keep the old state of whatever they change here, see 
+      ProofNodeS.keep(), and the kids spliced, see ProofNodeS.splice(). 
+      proof() builds the copy from the nodes in the thread of the reader,
+      in O(number of lines) time, and the edits keep nothing after that. """
+  def __init__(self, source):
+    self.source = source
+    # the old __dict__ by id() of the objects changed since, with the 
+    # objects, so that the ids stay theirs
+    self.kept = {} # type: Dict[int, tuple]
+    # (parent, [(rank, kids deleted, number of kids inserted)]) by 
+    # id(parent) of the splices since; lock is held by a splice and by
+    # proof() while it reads the kids of a node
+    self.spliced = {} # type: Dict[int, tuple]
+    self.lock = threading.Lock()
+    self.copy = None # type: ProofNode | None
+
+  def keep(self, obj) -> None:
+    # called before obj is changed; only the first state is the old one
+    if self.copy is None and id(obj) not in self.kept:
+      self.kept[id(obj)] = (obj, obj.__dict__.copy())
+
+  def keep_splice(self, parent, rank: int, n_del: int, n_ins: int) -> None:
+    # called with lock held, before the kids are spliced
+    if self.copy is None:
+      self.spliced.setdefault(id(parent), (parent, []))[1].append(
+        (rank, parent.children[rank:rank + n_del], n_ins))
+
+  def state(self, obj) -> dict:
+    # The old state is kept before obj is changed, so a state read 
+    # before the check is either kept or still the old one.
+    state = obj.__dict__.copy()
+    kept = self.kept.get(id(obj))
+    return state if kept is None else kept[1]
+
+  def kids(self, p_node) -> list:
+    with self.lock:
+      kids = list(p_node.children)
+      splices = list(self.spliced.get(id(p_node), (None, []))[1])
+    for rank, removed, n_ins in reversed(splices):
+      kids[rank:rank + n_ins] = removed
+    return kids
+
+  def proof(self) -> ProofNode: # type: ignore
+    """ The copy of the proof, built by the first call. The copy has its
+        own nodes, labels and annotations, so that the line numbers and
+        the validation flags cached on them are not changed by the edits
+        of the proof. The formulas are shared, because they are never 
+        changed in place. The copy must not be edited while it is read. """
+    if self.copy is not None:
+      return self.copy
+    state = self.state(self.source)
+    proof = ProofNode(NodeLabel())
+    # the premises referring to the root refer to the copy
+    memo = {id(self.source): proof}
+    pairs = [(state, proof)]
+    stack = [(self.source, proof)]
+    while stack:
+      p_node, new = stack.pop()
+      for kid in self.kids(p_node):
+        new_kid = ProofNode(NodeLabel())
+        memo[id(kid)] = new_kid
+        pairs.append((self.state(kid), new_kid))
+        new.children.append(new_kid)
+        stack.append((kid, new_kid))
+    for state, new in pairs:
+      new.label = self.copy_label(state['label'], memo)
+      new.validated = state['validated']
+      new.removed_with = state['removed_with']
+    proof.build_index()
+    proof.index_dict = proof.build_index_dict()
+    self.copy = proof
+    self.kept, self.spliced = {}, {}
+    return proof
+
+  def copy_label(self, label, memo: Dict[int, ProofNode]): # NodeLabel type
+    new = NodeLabel.__new__(NodeLabel)
+    new.__dict__.update(self.state(label))
+    if isinstance(new.ann, Ann):
+      ann = Ann.__new__(Ann)
+      ann.__dict__.update(self.state(new.ann))
+      if ann.premise_refs is not None:
+        ann.premise_refs = [ref if isinstance(ref, str) else 
+                            self.copy_ref(ref, memo)
+                            for ref in ann.premise_refs]
+      new.ann = ann
+    return new
+
+  def copy_ref(self, ref, memo: Dict[int, ProofNode]): # ProofNode type
+    # a premise out of the proof keeps its old line_num and removed_with
+    if id(ref) not in memo:
+      new = ProofNode.__new__(ProofNode)
+      new.__dict__.update(self.state(ref))
+      new.children = []
+      new.parent = None
+      memo[id(ref)] = new
+    return memo[id(ref)]
+
 class ProofNodeS(ProofNode): # type: ignore
   ''' S stands for Search. This class supplies numerous methods for 
       proof editing and searching.
   '''
+  # attributes of the root which belong to the editing session rather 
+  # than to the proof, so that undo() and rollback() leave them alone
+  EDIT_STATE = ('journal', 'dirty', 'in_transaction', 
+                'undo_stack', 'redo_stack', 'op_log', 'step_ops',
+                'op_depth', 'op_record', 'rendered_rows', 'rendered_ok',
+                'row_of_line', 'n_invalid', 'redraw', 'shift_from',
+                'cuts', 'cut_of', 'n_cuts', 'cited_by', 'loose', 'views')
+  # attributes of the nodes which splice() keeps up to date, so that 
+  # undo() and rollback() leave them alone too
+  LINE_STATE = ('children', 'parent', 'slot', 'n_lines', 'line_tree',
+                'index', 'line_num', 'stale', '_index_dict')
+
   def __init__(self, p_node: ProofNode | None=None): # type: ignore
     if p_node is None: # type: ignore
       p_node = parse_fitch()
@@ -23,8 +272,67 @@ class ProofNodeS(ProofNode): # type: ignore
     self.children = p_node.children
     self.index = p_node.index
     self.line_num =p_node.line_num
-    self.index_dict = p_node.index_dict
+    self.stale = False
+    self.index_dict = p_node.index_dict # renewed here if p_node is stale
+    self.n_lines = p_node.n_lines
+    self.line_tree = p_node.line_tree
+    self.slot = None
+    self.parent = None
     self.validated = p_node.validated
+    self.removed_with = p_node.removed_with
+    self.proof_root = self
+    # journal of the running edit, see recording() and transaction()
+    self.journal = None # type: List[tuple] | None
+    # the edited parts of the running edit, see mark_dirty()
+    self.dirty = None # type: List[tuple] | None
+    self.in_transaction = False
+    # (journal, dirty) of the recorded edits, see undo() and redo()
+    self.undo_stack = collections.deque(maxlen=UNDO_LIMIT)
+    self.redo_stack = [] # type: List[tuple]
+    # op records of the edits for another copy of the proof, see 
+    # take_ops() and apply_ops()
+    self.op_log = [] # type: List[list]
+    self.step_ops = [] # type: List[list]
+    self.op_depth = 0
+    self.op_record = None # type: list | None
+    # the nodes cut out by the edits, by cut number, and the cut number
+    # by id(removed_with), see mark_removed() and dump_nodes()
+    self.cuts = collections.OrderedDict() # type: Dict[int, list]
+    self.cut_of = {} # type: Dict[int, int]
+    self.n_cuts = 0
+    # rows sent by the last render_delta(), whether the line of each row
+    # is validated, the row of each line and the number of lines which
+    # are not validated
+    self.rendered_rows = [] # type: List[str]
+    self.rendered_ok = [] # type: List[bool]
+    self.row_of_line = [] # type: List[int]
+    self.n_invalid = 0
+    # the lines to be rendered again by render_delta(), None for all of 
+    # them, and the first line moved by splice() since the last call
+    self.redraw = None # type: Dict[int, ProofNode] | None
+    self.shift_from = None # type: int | None
+    # the lines by id() of the nodes their premises refer to, and the 
+    # lines with premises referring to no node, see note_premises()
+    self.cited_by = {} # type: Dict[int, Dict[int, ProofNode]]
+    self.loose = {} # type: Dict[int, ProofNode]
+    # weak references to the snapshots not copied yet, see snapshot()
+    self.views = () # type: Tuple[weakref.ref, ...]
+    # The nodes now belong to self instead of p_node, and so do the
+    # premises referring to p_node.
+    for kid in self.children:
+      kid.parent = self
+    stack = list(self.children)
+    while stack:
+      node = stack.pop()
+      stack.extend(node.children)
+      for kid in node.children:
+        kid.parent = node
+      node.proof_root = self
+      ann = node.label.ann
+      if isinstance(ann, Ann) and ann.premise_refs:
+        ann.premise_refs = [self if ref is p_node else ref 
+                            for ref in ann.premise_refs]
+    self.note_premises(self.children)
   
   def fmla_to_validate(self) -> tuple:
     """ Return the ((line_num, tree_index), principal connective) 
@@ -55,29 +363,33 @@ class ProofNodeS(ProofNode): # type: ignore
 
     return tuple() # all formulas have been validated
   
+  SEARCH_MESSAGES = {True: "All formulas have been validated.",
+                     False: "Failed to complete the proof search."}
+
   def search_proof(self, verbosity: int=0) -> None:
     """ For each invalidated formula, starting from the last one, try to
         find and apply the appropriate inference rules to validate it.
-        verbosity = 0: no output. just obtain a new proof
+        verbosity = 0: no output but the result. just obtain a new proof
                   = 1: show messages
                   = 2: show messages and the proof trees    
+        The annotations added by a search are a single step for undo().
+        See run_search() for the search without the output.
     """
-    while True:
-      if (ret_val := self.fmla_to_validate()):
+    print(f"\n{self.SEARCH_MESSAGES[self.run_search(verbosity)]}\n")
+
+  def run_search(self, verbosity: int=0) -> bool:
+    """ The search of search_proof(). Return True iff all formulas have
+        been validated. Nothing is printed for verbosity = 0. """
+    with self.recording():
+      while (ret_val := self.fmla_to_validate()):
         for rule in RuleInfer:
           if self.try_rule(rule, ret_val, verbosity):
             # stop RuleInfer loop and go to the next invalidated formula
             break
-          else:
-            # try the next rule
-            continue
         else:
-          print("\nFailed to complete the proof search.\n")
-          break # while loop
-      else:
-        # proof search successfully completed
-        print("\nAll formulas have been validated.\n")
-        break # while loop
+          return False
+      # proof search successfully completed
+      return True
 
   def try_rule(self, rule: RuleInfer, ret_val, verbosity) -> bool: # type: ignore
     ''' ret_val is the return value of self.fmla_to_validate()
@@ -604,6 +916,543 @@ class ProofNodeS(ProofNode): # type: ignore
 
   #region Edit methods
 
+  @contextlib.contextmanager
+  def recording(self):
+    """ Record the edits of the with block in a journal, as a single step
+        for undo(). If an edit raises an exception, the edits of the 
+        block are undone and the exception is raised again. Every edit 
+        method records itself, so this is needed only to make several 
+        edits a single step without deferring the revalidation as 
+        transaction() does, e.g., in search_proof(). """
+    if self.journal is not None:
+      yield self
+      return
+    self.journal = []
+    self.dirty = []
+    self.step_ops = []
+    n_cuts = self.n_cuts
+    try:
+      yield self
+    except BaseException:
+      self.rollback()
+      # cut numbers must stay in step with the other copies of the proof
+      while self.n_cuts > n_cuts:
+        self.forget_cut(self.n_cuts)
+        self.n_cuts -= 1
+      raise
+    step = (self.journal, self.dirty)
+    self.journal = None
+    self.dirty = None
+    if step[0]:
+      self.undo_stack.append(step)
+      self.redo_stack.clear()
+    if len(self.step_ops) == 1:
+      self.op_log.append(self.step_ops[0])
+    elif self.step_ops:
+      self.op_log.append(['batch', self.step_ops])
+
+  @contextlib.contextmanager
+  def transaction(self):
+    """ Apply several edits as a single one, e.g.,
+          with proof.transaction():
+            proof.delete_nodes('7~9')
+            proof.insert_nodes(3, p_node_li)
+        Within the with block, the edit methods do not revalidate the
+        lines, and line numbers refer to the proof as edited so far.
+        At the end of the block, the lines are revalidated once, see
+        validate_dirty().
+        If an edit raises an exception, e.g., when a subproof is 
+        inserted into a hypothesis, all the edits of the block are undone
+        and the exception is raised again. A nested transaction is a part
+        of the outer one. The whole transaction is a single step for 
+        undo(). """
+    if self.in_transaction:
+      yield self
+      return
+    with self.recording():
+      self.in_transaction = True
+      try:
+        yield self
+      finally:
+        self.in_transaction = False
+      self.validate_dirty(self.dirty)
+
+  def rollback(self) -> None:
+    """ Undo the edits of the running recording or transaction. """
+    journal, self.journal = self.journal, None
+    dirty, self.dirty = self.dirty, None
+    self.step_ops = []
+    self.replay(journal)
+    # The edits may have failed within the revalidation, which sets 
+    # validated of untouched lines too.
+    self.validate_dirty(dirty)
+
+  def undo(self) -> bool:
+    """ Undo the last edit, or the last transaction as a whole. 
+        Only the nodes, labels and annotations touched by the edit are
+        restored, and the lines the edit may have affected are 
+        revalidated. Return False if there is nothing to undo. """
+    if self.undo_redo(self.undo_stack, self.redo_stack):
+      self.op_log.append(['undo'])
+      return True
+    return False
+
+  def redo(self) -> bool:
+    """ Redo the last edit undone by undo(). Any other edit clears the 
+        edits to be redone. Return False if there is nothing to redo. """
+    if self.undo_redo(self.redo_stack, self.undo_stack):
+      self.op_log.append(['redo'])
+      return True
+    return False
+
+  def undo_redo(self, stack_from, stack_to) -> bool:
+    if self.journal is not None:
+      raise Exception("undo_redo(): Cannot undo or redo within an edit.")
+    if not stack_from:
+      return False
+    journal, dirty = stack_from.pop()
+    stack_to.append((self.replay(journal), dirty))
+    self.validate_dirty(dirty)
+    return True
+
+  def replay(self, journal) -> List[tuple]:
+    """ Restore the states recorded in journal in reverse order. 
+        Return the journal of the states replaced, which replay() 
+        restores in turn. """
+    reverse = []
+    for obj, state in reversed(journal):
+      if isinstance(state, tuple): # the kids spliced, see splice()
+        rank, removed, inserted = state
+        self.splice(obj, rank, len(inserted), removed)
+        reverse.append((obj, (rank, inserted, removed)))
+        continue
+      reverse.append(self.state_of(obj))
+      if self.views:
+        self.keep(obj)
+      if isinstance(obj, ProofNode):
+        self.note_redraw([obj])
+      keep = {key: obj.__dict__[key] for key in self.EDIT_STATE} \
+             if obj is self else {}
+      if isinstance(obj, ProofNode):
+        keep.update({key: obj.__dict__[key] for key in self.LINE_STATE
+                     if key in obj.__dict__})
+      obj.__dict__.clear()
+      obj.__dict__.update(state)
+      obj.__dict__.update(keep)
+    return reverse
+
+  def state_of(self, obj) -> tuple:
+    # journal entry: the object with a copy of its attributes
+    return (obj, obj.__dict__.copy())
+
+  def touch(self, *objs) -> None:
+    """ Record the state of objs(ProofNode, NodeLabel or Ann) before 
+        they are changed, so that rollback() and undo() can restore it.
+        The kids of the nodes are recorded by splice(). 
+        Does nothing outside recording(), but for the snapshots. """
+    if self.views:
+      self.keep(*objs)
+    if self.journal is None:
+      return
+    for obj in objs:
+      self.journal.append(self.state_of(obj))
+
+  def touch_subtrees(self, p_node_li) -> None:
+    # touch() all the nodes in p_node_li with their labels and annotations
+    if self.journal is None:
+      return
+    stack = list(p_node_li)
+    while stack:
+      p_node = stack.pop()
+      stack.extend(p_node.children)
+      self.touch(p_node, p_node.label)
+      if isinstance(p_node.label.ann, Ann):
+        self.touch(p_node.label.ann)
+
+  def splice(self, parent, rank: int, n_del: int, p_node_li) -> list:
+    """ ProofNode.splice() recorded in the journal as 
+        (parent, (rank, kids deleted, kids inserted)). 
+        The lines from the first kid deleted or inserted on get new line
+        numbers, and so may parent and its ancestors, which is noted 
+        for render_delta(). """
+    if self.redraw is not None and self.place(parent):
+      first = int(parent.line_num.split('-')[0])
+      if rank > 0:
+        first += parent.get_line_tree().prefix(rank)
+      self.shift_from = first if self.shift_from is None \
+                        else min(self.shift_from, first)
+      node = parent
+      while node is not None:
+        self.note_redraw(self.citing(node).values())
+        node = node.parent
+    if not self.views:
+      removed = super().splice(parent, rank, n_del, p_node_li)
+    else: # the snapshots read the kids while they are spliced
+      with contextlib.ExitStack() as stack:
+        for view in self.live_views():
+          stack.enter_context(view.lock)
+          view.keep_splice(parent, rank, n_del, len(p_node_li))
+        removed = super().splice(parent, rank, n_del, p_node_li)
+    if self.journal is not None:
+      self.journal.append((parent, (rank, removed, list(p_node_li))))
+    return removed
+
+  def validate_line(self, p_node) -> None:
+    if self.views:
+      self.keep(p_node)
+    super().validate_line(p_node)
+
+  def mark_dirty(self, p_node_li, around=None) -> None:
+    """ Record the subtrees p_node_li as edited, and around as the node 
+        whose kids have changed by the edit, for validate_dirty() at the
+        end of the transaction and after undo(). """
+    if self.journal is not None:
+      self.dirty.append((list(p_node_li), around))
+
+  def revalidate(self, p_node_li, around=None) -> None:
+    """ Revalidate the lines affected by an edit of the subtrees 
+        p_node_li, which have been inserted into, deleted from or changed
+        in the kids of around. Within a transaction, this is put off 
+        until its end. """
+    self.mark_dirty(p_node_li, around)
+    if not self.in_transaction:
+      self.validate_dirty([(p_node_li, around)])
+
+  def validate_dirty(self, dirty) -> None:
+    """ Revalidate the lines affected by the edits in dirty, which is a
+        list of (p_node_li, around) from mark_dirty(): the lines in the
+        subtrees p_node_li, the lines whose premises refer to any node in 
+        them or to around and its ancestors, and the lines with premises 
+        referring to no node. The other lines keep their premises as 
+        they were, so they need not be revalidated however far they 
+        have moved. """
+    lines = {} # type: Dict[int, ProofNode]
+    for p_node_li, around in dirty or []:
+      stack = list(p_node_li)
+      while stack:
+        p_node = stack.pop()
+        stack.extend(p_node.children)
+        if not p_node.children:
+          lines[id(p_node)] = p_node
+        lines.update(self.citing(p_node))
+      while around is not None:
+        lines.update(self.citing(around))
+        around = around.parent
+    for key, p_node in self.loose.items():
+      ann = p_node.label.ann
+      if isinstance(ann, Ann) and ann.premise_refs and \
+         any([isinstance(ref, str) for ref in ann.premise_refs]):
+        lines[key] = p_node
+    for p_node in lines.values():
+      if self.place(p_node): # still in the proof
+        self.validate_line(p_node)
+    self.note_redraw(lines.values())
+
+  def note_premises(self, p_node_li) -> None:
+    """ Register the lines in the subtrees p_node_li by the nodes their
+        premises refer to, for citing(). An entry is checked when it is 
+        used and never removed, because undo() may put back the 
+        annotation it came from. """
+    stack = list(p_node_li)
+    while stack:
+      p_node = stack.pop()
+      stack.extend(p_node.children)
+      ann = p_node.label.ann
+      if isinstance(ann, Ann) and ann.premise_refs:
+        for ref in ann.premise_refs:
+          if isinstance(ref, str):
+            self.loose[id(p_node)] = p_node
+          else:
+            self.cited_by.setdefault(id(ref), {})[id(p_node)] = p_node
+
+  def citing(self, p_node) -> Dict[int, ProofNode]: # type: ignore
+    # the lines whose premises refer to p_node now, by id()
+    lines = {}
+    for key, line in self.cited_by.get(id(p_node), {}).items():
+      ann = line.label.ann
+      if isinstance(ann, Ann) and ann.premise_refs and \
+         any([ref is p_node for ref in ann.premise_refs]):
+        lines[key] = line
+    return lines
+
+  def log_op(self, record: list) -> None:
+    """ Set the op record of the running edit. An edit made of other 
+        edits, e.g., move_nodes(), logs itself before calling them, and
+        only the first record of a top level edit is kept. 
+        The records are JSON-friendly lists:
+          ['insert', parent tree index, rank, dump_nodes() records]
+          ['delete', chunk]
+          ['move', chunk, line_num, go_above]
+          ['duplicate', chunk, line_num, go_above]
+          ['annotate', line_num, annotation text(, premise records)],
+            see dump_premises()
+          ['update', line_num, formula text]
+          ['clear', line_num]
+          ['replace', line_num, dump_nodes() record]
+          ['undo'], ['redo']
+          ['batch', [records]] for a transaction or a recording() """
+    if self.op_record is None:
+      self.op_record = record
+
+  def snapshot(self) -> ProofSnapshot:
+    """ Return a copy of the proof for readers in O(1) time, see 
+        ProofSnapshot. Its proof() gives the proof as it is now, 
+        whatever edits come in between. It must be called between 
+        edits, not within one. """
+    view = ProofSnapshot(self)
+    self.views = tuple([ref for ref in self.views if ref() is not None]) \
+                 + (weakref.ref(view),)
+    return view
+
+  def live_views(self) -> List[ProofSnapshot]:
+    # the snapshots not copied yet, which keep the old states
+    views = [ref() for ref in self.views]
+    views = [view for view in views 
+             if view is not None and view.copy is None]
+    if len(views) < len(self.views):
+      self.views = tuple([weakref.ref(view) for view in views])
+    return views
+
+  def keep(self, *objs) -> None:
+    # Keep the state of objs for the snapshots, before it is changed.
+    for view in self.live_views():
+      for obj in objs:
+        view.keep(obj)
+
+  def take_ops(self) -> List[list]:
+    """ Return the op records of the edits since the last call, e.g., to
+        send them to a server which keeps a copy of the proof. """
+    ops, self.op_log = self.op_log, []
+    return ops
+
+  def apply_ops(self, ops: List[list]) -> None:
+    """ Apply the op records from take_ops() of another copy of the 
+        proof. The copies must have been equal before those edits, and
+        they are equal again afterwards, undo and redo stacks included. """
+    for op in ops:
+      self.apply_op(op)
+
+  def apply_op(self, op: list) -> None:
+    name, args = op[0], op[1:]
+    match name:
+      case 'insert':
+        (parent_idx, rank, data) = args
+        self.insert_at(parent_idx, rank, load_nodes(data, self.cuts))
+      case 'delete':
+        self.delete_nodes(*args)
+      case 'move':
+        self.move_nodes(*args)
+      case 'duplicate':
+        self.duplicate_nodes(*args)
+      case 'annotate':
+        ann = Ann(args[1])
+        if len(args) > 2:
+          load_premises(ann, args[2], self.cuts)
+        self.annotate(args[0], ann)
+      case 'update':
+        self.update_formula(args[0], Formula(parse_ast(args[1])))
+      case 'clear':
+        self.clear_node(args[0])
+      case 'replace':
+        self.replace_node(args[0], load_nodes([args[1]], self.cuts)[0])
+      case 'undo':
+        self.undo()
+      case 'redo':
+        self.redo()
+      case 'batch':
+        with self.transaction():
+          for sub_op in args[0]:
+            self.apply_op(sub_op)
+      case _:
+        raise ValueError(f"apply_op(): unknown operation '{name}'")
+
+  def forget_cut(self, cut_no: int) -> None:
+    if cut_no in self.cuts:
+      del self.cut_of[id(self.cuts.pop(cut_no)[0])]
+
+  def cut_refs(self, p_node_li) -> Dict[int, list]:
+    """ The records of dump_nodes() for the nodes in the subtrees 
+        p_node_li which were cut out of the proof and are still known by
+        cut number. A record is ['cut', cut number, path], where path is
+        the list of ranks leading to the node within the cut. """
+    refs = {}
+    paths = {} # type: Dict[int, Dict[int, list]]
+    stack = list(p_node_li)
+    while stack:
+      p_node = stack.pop()
+      rec = self.cut_record(p_node, paths)
+      if rec is not None:
+        refs[id(p_node)] = rec
+      else:
+        stack.extend(p_node.children)
+    return refs
+
+  def premise_cut_refs(self, objs) -> Dict[int, list]:
+    """ The records of cut_refs() for the nodes cut out of the proof 
+        which the annotations of objs (subtrees or Ann objects) refer
+        to, see dump_premises(). """
+    refs = {}
+    paths = {} # type: Dict[int, Dict[int, list]]
+    stack = list(objs)
+    while stack:
+      obj = stack.pop()
+      if isinstance(obj, ProofNode):
+        stack.extend(obj.children)
+        obj = obj.label.ann
+      if isinstance(obj, Ann) and obj.premise_refs:
+        for ref in obj.premise_refs:
+          if not isinstance(ref, str) and ref.removed_with is not None:
+            rec = self.cut_record(ref, paths)
+            if rec is not None:
+              refs[id(ref)] = rec
+    return refs
+
+  def cut_record(self, p_node, paths: Dict[int, Dict[int, list]]) \
+        -> list | None:
+    # ['cut', cut number, path] of p_node, or None if p_node is not in a
+    # cut known by cut number. paths caches the paths by cut number.
+    cut_no = self.cut_of.get(id(p_node.removed_with))
+    if cut_no is None:
+      return None
+    if cut_no not in paths:
+      paths[cut_no] = {}
+      walk = [(node, [k]) for k, node in enumerate(self.cuts[cut_no])]
+      while walk:
+        node, path = walk.pop()
+        paths[cut_no][id(node)] = path
+        walk.extend([(kid, path + [i]) 
+                     for i, kid in enumerate(node.children)])
+    path = paths[cut_no].get(id(p_node))
+    return None if path is None else ['cut', cut_no, path]
+
+  def line_code(self, pos: int | str | List[int]) -> str:
+    """ The line number of the node at pos for an op record. A tree 
+        index is converted from the line counts, so that it is right 
+        even while the line numbers are stale. """
+    if not isinstance(pos, list):
+      return str(pos)
+    p_node = self.get_p_node(pos)
+    first = self.first_line(pos)
+    if p_node.children:
+      return f"{first}-{first + p_node.n_lines - 1}"
+    return str(first)
+
+  def fresh_premises(self, objs) -> None:
+    """ Renew the line numbers of the nodes the annotations of objs
+        (subtrees or Ann objects) refer to, so that their premises can be
+        written in op records. """
+    if not self.stale:
+      return
+    stack = list(objs)
+    while stack:
+      obj = stack.pop()
+      if isinstance(obj, ProofNode):
+        stack.extend(obj.children)
+        obj = obj.label.ann
+      if isinstance(obj, Ann) and obj.premise_refs:
+        for ref in obj.premise_refs:
+          if not isinstance(ref, str):
+            self.place(ref)
+
+  def render_delta(self) -> dict:
+    """ The rows of build_fitch_rows() which changed since the last call,
+        see rows_delta(). The first call gives all the rows. After that,
+        only the rows from the first line moved by the edits on, see 
+        splice(), and the lines noted by note_redraw() are rendered 
+        again, with the line numbers from the line counts. So an edit 
+        costs O(rows moved or changed * depth * log(number of kids)) 
+        time, without refresh_index(), which would also drop the 
+        LineTrees. n_invalid is kept up to date as well. """
+    start = self.shift_from
+    redraw = self.redraw
+    self.shift_from = None
+    self.redraw = {}
+    if redraw is None: # render all the rows
+      start = 1
+      redraw = {}
+    rows, row_ok = self.rendered_rows, self.rendered_ok
+    changed = {} # type: Dict[int, str]
+    if start is not None:
+      start = min(start, len(self.row_of_line) + 1)
+      r_start = self.row_of_line[start - 2] + 1 if start > 1 else 0
+      old_rows = rows[r_start:]
+      self.n_invalid -= row_ok[r_start:].count(False)
+      del rows[r_start:], row_ok[r_start:], self.row_of_line[start - 1:]
+      for row, p_node in self.iter_rows(start):
+        pos = len(rows)
+        if pos - r_start >= len(old_rows) or old_rows[pos - r_start] != row:
+          changed[pos] = row
+        rows.append(row)
+        ok = True
+        if p_node is not None:
+          self.row_of_line.append(pos)
+          ok = bool(p_node.validated)
+          if start > 1: # the premises citing p_node may show a new number
+            node = p_node
+            while node is not self:
+              redraw.update(self.citing(node))
+              if node.index[-1] > 0:
+                break
+              node = node.parent
+        row_ok.append(ok)
+        self.n_invalid += not ok
+    for p_node in redraw.values():
+      if p_node.children or not self.place(p_node):
+        continue
+      l_num = int(p_node.line_num)
+      if start is not None and l_num >= start:
+        continue # rendered above
+      pos = self.row_of_line[l_num - 1]
+      row = self.line_row(p_node)
+      if row != rows[pos]:
+        rows[pos] = changed[pos] = row
+      ok = bool(p_node.validated)
+      self.n_invalid += row_ok[pos] - ok
+      row_ok[pos] = ok
+    return {'n_rows': len(rows), 
+            'changed': [[pos, changed[pos]] for pos in sorted(changed)]}
+
+  def note_redraw(self, p_node_li) -> None:
+    # the lines in p_node_li are to be rendered again by render_delta()
+    if self.redraw is None:
+      return
+    for p_node in p_node_li:
+      self.redraw[id(p_node)] = p_node
+    if len(self.redraw) > self.n_lines:
+      self.redraw = None # cheaper to render them all
+
+  def iter_rows(self, start: int = 1):
+    """ Yield (row, line) for the rows of build_fitch_rows() from the row
+        of line number `start` on, where line is the leaf of the row, or
+        None for the row '├─' before the first conclusion of a subproof.
+        The line numbers come from the line counts, see iter_lines(). """
+    for p_node in self.iter_lines(start):
+      seps = []
+      node = p_node
+      while node is not self:
+        up = node.parent
+        k = node.index[-1]
+        # the first conclusion follows the hypotheses
+        if not node.label.is_hyp and \
+           (k == 0 or up.children[k - 1].label.is_hyp) and \
+           all([kid.label.is_hyp for kid in up.children[:k]]):
+          seps.append(VERT * (len(up.index) - 1) + '├─')
+        if k > 0:
+          break
+        node = up
+      for row in reversed(seps):
+        yield (row, None)
+      yield (self.line_row(p_node), p_node)
+
+  def line_row(self, p_node) -> str:
+    # the row of build_fitch_rows() for a leaf whose line_num is up to date
+    if self.stale: 
+      self.fresh_premises([p_node])
+    level = len(p_node.index) - 1
+    if p_node.label.type == LabelType.SUBPROOF: # empty subproof
+      level += 1
+    return VERT * level + f'{p_node.line_num}. ' + p_node.line_text(True)
+
   def insert_node(self, pos: int | str | List[int], 
           p_node: ProofNode | None=None, # type: ignore
           go_above: bool=True, level_down: bool=False) -> None:
@@ -614,6 +1463,7 @@ class ProofNodeS(ProofNode): # type: ignore
       p_node_li = [] # later, this will be a list of a single blank line
     self.insert_nodes(pos, p_node_li, go_above, level_down)
 
+  @undoable
   def insert_nodes(self, pos: int | str | List[int], 
           p_node_li: List[ProofNode]=[], # type: ignore
           go_above: bool=True, level_down: bool=False) -> None:
@@ -636,16 +1486,16 @@ class ProofNodeS(ProofNode): # type: ignore
         one formula.
         
       As the result of the insertion, the lines below the insertion node
-        are shifted, and we have to update line_num and index, which is
-        easily done by the following:
-          self.build_index()
-          self.index_dict = self.build_index_dict()
-      But updating the premises of the shifted lines needs some work,
-        and we do it by calling self.adjust_premises() method. """
+        are shifted. Only the line counts of the ancestors are updated
+        here by self.splice(); line_num, index and index_dict are
+        renewed lazily when they are needed next.
+      The premises of the annotations refer to nodes rather than line
+        numbers (see Ann.premise), so they follow the shifted lines
+        without being rewritten. Only the premises of the inserted nodes
+        are bound to the nodes of self. """
     # work on the destination node and its parent
     p_node_dest = self.get_p_node(pos)
     dest_idx = p_node_dest.index
-    dest_ln = p_node_dest.line_num
     assert len(dest_idx) > 1, \
       f"insert_nodes(): You cannot insert a node at the root."
     dest_in_hyp = p_node_dest.label.is_hyp
@@ -688,9 +1538,9 @@ class ProofNodeS(ProofNode): # type: ignore
             rank_insert = dest_idx[-2]
             dest_in_hyp = False
             if p_node.label.type == LabelType.BLANK_HYP:
-              p_node.label.type = LabelType.BLANK_CONC
-              p_node.label.is_hyp = False
-              p_node_li = [p_node]
+              # a new blank line, so that p_node stays as it is
+              label0 = NodeLabel(type=LabelType.BLANK_CONC)
+              p_node_li = [ProofNode(label=label0)]
         else:
           # inserting any node below a hypothesis is not allowed.
           raise Exception("insert_nodes(): Cannot insert any node below"
@@ -709,27 +1559,50 @@ class ProofNodeS(ProofNode): # type: ignore
       else: # insert below the destination node
         rank_insert += 1
 
+    self.insert_at(dest_idx_parent, rank_insert, p_node_li)
+
+  @undoable
+  def insert_at(self, parent_idx: List[int], rank: int,
+                p_node_li: List[ProofNode]) -> None: # type: ignore
+    """ Insert p_node_li as they are into the kids of the node at tree
+        index parent_idx, so that the first of them has the given rank.
+        This is the last step of insert_nodes(), which decides where 
+        and how the nodes go. """
+    parent_node = self.get_p_node(parent_idx)
+    # A node still in the proof goes in as a copy, so that no node has
+    # two parents, e.g., a line left blank by cut_nodes().
+    p_node_li = list(p_node_li)
+    kept = [k for k, p_node in enumerate(p_node_li) 
+            if self.in_proof(p_node)]
+    if kept:
+      copies = self.copy_subtrees([p_node_li[k] for k in kept])
+      for k, p_node in zip(kept, copies):
+        p_node_li[k] = p_node
+    self.touch_subtrees(p_node_li)
+    self.rebind_premises(p_node_li)
+    cut_refs = self.cut_refs(p_node_li) if self.op_record is None else {}
     # the insertion is done here
-    parent_node.children[rank_insert:rank_insert] = p_node_li
+    self.splice(parent_node, rank, 0, p_node_li)
 
-    self.build_index()
-    self.index_dict = self.build_index_dict()
-    n_lines = sum([num_nodes(p_n) for p_n in p_node_li]) 
-    self.adjust_premises(dest_idx, dest_ln, n_lines, 
-                         opt='insert', go_above=go_above)
-    #^ Actually, it would have been a little bit easier if we adjusted 
-    #^ premises before the insertion action.
+    self.mark_removed(p_node_li, None)
+    self.bind_premises(p_node_li)
+    self.note_premises(p_node_li)
+    if self.op_record is None:
+      self.fresh_premises(p_node_li)
+      cut_refs.update(self.premise_cut_refs(p_node_li))
+      self.log_op(['insert', list(parent_idx), rank, 
+                   dump_nodes(p_node_li, cut_refs)])
 
-    self.validate_all()
+    self.revalidate(p_node_li, parent_node)
 
   def delete_node(self, pos: int | str | List[int], bReturn=False):
     ''' This method utilizes the delete_nodes() method. '''
     if isinstance(pos, list):
-      p_node = self.get_p_node(pos)
-      pos = p_node.line_num
+      pos = self.line_code(pos)
 
     self.delete_nodes(pos, bReturn)
   
+  @undoable
   def delete_nodes(self, chunk, bReturn=False):
     """ Delete the nodes in the chunk. 
       `chunk` is a string that looks like 'a~b', where 
@@ -743,138 +1616,153 @@ class ProofNodeS(ProofNode): # type: ignore
       one conclusion. Therefore, when delete all the lines of the 
       hypothesis or the conclusion section of a subproof, we leave a 
       blank line there.
-        As the result of the insertion, the lines below the insertion 
-      node are shifted, and we have to update line_num and index, which 
-      is easily done by the following:
-          self.build_index()
-          self.index_dict = self.build_index_dict()
-      But updating the premises of the shifted lines needs some work,
-        and we do it by calling self.adjust_premises() method. """
+        As the result of the deletion, the lines below the deleted 
+      nodes are shifted. Only the line counts of the ancestors are updated
+      here by self.splice(); line_num, index and index_dict are
+      renewed lazily when they are needed next.
+      The premises referring to the deleted nodes are left out of the 
+      annotations of the remaining lines (see Ann.premise). They come 
+      back if the nodes are inserted again, e.g., by move_nodes(). """
+    self.log_op(['delete', str(chunk)])
     # Work on the nodes to be deleted.
     p_node_del_li = self.get_p_node_li(chunk)
     del_idx_li = [p_node.index for p_node in p_node_del_li]
-    del_ln_li = [p_node.line_num for p_node in p_node_del_li]
     parent_idx = del_idx_li[0][:-1]
     parent_node = self.get_p_node(parent_idx)
     # If there is only one hypothesis or one conclusion, then we cannot
     # delete it. Instead, we clear it.  To handle this, we prepare some 
     # variables here.
-    n_hyp = parent_node.num_nodes_hyp()
-    n_conc = parent_node.num_nodes_conc()
-    n_hyp_del = sum([p_node.label.is_hyp for p_node in p_node_del_li])
+    # is_hyp is None for a line whose annotation could not be parsed
+    n_hyp_del = sum([bool(p_node.label.is_hyp) for p_node in p_node_del_li])
     n_conc_del = len(p_node_del_li) - n_hyp_del
 
     rank_s = del_idx_li[0][-1]
     rank_e = del_idx_li[-1][-1] # = rank_s + len(p_node_del_li) - 1
+    # n_hyp and n_conc are needed only when all the hypotheses or all
+    # the conclusions are deleted, which the kids left tell soon.
+    kids = parent_node.children
+    def is_hyp_left():
+      for i in itertools.chain(range(rank_s), range(rank_e + 1, len(kids))):
+        yield kids[i].label.is_hyp
+    n_hyp = n_hyp_del if n_hyp_del > 0 and not any(is_hyp_left()) else -1
+    n_conc = n_conc_del if n_conc_del > 0 and all(is_hyp_left()) else -1
+    if n_conc != -1:
+      n_hyp = len(kids) - n_conc
+
+    self.touch_subtrees(p_node_del_li)
 
-    n_lines_sub = 0
     # delete hypotheses
-    if n_hyp_del == n_hyp: # we must leave a blank hyp in this case
+    # A hyp below the conclusions is not cleared in place of the first
+    # line, which may be a subproof.
+    if n_hyp_del == n_hyp and kids[0].label.is_hyp:
+      # we must leave a blank hyp in this case
       self.clear_node(parent_idx + [0])
-      del parent_node.children[1:n_hyp]
+      self.splice(parent_node, 1, n_hyp - 1, [])
       n_hyp_del = n_hyp - 1
-      n_lines_sub -= 1
     elif n_hyp_del > 0: # easier case
-      del parent_node.children[rank_s:rank_s+n_hyp_del]
+      self.splice(parent_node, rank_s, n_hyp_del, [])
     # delete conclusions
     if n_conc_del == n_conc: # we must leave a blank conc in this case
       self.clear_node(parent_idx + [max(s_conc := n_hyp - n_hyp_del, 1)])
-      del parent_node.children[s_conc+1:]
-      n_lines_sub -= 1
+      self.splice(parent_node, s_conc + 1, 
+                  len(parent_node.children) - s_conc - 1, [])
     elif n_conc_del > 0: 
       # need some work here because hypotheses may have been deleted
       s_conc = rank_e - n_hyp_del - n_conc_del + 1
       e_conc = rank_e - n_hyp_del + 1
-      del parent_node.children[s_conc:e_conc]
-
-    self.build_index()
-    self.index_dict = self.build_index_dict()
-    n_lines = sum([num_nodes(p_n) for p_n in p_node_del_li]) + n_lines_sub
-    n_del_nodes = len(p_node_del_li)
+      self.splice(parent_node, s_conc, e_conc - s_conc, [])
 
-    self.adjust_premises(del_idx_li[0], del_ln_li[0], n_lines, 
-                        opt='delete', n_del_nodes=n_del_nodes)
-    self.validate_all()
+    # the cleared nodes stay in the proof
+    removed = [p_node for p_node in p_node_del_li if p_node.parent is None]
+    if removed:
+      self.mark_removed(removed, removed[0])
+    self.revalidate(p_node_del_li, parent_node)
 
     if bReturn:
       return p_node_del_li
 
-  def adjust_premises(self, dest_idx, dest_ln: str, n_lines, 
-                      opt, go_above=True, n_del_nodes=1) -> None:
-    ''' When a node is inserted or deleted, we need to adjust the premises 
-      in the annotations of the lines after dest_ln.
-        opt is either 'insert' or 'delete'.
-        dest_ln is a string which represents a position of a line or 
-      a subproof. In the latter case, and in this case only, the value of
-      the argument n_lines is >= 2. 
-        This method is not recursively called. It calls the Ann class's
-      adjust_premises() method.
-    '''
-    
-    if '-' in dest_ln: 
-      dest_ln = dest_ln.split('-')[0] # hyp line of the subproof
-    for v_ln in self.index_dict: # type: ignore
-      # self.index_dict is of the tree after the insertion/deletion
-      p_node = self.get_p_node(v_ln)
-      if p_node.label.type != LabelType.FORMULA or p_node.label.is_hyp:
-        continue
-      if not int(v_ln) >= int(dest_ln):
-        #^ do not use is_earlier() here
-        continue
-      ann = p_node.label.ann
-      if not isinstance(ann, Ann) or not ann.premise:
-        continue
-      if opt == 'delete': # easier case
-        ann.adjust_premises(self, dest_ln, v_ln, n_lines, opt)
-      elif opt == 'insert':
-        if int(v_ln) >= (e := int(dest_ln) + n_lines):
-           dest_idx1 = dest_idx[:-1] + [dest_idx[-1] + 1]
-           if go_above or (int(v_ln) > e and 
-                           not li_extends(p_node.index, dest_idx1)):
-             ann.adjust_premises(self, dest_ln, v_ln, n_lines, opt)
-      else:
-        raise Exception("adjust_premises(): opt must be either"
-                        " 'insert' or 'delete'.")
+  def mark_removed(self, p_node_li, removed_with) -> None:
+    """ Set removed_with of the nodes and annotations in the subtrees
+        p_node_li. removed_with is None when they are put into the proof,
+        and the first removed node when they are cut out of it. 
+        The nodes cut out are kept by cut number for op records, which
+        refer to them when they are inserted again. """
+    if removed_with is not None:
+      self.n_cuts += 1
+      self.cuts[self.n_cuts] = list(p_node_li)
+      self.cut_of[id(removed_with)] = self.n_cuts
+      if len(self.cuts) > UNDO_LIMIT:
+        self.forget_cut(next(iter(self.cuts)))
+    stack = list(p_node_li)
+    while stack:
+      p_node = stack.pop()
+      stack.extend(p_node.children)
+      p_node.removed_with = removed_with
+      if isinstance(p_node.label.ann, Ann):
+        p_node.label.ann.removed_with = removed_with
 
+  @undoable
   def update_formula(self, pos, new_fmla: Formula) -> None: # type: ignore
-    import copy
     """ The line can be a formula(hyp or conc), a comment or a blank line. 
-        Non-formula line becomes a formula line, and the content
-          is lost. 
+        Non-formula line becomes a formula line with a blank 
+          annotation, and the content is lost. 
         Formula line's formula is replaced with new_fmla.
-        Its ann remains unchanged. """
+        Its ann remains unchanged. The line shares the ast of new_fmla,
+        which is never changed in place, see Formula.__deepcopy__(). """
+    self.log_op(['update', self.line_code(pos), f"{new_fmla}"])
     p_node = self.get_p_node(pos)
+    self.touch(p_node.label)
+    if p_node.label.type != LabelType.FORMULA:
+      # a blank annotation, as clear_node() gives
+      p_node.label.ann = Ann('hyp') if p_node.label.is_hyp else Ann()
     p_node.label.type = LabelType.FORMULA
-    p_node.label.formula = copy.deepcopy(new_fmla) # type: ignore
+    p_node.label.formula = Formula(new_fmla.ast) # type: ignore
     p_node.label.line = f"{new_fmla}\t .{p_node.label.ann}" # type: ignore
-    self.validate_all()
+    self.revalidate([p_node], p_node.parent)
 
+  @undoable
   def annotate(self, pos, ann: Ann) -> None: # type: ignore
     import copy
     """ Annotate the formula at pos with ann.
         pos must be the t_idx of a conclusion formula node. """
     p_node = self.get_p_node(pos)
-    l_num = p_node.line_num
+    l_num = self.line_code(pos)
     assert p_node.label.type == LabelType.FORMULA, \
       f"annotate(): pos {pos} is not a formula node."
     assert not p_node.label.is_hyp, \
       f"annotate(): pos '{l_num}' is a hypothesis, which cannot be annotated."
     assert isinstance(ann, Ann), \
       f"annotate(): ann must be an Ann object."
+    if self.op_record is None:
+      self.fresh_premises([ann])
+      (ann_str, premises) = dump_premises(ann, self.premise_cut_refs([ann]))
+      self.log_op(['annotate', self.line_code(pos), ann_str.strip()] + 
+                  ([premises] if premises is not None else []))
+    self.touch(p_node, p_node.label)
     p_node.label.ann = copy.deepcopy(ann)
-    p_node.validated = self.verified(l_num)
+    self.bind_premises([p_node])
+    self.note_premises([p_node])
+    # the formula is kept, so the lines citing p_node need no revalidation
+    self.mark_dirty([p_node])
+    self.note_redraw([p_node])
+    if not self.in_transaction:
+      p_node.line_num = l_num
+      self.validate_line(p_node)
 
   def clear_ann(self, pos) -> None: 
     """ Clear the annotation at pos, which is a formula node. """
     self.annotate(pos, Ann())
     
+  @undoable
   def clear_node(self, pos) -> None:
     """ Make the node at pos a blank formula. 
         The node may be either a formula or a subproof.
         Blank formula means 
           hyp case: top .hyp
           conc case: top <empty annotation> """
+    self.log_op(['clear', self.line_code(pos)])
     p_node = self.get_p_node(pos)
+    self.touch(p_node.label)
     p_node.label.type = LabelType('formula')
     p_node.label.formula = Formula()
     if p_node.label.is_hyp:
@@ -884,24 +1772,50 @@ class ProofNodeS(ProofNode): # type: ignore
       p_node.label.line = "top ."
       p_node.label.ann = Ann()
 
-    self.validate_all()
+    self.revalidate([p_node], p_node.parent)
 
+  @undoable
   def replace_node(self, pos, p_node) -> None:
+    """ Replace the label and the kids of the node at pos with those of
+        p_node. The node itself is kept, so the premises which refer to
+        pos keep referring to it. """
     assert isinstance(p_node, ProofNode), \
       f"insert_node(): p_node must be a ProofNode."
     p_node_dest = self.get_p_node(pos)
+    pos_line = self.line_code(pos)
     if p_node_dest.label.is_hyp and \
        p_node.label.type == LabelType.SUBPROOF:
       raise Exception("replace_node(): Cannot replace a hypothesis" 
                       " with a subproof.")
-    t_idx = p_node_dest.index
-    parent_idx = t_idx[:-1]
-    parent_node = self.get_p_node(parent_idx)
-    rank_dest = t_idx[-1]
-    parent_node.children[rank_dest] = p_node
-    self.build_index()
-    self.index_dict = self.build_index_dict()
-    self.validate_all()
+    self.touch(p_node_dest)
+    old_kids = list(p_node_dest.children)
+    self.touch_subtrees([p_node] + old_kids)
+    self.rebind_premises([p_node])
+    cut_refs = self.cut_refs(p_node.children) \
+               if self.op_record is None else {}
+    if old_kids:
+      self.mark_removed(old_kids, old_kids[0])
+    p_node_dest.label = p_node.label
+    self.splice(p_node_dest, 0, len(old_kids), p_node.children)
+    p_node_dest.validated = p_node.validated
+    # the premises referring to p_node refer to the node at pos instead
+    stack = [p_node_dest]
+    while stack:
+      node = stack.pop()
+      stack.extend(node.children)
+      ann = node.label.ann
+      if isinstance(ann, Ann) and ann.premise_refs:
+        ann.premise_refs = [p_node_dest if ref is p_node else ref
+                            for ref in ann.premise_refs]
+    self.mark_removed([p_node_dest], None)
+    self.bind_premises([p_node_dest])
+    self.note_premises([p_node_dest])
+    if self.op_record is None:
+      self.fresh_premises([p_node_dest])
+      cut_refs.update(self.premise_cut_refs([p_node_dest]))
+      self.log_op(['replace', pos_line, 
+                   dump_nodes([p_node_dest], cut_refs)[0]])
+    self.revalidate([p_node_dest] + old_kids, p_node_dest.parent)
 
   # copy/cut/move/duplicate nodes
 
@@ -910,32 +1824,63 @@ class ProofNodeS(ProofNode): # type: ignore
     return self.copy_nodes(pos)[0]
   
   def copy_nodes(self, chunk) -> List[ProofNode]: # type: ignore
+    return self.copy_subtrees(self.get_p_node_li(chunk))
+
+  def copy_subtrees(self, p_node_li) -> List[ProofNode]: # type: ignore
     import copy
 
-    return copy.deepcopy(self.get_p_node_li(chunk))
+    # Copy the subtrees under a common parent, so that the premises 
+    # referring to any node of them are redirected to the copies.
+    # The formulas are shared, see Formula.__deepcopy__().
+    parent = ProofNode(NodeLabel(), list(p_node_li))
+    copies = copy.deepcopy(parent).children
+    for p_node in copies: # not in the proof yet
+      p_node.parent = None
+    return copies
+
+  def in_proof(self, p_node) -> bool:
+    # Test if p_node is a node of self, which must be the root.
+    while p_node.parent is not None:
+      p_node = p_node.parent
+    return p_node is self
     
   def cut_node(self, pos) -> ProofNode: # type: ignore
     """ Cut the node in the chunk and return it. """
     return self.cut_nodes(pos)[0]
   
   def cut_nodes(self, chunk) -> List[ProofNode]: # type: ignore
-    """ Cut the nodes in the chunk and return them as a list. """
-    return self.delete_nodes(chunk, bReturn=True) # type: ignore   
+    """ Cut the nodes in the chunk and return them as a list. 
+        A hypothesis or a conclusion which has to stay as a blank line
+        (see delete_nodes()) is returned as a copy made before the cut,
+        so that all the nodes returned are out of the proof. """
+    # Only the first hypothesis and the first conclusion can be left.
+    p_node_li = self.get_p_node_li(chunk)
+    kids = self.get_p_node(p_node_li[0].index[:-1]).children
+    firsts = [p_node for p_node in p_node_li if p_node.index[-1] == 0 or
+              (not p_node.label.is_hyp and 
+               kids[p_node.index[-1] - 1].label.is_hyp)]
+    copies = dict(zip([id(p_node) for p_node in firsts], 
+                      self.copy_subtrees(firsts)))
+    p_node_li = self.delete_nodes(chunk, bReturn=True) # type: ignore
+    return [p_node if p_node.parent is None else copies[id(p_node)]
+            for p_node in p_node_li]
   
   def move_node(self, pos_src, pos_dest, go_above=True) -> None:
     ''' This method utilizes the move_nodes() method. '''
     self.move_nodes(pos_src, pos_dest, go_above)
 
+  @undoable
   def move_nodes(self, chunk, pos_dest, go_above=True) -> None:
     ''' This method is basically does the job of cut_nodes() followed by
       insert_nodes(). Some preparatory work is necessary. '''
+    self.log_op(['move', str(chunk), self.line_code(pos_dest), go_above])
     # source nodes
     p_node_li = self.get_p_node_li(chunk) 
     #^ Checking the integrity of `chunk` is done above.
 
     # destination node
-    t_idx_dest = (p_node_dest := self.get_p_node(pos_dest)).index
-    l_num_dest = p_node_dest.line_num
+    t_idx_dest = self.get_p_node(pos_dest).index
+    l_num_dest = self.line_code(pos_dest)
 
     # compatibility of src and dest positions
     for p_node in p_node_li:
@@ -953,21 +1898,25 @@ class ProofNodeS(ProofNode): # type: ignore
 
     if int(l_num_src) < int(l_num_dest):
       # destination changes after the deletion of p_node_src
-      n_lines = sum([num_nodes(p_n) for p_n in p_node_li]) 
+      n_lines = sum([p_n.n_lines for p_n in p_node_li]) 
       l_num_dest = str(int(l_num_dest) - n_lines)
 
-    self.delete_nodes(chunk)
-    # We use l_num_dest instead of pos_dest because pos_dest may 
-    # have been changed by the deletion of `chunk`.
-    self.insert_nodes(l_num_dest, p_node_li, go_above)
+    with self.transaction():
+      p_node_li = self.cut_nodes(chunk)
+      # We use l_num_dest instead of pos_dest because pos_dest may 
+      # have been changed by the deletion of `chunk`.
+      self.insert_nodes(l_num_dest, p_node_li, go_above)
     
   def duplicate_node(self, pos_src, pos_dest, go_above=True) -> None:
     ''' This method utilizes the duplicate_nodes() method. '''
     self.duplicate_nodes(pos_src, pos_dest, go_above)
 
+  @undoable
   def duplicate_nodes(self, chunk, pos_dest, go_above=True) -> None:
     """ This method is basically does the job of copy_nodes() followed 
       by insert_nodes(). Much simpler than move_nodes(). """
+    self.log_op(['duplicate', str(chunk), self.line_code(pos_dest), 
+                 go_above])
     p_node_li = self.copy_nodes(chunk)
     #^ Checking the integrity of `chunk` is done above.
     self.insert_nodes(pos_dest, p_node_li, go_above)   
@@ -976,7 +1925,7 @@ class ProofNodeS(ProofNode): # type: ignore
     ''' Get p_node_li from `chunk`.
         Duplication is the responsibility of the caller. '''    
 
-    assert isinstance(self.index_dict, dict), \
+    assert self.stale or isinstance(self.index_dict, dict), \
       f"get_p_node_li(): self.index_dict is not dict?"
     assert isinstance(chunk, str) or isinstance(chunk, int), \
       f"get_p_node_li(): chunk='{chunk}'?"
@@ -985,14 +1934,22 @@ class ProofNodeS(ProofNode): # type: ignore
     s_li = chunk.split('~')
     if len(s_li) == 2:
       pos_s = s_li[0]
-      idx_s = self.index_dict.get(pos_s)
+      p_node_s = self.get_p_node(pos_s)
+      idx_s = p_node_s.index
       pos_e = s_li[1]
-      idx_e = self.index_dict.get(pos_e)
-      assert self.index_dict[pos_s][:-1] == self.index_dict[pos_e][:-1], \
+      idx_e = self.get_p_node(pos_e).index
+      assert idx_s[:-1] == idx_e[:-1], \
         f"get_p_node_li(): two positions '{pos_s}' and '{pos_e}'" \
         "\n\tshould share a common parent."
-      p_node_li = [self.get_p_node(pos) for pos in self.index_dict 
-                    if idx_within(self.index_dict[pos], idx_s, idx_e)]
+      parent_node = self.get_p_node(idx_s[:-1])
+      p_node_li = parent_node.children[idx_s[-1]:idx_e[-1] + 1]
+      # index and line_num of the nodes in between may be out of date
+      l_num = int(p_node_s.line_num.split('-')[0])
+      for k, p_node in enumerate(p_node_li):
+        p_node.index = idx_s[:-1] + [idx_s[-1] + k]
+        p_node.line_num = f"{l_num}-{l_num + p_node.n_lines - 1}" \
+                          if p_node.children else str(l_num)
+        l_num += p_node.n_lines
     elif len(s_li) == 1:
       p_node_li = [self.get_p_node(chunk)]
     else:
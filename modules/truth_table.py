@@ -1,16 +1,11 @@
 # type: ignore
-from typing import List, Tuple
+from typing import Dict, List, Tuple
 from enum import Enum
 
 try:
-  import sys
-  sys.path.append('..')
   from modules.first_order_logic_parse import *
-except ImportError:
-  url = 'https://raw.githubusercontent.com/jhjeong314/Proofmood/main/modules'
-  import httpimport
-  with httpimport.remote_repo(url):
-    from first_order_logic_parse import *
+except ImportError: # loaded as a top-level module, e.g. by httpimport
+  from first_order_logic_parse import *
 
 class Connective(Enum):
   BOT = 'bot'
@@ -39,6 +34,15 @@ class Formula:
 
   def __str__(self):
     return self.ast.build_infix('text')
+
+  def __deepcopy__(self, memo):
+    # A copy shares the ast with self. The asts are never changed in 
+    # place, see Node.replace_node_at(), so copying a proof or a line 
+    # does not copy its formulas.
+    fmla = self.__class__.__new__(self.__class__)
+    memo[id(self)] = fmla
+    fmla.__dict__.update(self.__dict__)
+    return fmla
   
   def __eq__(self, other) -> bool:
     return self.ast == other.ast
@@ -81,24 +85,31 @@ class Formula:
   def node_at(self, pos: List[int]) -> Node:
     return self.ast.node_at(pos)
   
+  # The ast may be shared with other formulas, see __deepcopy__(), so
+  # the methods below never change it. The in-place versions 
+  # (dupl == '') give self the new ast made by the copy-on-write 
+  # methods of Node instead.
   def replace_node_at(self, pos: List[int], new_node: Node, 
                       dupl: str = ''):
-    node = self.ast.replace_node_at(pos, new_node, dupl)
-    if dupl=='dupl' and isinstance(node, Node):
+    node = self.ast.replace_node_at(pos, new_node, 'dupl')
+    if dupl=='dupl':
       return Formula(node)
+    self.ast = node
 
   def replace_nodes_at(self, pos_li: List[List[int]],
                       new_node_li, dupl: str=''):
-    node = self.ast.replace_nodes_at(pos_li, new_node_li, dupl)
-    if dupl=='dupl' and isinstance(node, Node):
+    node = self.ast.replace_nodes_at(pos_li, new_node_li, 'dupl')
+    if dupl=='dupl':
       return Formula(node)
+    self.ast = node
 
   def substitute(self, var: str, new_node, dupl: str = ''):
     # Use Node.substitute() method.
     # var can be either is individual var/constant or propositional var.
-    node = self.ast.substitute(var, new_node, dupl) 
-    if dupl=='dupl' and isinstance(node, Node):
+    node = self.ast.substitute(var, new_node, 'dupl') 
+    if dupl=='dupl':
       return Formula(node)
+    self.ast = node
 
   # Methods for building truth tables.
 
@@ -117,9 +128,11 @@ class Formula:
   # the atoms of propositional reasoning.  These can be identified in the
   # AST of a formula with bottom-up method. See the following code for details.
 
-  # Note that the prime formulas are represented in the code by the 
-  # infix-notation strings of the formulas.  This is because we want to be 
-  # able to use set operations, and the Nodes of the AST are not hashable.
+  # Note that the prime formulas are identified in the code by their 
+  # alpha keys, see Node.alpha_key(), and shown by the infix-notation 
+  # string of the first occurrence.  So alphabetic variants such as 
+  # forall x P1(x) and forall y P1(y) are one and the same prime formula, 
+  # and a prime node finds its index with a dict lookup.
 
   # Prime subformulas are the subformulas having the root whose token_type
   # belongs to PRIME_ROOT := ("pred_pre", "pred_in", "equality", 
@@ -128,33 +141,51 @@ class Formula:
   #   NON_PRIME_ROOTS := ("conn_1ary", "conn_2ary", "conn_arrow")
   #endregion comment1
 
-  def get_prime_subformulas(self) -> set:
-    # This method is used in TruthTable.get_prime_subformulas().
+  def prime_nodes(self):
+    # Generate the prime nodes of the truth tree other than bot and top,
+    # from left to right.
+    stack = [self.ast]
+    while stack:
+      node = stack.pop()
+      if node.token.token_type in Token.NON_PRIME_ROOTS:
+        # connectives of positive arity
+        stack.extend(reversed(node.children))
+      elif node.token.token_type != 'conn_0ary':
+        yield node
+
+  def get_prime_atoms(self, atoms: Dict[tuple, str] | None = None
+                      ) -> Dict[tuple, str]:
+    # This method is used in TruthTable.get_prime_atoms().
+    # Return the dict from the alpha keys of the prime subformulas to 
+    # their infix strings, in the order of first occurrence.  If atoms 
+    # is given, new ones are added to it.
     MAX_N = 8 # maximum number of prime subformulas
-    prime_subs = set()
-    tree = self.ast
-    if tree.token.token_type in Token.NON_PRIME_ROOTS: 
-      # connectives of positive arity
-      for kid in tree.children:
-        prime_subs |= Formula(kid).get_prime_subformulas()
-    elif tree.token.token_type != 'conn_0ary':
-      prime_subs |= { self.ast.build_infix('text') }
-
-    assert len(prime_subs) <= MAX_N, \
+    atoms = {} if atoms is None else atoms
+    for node in self.prime_nodes():
+      key = node.alpha_key()
+      if key not in atoms:
+        atoms[key] = node.build_infix('text')
+
+    assert len(atoms) <= MAX_N, \
       f"Error: number of prime subformulas exceeds {MAX_N}."
-    return prime_subs
+    return atoms
+
+  def get_prime_subformulas(self) -> set:
+    # This method is used in TruthTable.get_prime_subformulas().
+    return set(self.get_prime_atoms().values())
   
   #region comment2
   # Truth tree is a subtree of the AST of a formula obtained by removing specific nodes.  The root node belongs to the truth tree.  If a node is labeled with a connective with positive arity, then each of its children belongs to the truth tree.  Therefore, every node within the truth tree is a prime subformula of the formula or a subformula built from earlier nodes within the truth tree and connectives.  In brief, a truth tree is a tree of subformulas where each node is to be assigned a truth value.
 
   # Nodes labeled with bot, which represents the constant False, are prime subformulas but are not included in the return value of the get\_prime\_subformulas() method due to technical reasons. We refer to the elements in the return value of this method as prime nodes.
 
-  # Prime nodes within the truth tree should be assigned indices. If [A, forall x P(x), Q(x,y)] is the sorted list of all prime nodes within a set of formulas, then any node in the truth tree of a formula labeled A is assigned index 0. Similarly, nodes labeled with forall x P(x) are assigned index 1, and Q(x,y) is assigned index 2. Non-prime nodes within the truth tree are not assigned indices.
+  # Prime nodes within the truth tree should be assigned indices. If [A, forall x P(x), Q(x,y)] is the sorted list of all prime nodes within a set of formulas, then any node in the truth tree of a formula labeled A is assigned index 0. Similarly, nodes labeled with forall x P(x), or an alphabetic variant such as forall y P(y), are assigned index 1, and Q(x,y) is assigned index 2. Non-prime nodes within the truth tree are not assigned indices.
 
   # When a specific truth-value assignment is provided, each node in the proof tree is assigned a truth value in the following manner. Prime nodes are assigned values based on the truth-value assignment. Non-prime nodes are assigned values according to the truth functions of the corresponding connectives.
   #endregion comment2
 
-  def label_prime_subs(self, prime_subs_li: List[str]) -> List[str]:
+  def label_prime_subs(self, prime_subs_li: List[str] | Dict[tuple, str]
+                       ) -> List[str]:
     # This method uses TruthTable.label_prime_subs().
     t_table = TruthTable([self])
     return t_table.label_prime_subs(prime_subs_li)
@@ -259,25 +290,29 @@ class Formula:
     # That's all the difference between the two cases.
     
     bValues = []
-    tree = self.ast
-    token = tree.token
-    if token.token_type in Token.FMLA_ROOTS:
-      if token.token_type in Token.NON_PRIME_ROOTS:
-        if token.arity == 1:
-          v = tree.bValue if opt=='truth_val' else tree.level
-          bValues.append(v)
-          bValues += Formula(tree.children[0]).get_bValues(opt)
-        else: # token.arity == 2
-          bValues += Formula(tree.children[0]).get_bValues(opt)
-          v = tree.bValue if opt=='truth_val' else tree.level
-          bValues.append(v)
-          bValues += Formula(tree.children[1]).get_bValues(opt)
-      else: # token.token_type in Token.PRIME_ROOTS
-          v = tree.bValue if opt=='truth_val' else tree.level
+    stack = [self.ast] # nodes to visit and values to output, in reverse
+    while stack:
+      tree = stack.pop()
+      if not isinstance(tree, Node): # a value to output
+        bValues.append(tree)
+        continue
+      token = tree.token
+      if token.token_type in Token.FMLA_ROOTS:
+        v = tree.bValue if opt=='truth_val' else tree.level
+        if token.token_type in Token.NON_PRIME_ROOTS:
+          if token.arity == 1:
+            stack += [tree.children[0], v]
+          else: # token.arity == 2
+            stack += [tree.children[1], v, tree.children[0]]
+        else: # token.token_type in Token.PRIME_ROOTS
           bValues.append(v)
 
     return bValues
   
+  def build_truth_table(self, opt: str='text') -> 'TruthTableResult':
+    # This method uses TruthTable.build_truth_table().
+    return TruthTable([self]).build_truth_table(opt)
+
   def show_truth_table(self, opt: str='text') -> None:
     # opt ::== 'text' | 'latex'
     # This method uses TruthTable.show_truth_table().
@@ -292,17 +327,19 @@ class TruthTable:
   def  __init__(self, f_list: FList):
     self.f_list = f_list
 
-  def get_prime_subformulas(self) -> set:
-    MAX_N = 8 # maximum number of prime subformulas
-    prime_subs = set()
+  def get_prime_atoms(self) -> Dict[tuple, str]:
+    # The prime subformulas of all the formulas in self.f_list,
+    # see Formula.get_prime_atoms().
+    atoms = {}
     for f in self.f_list:
-      prime_subs |= f.get_prime_subformulas()
+      f.get_prime_atoms(atoms)
+    return atoms
 
-    assert len(prime_subs) <= MAX_N, \
-      f"Error: number of prime subformulas exceeds {MAX_N}."
-    return prime_subs
+  def get_prime_subformulas(self) -> set:
+    return set(self.get_prime_atoms().values())
 
-  def label_prime_subs(self, prime_subs_li: List[str]) -> List[str]:
+  def label_prime_subs(self, prime_subs_li: List[str] | Dict[tuple, str]
+                       ) -> List[str]:
     # In this method, each prime node in a truth tree is assigned 
     # an index, which is the index of the formula in prime_subs_li.
     # Also, each prime node which is not a prop letter is assigned 
@@ -311,18 +348,27 @@ class TruthTable:
     # the prop letter itself, i.e., node.token.value.
     # So, when forming any formula, prop letter P_i is not allowed.
     # The return value is the list of alternate labels of the prime nodes.
+    # prime_subs_li is either the dict returned by get_prime_atoms(), 
+    # or a list of infix strings of prime subformulas.  Prime nodes are 
+    # matched by their alpha keys in both cases.
     
+    if isinstance(prime_subs_li, dict):
+      atom_ids = {key: i for i, key in enumerate(prime_subs_li)}
+    else:
+      str_ids = {s: i for i, s in enumerate(prime_subs_li)}
+      atom_ids = dict()
+      for f in self.f_list:
+        for node in f.prime_nodes():
+          i = str_ids.get(node.build_infix('text'))
+          if i is not None:
+            atom_ids.setdefault(node.alpha_key(), i)
     dict_index2i = dict()
     ret_li = [''] * len(prime_subs_li)
     n_added_alt = 0
 
-    def rec_fn(node: Node) -> None:
-      nonlocal n_added_alt
-      if node.token.token_type in Token.NON_PRIME_ROOTS:
-        for kid in node.children:
-          rec_fn(kid)
-      elif node.token.token_type != 'conn_0ary':
-        node.index = prime_subs_li.index(node.build_infix('text'))         
+    for f in self.f_list:
+      for node in f.prime_nodes():
+        node.index = atom_ids[node.alpha_key()]
         if node.token.token_type != 'prop_letter':
           if node.index not in dict_index2i:
             n_added_alt += 1
@@ -336,9 +382,6 @@ class TruthTable:
           node.alt_str = node.token.value 
           # What if node.token.value has '_' and/or too long?
           ret_li[node.index] = node.alt_str
-
-    for f in self.f_list:
-      rec_fn(f.ast)
     return ret_li
 
   def show_p_sub_labels(self, prime_subs_li: List[str]) -> None:
@@ -373,7 +416,7 @@ class TruthTable:
       f.get_truth_tree(tVal_assign)
   
   def get_binary(self, n: int, len: int) -> str:
-    # This method is used in show_truth_table().
+    # This method is used in build_truth_table().
     # n is an integer in the range [0, 2^len - 1]
     # len is the number of propositional letters in the formula(s)
     # E.g., if n=5, len=4, then return '0101'.
@@ -381,10 +424,14 @@ class TruthTable:
   
   def print_truth_table_row(self, header: str, tVal_assign: str, 
                              bValues: List[int]) -> None:
-    # This method is used in show_truth_table(opt='text') to print
+    print(self.truth_table_row_str(header, tVal_assign, bValues))
+
+  def truth_table_row_str(self, header: str, tVal_assign: str, 
+                          bValues: List[int]) -> str:
+    # This method is used in build_truth_table(opt='text') to build
     # a row of the table corresponding to tVal_assign. So, this method
     # will be called 2^n_prop_letters times to complete the table.
-    # The truth values, 0 and 1, in the row are printed in line with 
+    # The truth values, 0 and 1, in the row are placed in line with 
     # the tokens in the header.
 
     # The header argument is only used to determine the positions of the
@@ -430,10 +477,14 @@ class TruthTable:
       bVal_str = footer_str[prefix_len:]
       prefix = "Level".ljust(prefix_len)
       footer_str = prefix + bVal_str
-    print(footer_str)
+    return footer_str
 
   def print_latex_row(self, empty_pos_li: List[int], tvSeq: List[str], 
                       bLast: bool=False) -> None:
+    print(self.latex_row_str(empty_pos_li, tvSeq, bLast))
+
+  def latex_row_str(self, empty_pos_li: List[int], tvSeq: List[str], 
+                    bLast: bool=False) -> str:
     for pos in empty_pos_li:
       tvSeq.insert(pos, '')
 
@@ -449,18 +500,26 @@ class TruthTable:
         tvSeq[i] = ' & ' + s
 
     postfix = r" \\ \hline" if bLast else r" \\"
-    print(prefix + ''.join(tvSeq) + postfix)
+    return prefix + ''.join(tvSeq) + postfix
     
   def print_truth_table_footer(self, header: str, n: int,
                              bValues: List[int]) -> None:
+    print(self.truth_table_footer_str(header, n, bValues))
+
+  def truth_table_footer_str(self, header: str, n: int,
+                             bValues: List[int]) -> str:
     v_str = '2' * n # n = number of propositional letters
-    self.print_truth_table_row(header, v_str, bValues)
+    return self.truth_table_row_str(header, v_str, bValues)
 
   def print_latex_footer(self, n_prop: int, e_p_li: List[int],
                          tvSeq: List[str]) -> None:
+    print(self.latex_footer_str(n_prop, e_p_li, tvSeq))
+
+  def latex_footer_str(self, n_prop: int, e_p_li: List[int],
+                       tvSeq: List[str]) -> str:
     level_str_li = ['L'] * n_prop
     tvSeq = level_str_li + tvSeq
-    self.print_latex_row(e_p_li, tvSeq, True)
+    return self.latex_row_str(e_p_li, tvSeq, True)
 
   def get_header_latex(self, header: str) -> Tuple[str, List[int]]:
     v_li = header.split()
@@ -538,72 +597,62 @@ class TruthTable:
     
     return tuple([perm, 
                   perm_inv])                                                           
-  def show_truth_table(self, opt: str='text') -> None:
+  def build_truth_table(self, opt: str='text') -> 'TruthTableResult':
     # opt ::== 'text' | 'latex'
-    # For opt == 'text', this method generates and prints out a truth 
-    # table for the formulas in self.f_list.
-    # For opt == 'latex', this method prints out the LaTeX source code.
-    # It doesn't render the table on the screen.
+    # This method builds the truth table for the formulas in self.f_list
+    # without printing or displaying anything.  The lines of the result
+    # are the table in text or the LaTeX source code, preceded for 
+    # opt == 'text' by the prime subformulas and their alternate labels.
+    # show_truth_table() prints them, and the proof server returns them.
 
     # Roughly speaking, it uses the following methods to prepare the 
     # scaffold of the truth tree.
-    # 1. get_prime_subformulas()
-    # 2. label_prime_subs(prime_subs_li)
+    # 1. get_prime_atoms()
+    # 2. label_prime_subs(prime_atoms)
     # Then, for each truth value assignment, it uses the following
     # methods to fill in the truth tree.
     # 3. get_truth_tree(tVal_assign)
     # Finally, for each truth value assignment, it uses the following
-    # methods to print out a row of the truth table.
+    # methods to build a row of the truth table.
     # 4. get_bValues()
-    # 5. print_truth_table_row()
+    # 5. truth_table_row_str()
     
-    prime_subs_li = list(self.get_prime_subformulas())
+    result = TruthTableResult(opt, [f"{f}" for f in self.f_list])
+    lines = result.lines
+    prime_atoms = self.get_prime_atoms()
+    prime_subs_li = list(prime_atoms.values())
     if len(prime_subs_li) == 0:
-      print("Error: propositional variable not found in the following:")
-      for f in self.f_list:
-        f.display_infix()
-      return
-    alt_str_li = self.label_prime_subs(prime_subs_li)
+      result.error = "Error: propositional variable not found " \
+                     "in the following:"
+      lines += [result.error] + result.formulas
+      return result
+    alt_str_li = self.label_prime_subs(prime_atoms)
     n_prime_node = len(prime_subs_li)
     perm, perm_inv = self.order(alt_str_li)
     alt_str_li2 = permute_li(alt_str_li, perm) # == sorted(alt_str_li)
-         
-    n_fmla = len(self.f_list)
-    print("Truth table for the following", end="")
-    print(" formula." if n_fmla == 1 else f" {n_fmla} formulas.")
 
-    for f in self.f_list:
-      f.display_infix()
-    # self.show_p_sub_labels(prime_subs_li)
-    # print("")
-
-    # Show prime subformulas and their alternate labels.
+    # Prime subformulas and their alternate labels.
     prime_subs_li2 = permute_li(prime_subs_li, perm)
+    result.prime_subs, result.alt_labels = prime_subs_li2, alt_str_li2
     if opt == 'text':
-      print("prime subformulas =", prime_subs_li2)
-      print("alt prop. letters =", alt_str_li2)
-      print()
-    else: # opt == 'latex'
-      print("Prime subformulas and their alternate labels.")
-      Node.display_latex_li(prime_subs_li2)
-      Node.display_latex_li(alt_str_li2)
+      lines.append(f"prime subformulas = {prime_subs_li2}")
+      lines.append(f"alt prop. letters = {alt_str_li2}")
+      lines.append('')
 
-    # Prepare and print the header of the truth table.
+    # Prepare the header of the truth table.
     str_li = [str(f.display_infix('truth_table_str')) 
               for f in self.f_list]
     formulas_joined = ', '.join(str_li)
     prop_letters = ' '.join(alt_str_li2)
     header = f"{prop_letters.replace('_','')} : {formulas_joined}"
     if opt == 'text':
-      # Print the header.
-      print(f"{header}")
-      print(f"{'-' * len(header)}")
+      lines.append(header)
+      lines.append('-' * len(header))
     else: # opt == 'latex'
       header_latex, empty_pos_li = self.get_header_latex(header)
-      print(header_latex)
-      # print(empty_pos_li)
+      lines.append(header_latex)
 
-    # Generate and print out the body of the truth table.
+    # Generate the body of the truth table.
     n_row = 2**n_prime_node
     for i in range(1, n_row+1):
       tVal_assign = self.get_binary(n_row - i, n_prime_node)
@@ -613,27 +662,81 @@ class TruthTable:
       bValues = []
       for f in self.f_list:
         bValues += f.get_bValues()
+      result.assignments.append(tVal_assign)
+      result.values.append(bValues)
       if opt == 'text':
-        self.print_truth_table_row(header, tVal_assign, bValues)
+        lines.append(self.truth_table_row_str(header, tVal_assign, bValues))
       else: # opt == 'latex':
         tvSeq = list(tVal_assign) + [str(i) for i in bValues]
-        self.print_latex_row(empty_pos_li, tvSeq, i == n_row) # pyright: ignore[reportUnboundVariable]  
+        lines.append(self.latex_row_str(empty_pos_li, tvSeq, i == n_row)) # pyright: ignore[reportUnboundVariable]  
 
-    # Print the footer of the truth table.
+    # The footer of the truth table.
     self.assign_levels()
     bValues = []
     for f in self.f_list:
       bValues += f.get_bValues('level')
+    result.levels = bValues
     if opt == 'text':
-      print(f"{'-' * len(header)}")
-      self.print_truth_table_footer(header, n_prime_node, bValues)
+      lines.append('-' * len(header))
+      lines.append(self.truth_table_footer_str(header, n_prime_node, 
+                                               bValues))
     else: # opt == 'latex':
       bVal_li = [str(i) for i in bValues]
-      self.print_latex_footer(n_prime_node, empty_pos_li, bVal_li) # pyright: ignore[reportUnboundVariable]  
-      print(r"\end{tabular}")
+      lines.append(self.latex_footer_str(n_prime_node, empty_pos_li, bVal_li)) # pyright: ignore[reportUnboundVariable]  
+      lines.append(r"\end{tabular}")
+    return result
+
+  def show_truth_table(self, opt: str='text', show_fmlas: bool=True) -> None:
+    # opt ::== 'text' | 'latex'
+    # For opt == 'text', this method generates and prints out a truth 
+    # table for the formulas in self.f_list.
+    # For opt == 'latex', this method prints out the LaTeX source code.
+    # It doesn't render the table on the screen.
+    # If show_fmlas is True, then the formulas (and, for opt == 'latex',
+    # the prime subformulas) are displayed with IPython before the
+    # table.  See build_truth_table() for the table itself.
+    result = self.build_truth_table(opt)
+    if show_fmlas:
+      if result.error:
+        print(result.error)
+        for f in self.f_list:
+          f.display_infix('latex')
+        return
+      n_fmla = len(self.f_list)
+      print("Truth table for the following", end="")
+      print(" formula." if n_fmla == 1 else f" {n_fmla} formulas.")
+      for f in self.f_list:
+        f.display_infix()
+      if opt == 'latex':
+        print("Prime subformulas and their alternate labels.")
+        Node.display_latex_li(result.prime_subs)
+        Node.display_latex_li(result.alt_labels)
+    print(result.text, end='')
       
   # end of class TruthTable
 
+class TruthTableResult:
+  """ A truth table built by TruthTable.build_truth_table(). The rows 
+      are in the order of the table, from 11..1 down to 00..0, and the 
+      digits of an assignment go with alt_labels.  values[i] are the 
+      truth values of the nodes of the truth trees under assignments[i],
+      in the order of the header, and levels are their levels. """
+  def __init__(self, opt: str, formulas: List[str]):
+    self.opt = opt # 'text' | 'latex'
+    self.formulas = formulas # infix strings of the formulas
+    self.error = '' # nonempty if there is no prime subformula
+    self.prime_subs = [] # type: List[str]
+    self.alt_labels = [] # type: List[str]
+    self.assignments = [] # type: List[str]
+    self.values = [] # type: List[List[int]]
+    self.levels = [] # type: List[int]
+    self.lines = [] # type: List[str]
+
+  @property
+  def text(self) -> str:
+    # what show_truth_table(opt, show_fmlas=False) prints
+    return ''.join(line + '\n' for line in self.lines)
+
 # Utility functions
 
 def show_tree_nodes(tree: Node) -> None: # 
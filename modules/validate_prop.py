@@ -3,26 +3,22 @@
 from typing import List, Tuple, Dict, Set, Any
 import re
 from enum import Enum
+from collections import OrderedDict
 
-# Make colorama module available.
-import sys, subprocess
-try:
-  from colorama import Fore, Back, Style
-except ModuleNotFoundError:
-  subprocess.check_call(
-    [sys.executable, '-m', 'pip', 'install', 'colorama'],
-      stdout=subprocess.DEVNULL
-  )
-  print("colorama installed")
-  from colorama import Fore, Back, Style
+import sys, io, html, functools, random
 
 try:
   from modules.truth_table import * 
-except ImportError:
-  url = 'https://raw.githubusercontent.com/jhjeong314/Proofmood/main/modules'
-  import httpimport
-  with httpimport.remote_repo(url):
-    from truth_table import *  
+except ImportError: # loaded as a top-level module, e.g. by httpimport
+  from truth_table import *  
+
+class Fore:
+  # ANSI color codes, the same as those of colorama.Fore, which is not
+  # needed just for these
+  LIGHTRED_EX = '\x1b[91m'
+  LIGHTGREEN_EX = '\x1b[92m'
+  YELLOW = '\x1b[33m'
+  RESET = '\x1b[39m'
 
 class RuleInfer(Enum):
   # ordered by the precedence of proof search 
@@ -57,8 +53,78 @@ RULES_AUX = ['repeat', 'LEM', 'hyp']
 VERT = '│'
 PROVES = '├─'
 TAB = '\t'
+# build_fitch_html(): symbols for the words of the text form of formulas,
+# the size in px of a scope bar cell, and the style sheet.
+HTML_DICT = Node.UNICODE_DICT
+HTML_WORD = re.compile(r'\b(' + '|'.join(w for w in HTML_DICT if w.isalpha())
+                       + r')\b')
+BAR_WIDTH, ROW_HEIGHT = 14, 24
+FITCH_CSS = (
+  ".pm-fitch{border-collapse:collapse;font-family:serif;}"
+  f".pm-fitch td{{padding:0 .4em;height:{ROW_HEIGHT}px;"
+  "white-space:pre;vertical-align:middle;}"
+  ".pm-fitch td.pm-line{padding-left:0;}"
+  ".pm-fitch svg{vertical-align:top;stroke:currentColor;stroke-width:1;}"
+  ".pm-fitch .pm-num{text-align:right;color:#666;}"
+  ".pm-fitch .pm-ok{color:#2a2;}.pm-fitch .pm-err{color:#d22;}"
+  ".pm-fitch .pm-comment{color:#666;font-style:italic;}")
+FITCH_BAR_DEFS = (
+  '<svg width="0" height="0" style="position:absolute"><defs>'
+  f'<pattern id="pm-bar" width="{BAR_WIDTH}" height="{ROW_HEIGHT}" '
+  'patternUnits="userSpaceOnUse"><line x1="{0}" y1="0" x2="{0}" '
+  f'y2="{ROW_HEIGHT}" stroke="currentColor"/></pattern></defs></svg>'
+  ).format(BAR_WIDTH // 2)
 #endregion 0
 
+class VerifyCache:
+  """ Process-wide bounded (LRU) cache of rule verification results.
+      Whether a conclusion follows from premises by a rule depends only
+      on the structure of the formulas, so the key is the rule together
+      with the polish notations of the conclusion and the premises.
+      (Node.__eq__ compares polish notations too.)
+      The same check is thus done only once across proofs, revisions of
+      a proof and iterations of proof search. """
+  def __init__(self, maxsize: int = 1 << 14):
+    self.maxsize = maxsize # 0 disables the cache
+    self.data = OrderedDict() # type: OrderedDict[tuple, bool]
+    self.hits = 0
+    self.misses = 0
+
+  def key(self, rule_inf: RuleInfer, conc: Node, premise: List[Node]) \
+      -> tuple:
+    return (rule_inf, conc.build_polish_notation(),
+            tuple([node.build_polish_notation() for node in premise]))
+
+  def get(self, key: tuple) -> bool | None:
+    value = self.data.get(key)
+    if value is None:
+      self.misses += 1
+    else:
+      self.hits += 1
+      self.data.move_to_end(key)
+    return value
+
+  def put(self, key: tuple, value: bool) -> None:
+    if self.maxsize <= 0:
+      return
+    self.data[key] = value
+    self.data.move_to_end(key)
+    if len(self.data) > self.maxsize:
+      self.data.popitem(last=False)
+
+  def clear(self) -> None:
+    self.data.clear()
+    self.hits = 0
+    self.misses = 0
+
+  def stats(self) -> Dict[str, Any]:
+    n_lookup = self.hits + self.misses
+    return {'size': len(self.data), 'maxsize': self.maxsize,
+            'hits': self.hits, 'misses': self.misses,
+            'hit_rate': self.hits / n_lookup if n_lookup else 0.0}
+
+verify_cache = VerifyCache()
+
 class FormulaProp(Formula):
   def __init__(self, input: str | Node = ''):
         super().__init__(input)
@@ -82,7 +148,20 @@ class FormulaProp(Formula):
         If a subproof need be a member of premise, then we must use 
         the formula A imp B instead where A is the hypothesis and B 
         is the last formula of the subproof.
+        The result is looked up in verify_cache first.
       """
+    if verify_cache.maxsize <= 0:
+      return self.check_rule(rule_inf, premise)
+    key = verify_cache.key(rule_inf, self.ast, premise)
+    result = verify_cache.get(key)
+    if result is None:
+      result = self.check_rule(rule_inf, premise)
+      verify_cache.put(key, result)
+    return result
+
+  def check_rule(self, rule_inf: RuleInfer, premise: List[Node] = []) \
+      -> bool:
+    """ The uncached body of verified_by(). """
     if f"{self}" == 'top':
       return True
     match rule_inf:
@@ -91,12 +170,12 @@ class FormulaProp(Formula):
         # two premises are negations of each other
         if self.ast.token.value != 'bot' or len(premise) != 2:
           return  False
-        not_i = 0 if premise[0].token.value == 'not' else 1
-        not_prem = premise[not_i]
-        if not FormulaProp(not_prem).is_fmla_type(Connective.NOT):
-          return False
-        other_prem = premise[1 - not_i]
-        return not_prem.children[0] == other_prem
+        # both premises can be negations, e.g., not A and not not A
+        for not_prem, other_prem in (premise, premise[::-1]):
+          if FormulaProp(not_prem).is_fmla_type(Connective.NOT) and \
+             not_prem.children[0] == other_prem:
+            return True
+        return False
       case RuleInfer.BOT_ELIM:
         # return true iff the only premise is bot
         # self can be any formula
@@ -255,8 +334,44 @@ class Ann:
     self.premise = None # [node_code,.. , ] 
                         # node_code ::= ln: digit | ln_s-ln_e: str
                         # ln = line number
+    # ProofNode.bind_premises() replaces the node codes in premise_refs
+    # by the nodes they refer to. Then the premise property gives their
+    # current line numbers, so edits never rewrite annotations.
+    # removed_with is set while the line is cut out of the proof.
+    self.removed_with = None # type: ProofNode | None
     self.parse()
 
+  @property
+  def premise(self) -> List[str] | None:
+    """ The node codes of the premises. A premise whose node has been
+        removed from the proof is left out, unless it was removed 
+        together with this annotation, e.g., by cut_nodes(). """
+    if self.premise_refs is None:
+      return None
+    return [ref if isinstance(ref, str) else ref.line_num 
+            for ref in self.premise_refs 
+            if isinstance(ref, str) or ref.removed_with is None or
+               ref.removed_with is self.removed_with]
+
+  @premise.setter
+  def premise(self, value: List[str] | None) -> None:
+    self.premise_refs = None if value is None else list(value)
+
+  def __deepcopy__(self, memo):
+    # The premises refer to other nodes of the proof, which are not
+    # copied. ProofNode.__deepcopy__() registers the copies of the nodes
+    # in memo before copying the labels, so that the premises within
+    # the copied subtree refer to the copies.
+    ann = Ann.__new__(Ann)
+    memo[id(self)] = ann
+    ann.__dict__.update(self.__dict__)
+    if self.premise_refs is not None:
+      ann.premise_refs = [ref if isinstance(ref, str) else 
+                          memo.get(id(ref), ref) 
+                          for ref in self.premise_refs]
+    ann.removed_with = memo.get(id(self.removed_with), self.removed_with)
+    return ann
+
   def __str__(self) -> str:
     if self.rule is None:
       return ''
@@ -336,49 +451,6 @@ class Ann:
     else:
       raise ValueError('5: ' + err_msg)
 
-  def adjust_premises(self, proof, target_ln: str, v_ln: str, 
-                      n_lines: int, opt: str) -> None:
-    # target_ln is the line_num of the insertion node in the proof tree 
-    # before insertion. This may change by the insertion because of the 
-    # line-subproof issue. v_ln is the line_num of the node to be adjusted
-    # in the new proof tree.  opt = 'insert' | 'delete'.
-    def adjust_n(prem: str, s: int, e: int, n_lines, opt: str) -> str:
-      n = int(prem)
-      if n < s:
-        return str(n)
-      else:
-        if opt == 'insert':
-          return str(n + n_lines)
-        else: # opt == 'delete'
-          if n < e:
-            return '0' # non-existing line 
-          else: # n >= e
-            return str(n - n_lines)
-          
-    p_node = proof.get_p_node(v_ln)
-    ann = p_node.label.ann
-    premise_new = []
-    s = int(target_ln) # start line number
-    e = s + n_lines # end line number + 1
-    for prem in ann.premise:
-      # prem is a node code, e.g., '1', '2-3'
-      if '-' in prem: # prem refers to a subproof
-        a, b = [v for v in prem.split('-')]
-        a = adjust_n(a, s, e, n_lines, opt)
-        b = adjust_n(b, s, e, n_lines, opt)
-        if a != '0' and b != '0':
-          prem = f"{a}-{b}" 
-        else:
-          continue # remove the premise
-      else: # prem refers to a formula line
-        prem = adjust_n(prem, s, e, n_lines, opt)
-        if prem == '0':
-          continue # remove the premise
-
-      premise_new.append(prem)
-
-    ann.premise = premise_new
-
   # end of class Annotation
 
 class NodeLabel: 
@@ -397,6 +469,7 @@ class NodeLabel:
     self.formula = formula
     self.ann = ann
     self.is_hyp = None # type: bool | None
+    self.fmla_cache = None # see formula_str()
     if self.type != LabelType.FORMULA:
       self.is_hyp = self.type.value.endswith('.hypo')
     elif self.line != '': 
@@ -411,9 +484,26 @@ class NodeLabel:
 
   def __str__(self) -> str:
     if self.type == LabelType.FORMULA:
-      return f"{self.formula}\t .{self.ann}"
+      return f"{self.formula_str()}\t .{self.ann}"
     else:
       return self.line
+
+  def formula_str(self, opt: str = 'text') -> str:
+    """ self.formula.ast.build_infix(opt), cached on the label.
+        opt is 'text', 'latex' or 'html'.
+        The edit methods never modify a formula of a proof in place but
+        replace it by a new Formula object, which drops the cache. """
+    cache = getattr(self, 'fmla_cache', None)
+    if cache is None or cache[0] is not self.formula:
+      cache = self.fmla_cache = (self.formula, {})
+    fmla_str = cache[1].get(opt)
+    if fmla_str is None:
+      if opt == 'html': # from the text form, see build_fitch_html()
+        fmla_str = infix_html(self.formula_str())
+      else:
+        fmla_str = self.formula.ast.build_infix(opt)
+      cache[1][opt] = fmla_str
+    return fmla_str
     
   def build_str(self) -> str:
     if self.type == LabelType.SUBPROOF:
@@ -478,11 +568,66 @@ class ProofNode:
     # The following 2 attributes are set by the build_index() method.
     self.index = None # type: List[int] | None
     self.line_num = None # type: str | None # e.g., '4', '6-10'
+    # Number of lines(leaves) in this subtree, kept up to date by 
+    # build_index(), splice() and lines_changed(). line_tree is a LineTree
+    # over the kids, built lazily by get_line_tree(), and slot is the
+    # place of self in the line_tree of its parent.
+    self.n_lines = sum([kid.n_lines for kid in self.children]) \
+                   if self.children else 1
+    self.line_tree = None # type: LineTree | None
+    self.slot = None # type: LineSlot | None
+    # set by build_index() and splice(), None while cut out of the proof
+    self.parent = None # type: ProofNode | None
+    # stale is set on the root when an edit has changed the line counts
+    # but index, line_num and index_dict have not been renewed yet.
+    self.stale = False
     # The 4th attribute is set within the parse_fitch() function
     # using the build_index_dict() method.
     self.index_dict = None # type: Dict[str, List[int]] | None
     # The last attribute is set by validate_all() method.
     self.validated = None # type: bool | None
+    # set while the node is cut out of the proof, see Ann.premise
+    self.removed_with = None # type: ProofNode | None
+    # the root of the proof the node belongs to, set by build_index()
+    self.proof_root = None # type: ProofNode | None
+
+  def __deepcopy__(self, memo):
+    """ Copy the subtree without recursion. All the copies are put in 
+        memo first, so that the premises referring to nodes within the 
+        subtree are redirected to the copies, while the other premises 
+        keep referring to the original nodes. """
+    import copy
+
+    pairs = []
+    stack = [self]
+    while stack:
+      p_node = stack.pop()
+      new = p_node.__class__.__new__(p_node.__class__)
+      memo[id(p_node)] = new
+      pairs.append((p_node, new))
+      stack.extend(p_node.children)
+    for p_node, new in pairs:
+      for key, value in p_node.__dict__.items():
+        if key == 'children':
+          value = [memo[id(kid)] for kid in value]
+        elif key in ('removed_with', 'proof_root', 'parent'):
+          value = memo.get(id(value), value)
+        elif key in ('line_tree', 'slot'): # built again when needed
+          value = None
+        else:
+          value = copy.deepcopy(value, memo)
+        new.__dict__[key] = value
+    return memo[id(self)]
+
+  @property
+  def index_dict(self) -> Dict[str, List[int]] | None:
+    if self.stale:
+      self.refresh_index()
+    return self._index_dict
+
+  @index_dict.setter
+  def index_dict(self, value: Dict[str, List[int]] | None) -> None:
+    self._index_dict = value
 
   def __str__(self) -> str:
     return self.build_fitch_text()
@@ -504,7 +649,7 @@ class ProofNode:
     return ret_str_common + ret_str
     
   def build_fitch_text(self) -> str:
-    """ Recursively build Fitch-style proof text which looks like:
+    """ Build Fitch-style proof text which looks like:
       │1. A imp B  .hyp
       │2. B imp C  .hyp
       ├─
@@ -514,26 +659,73 @@ class ProofNode:
       ││5. C   .imp elim 2,4
       │6. A imp C  .imp intro 3-5    
     """    
+    if self.stale:
+      self.refresh_index()
+    return emit_items(self, ProofNode.fitch_text_items)
+
+  def write_fitch_text(self, out, marks: bool = False, 
+                       color: bool = False) -> None:
+    """ Write the text of build_fitch_text() to the text stream out,
+        one line at a time. marks and color are as in line_text(). """
+    if self.stale:
+      self.refresh_index()
+    for line_str in iter_items(self, lambda node: 
+                               node.fitch_text_items(marks, color)):
+      out.write(line_str)
+
+  def fitch_text_items(self, marks: bool = False, 
+                       color: bool = False) -> list:
+    # items for emit_items(): strings and subproofs to be expanded
     level = len(self.index) if self.index else 0 # always >= 1
     if self.children: # subproof case
-      ret_str = ''
+      items = []
       b_hyp = True 
       for kid in self.children:
         # When the line changes from hyp to non-hyp, insert '├─\n'.
         if b_hyp and not kid.label.is_hyp:
           b_hyp = False
-          ret_str += VERT * (level - 1) + '├─\n'
+          items.append(VERT * (level - 1) + '├─\n')
         # Output the line for leaf nodes only.
         if kid.label.type != LabelType.SUBPROOF: # output for leaf node 
-          line_str = f"{kid.label}"
-          ret_str += VERT * level + f'{kid.line_num}. ' + line_str + '\n'
-        else: # recursively call build_fitch_text() for subproofs
-          ret_str += kid.build_fitch_text()
+          line_str = kid.line_text(marks, color)
+          items.append(VERT * level + f'{kid.line_num}. ' + line_str + '\n')
+        else: # subproofs are expanded in their turn
+          items.append(kid)
+      return items
+    else:
+      line_str = self.line_text(marks, color)
+      return [VERT * level + f'{self.line_num}. ' + line_str + '\n']
+
+  def line_text(self, marks: bool = False, color: bool = False) -> str:
+    """ The text of a line after its line number. With marks, formula
+        lines show a check mark or an x-mark as in show_fitch_text(),
+        colored if color is True. """
+    label = self.label
+    if not marks or label.type != LabelType.FORMULA:
+      return f"{label}"
+    fmla_str = label.formula_str()
+    # 'top' is empty formula
+    fmla_str = '' if fmla_str == 'top' else fmla_str
+    red, green, reset = (Fore.LIGHTRED_EX, Fore.LIGHTGREEN_EX, Fore.RESET) \
+                        if color else ('', '', '')
+    if label.is_hyp:
+      return f"{fmla_str}\t .hyp"
+    elif not isinstance(label.ann, Ann):
+      return f"{fmla_str}\t{red}x {label.ann}{reset}"
+    elif not self.validated:
+      return f"{fmla_str}\t{red}x{reset} {label.ann}"
+    elif fmla_str:
+      return f"{fmla_str}\t{green}\u2713{reset} {label.ann}"
     else:
-      line_str = f"{self.label}"
-      ret_str = VERT * level + f'{self.line_num}. ' + line_str + '\n'
-      
-    return ret_str
+      return f" {label.ann}"
+
+  def build_fitch_rows(self) -> List[str]:
+    """ The rows of build_fitch_text() with the validation marks of
+        show_fitch_text(), as a list. See rows_delta(). """
+    if self.stale:
+      self.refresh_index()
+    text = emit_items(self, lambda node: node.fitch_text_items(True))
+    return text.splitlines()
 
   def show_fitch_text(self, verbose: bool = True) -> None:
     """ If verbose is False, then simply print the return value of 
@@ -542,133 +734,166 @@ class ProofNode:
         check mark for success and x-mark for failure. 
         We allow verbose to be an integer so that we can use 1  
         in place of True.
+        The lines are written to sys.stdout as they are rendered.
     """
-    def show_line(node, level):
-      print(VERT * level, sep="", end="")
-      print(f"{node.line_num}. ", sep="", end="")
-      # Now, we print the line with colored marks for formula lines.
-      # Comment/blank lines are relatively easy to handle.
-      label = node.label
-      if label.type == LabelType.FORMULA:
-        fmla_str = f"{label.formula}"
-        # 'top' is empty formula
-        fmla_str = '' if fmla_str == 'top' else fmla_str
-        if not label.is_hyp: # formula line in conclusion
-          if isinstance(label.ann, Ann):
-            print(fmla_str, end="")
-            if node.validated: # show green check-mark
-              if fmla_str != '': # non-empty formula case only
-                print("\t", Fore.LIGHTGREEN_EX, '\u2713', Fore.RESET, 
-                      sep="", end="")
-            else: # show red x-mark
-              print("\t", Fore.LIGHTRED_EX, 'x', Fore.RESET, sep="", end="")
-            print(f" {label.ann}")
-          else:
-            print(fmla_str, end="")
-            print("\t", Fore.LIGHTRED_EX, 'x', f" {label.ann}", Fore.RESET, sep="")
-        else: # hypothesis
-          print(f"{fmla_str}\t .hyp")
-      else: # comment or blank line
-        print(f"{label}")
-    
-    text_str = self.build_fitch_text()
-    #^ Each line in text_str has been treated so that 
-    #  left border uses VERT and line numbers exist etc.
+    if self.stale:
+      self.refresh_index()
     if not verbose:
-      print(text_str) # trivial
-    else:
-      # Show whether each line is validated or not by colored marks.
-      # Of course this is for formula line only.
-      level = len(self.index) if self.index else 0 # always >= 1
-      if self.children:
-        b_hyp = True
-        for kid in self.children:
-          # When the line changes from hyp to non-hyp, insert '├─\n'.
-          if b_hyp and not kid.label.is_hyp:
-            b_hyp = False
-            print(VERT * (level - 1) + '├─')
-          # Output the line for leaf nodes only.
-          if kid.label.type != LabelType.SUBPROOF:
-            show_line(kid, level) # level is the parent's level
-          else:
-            kid.show_fitch_text(verbose)
-          # end of for loop
-      else:
-        show_line(self, level - 1)
+      self.write_fitch_text(sys.stdout)
+      print()
+    elif self.children:
+      self.write_fitch_text(sys.stdout, True, True)
+    else: # a single line, shown at the level of its parent
+      level = len(self.index) if self.index else 0
+      print(VERT * (level - 1) + f"{self.line_num}. " + 
+            self.line_text(True, True))
 
   def build_fitch_latex(self, verbose: bool = True) -> str:
     """ Build a Fitch-style proof latex source. 
         Need proofmood.sty for compilation.
         `self` must be a subproof. """
-    def build_fitch_latex_rec(node: ProofNode) -> str:
-      ret_str = ''
-      b_hyp = True
-      level = len(node.index) if node.index else 0 # always >= 1
-      for kid in node.children:
-        # When the line changes from hyp to non-hyp, insert '├─\n'.
-        if b_hyp and not kid.label.is_hyp:
-          b_hyp = False
-          ret_str += "& " +  "\\pmvert " * (level - 1) + \
-                     "\\pmproves & & & \\\\\n"
-        # Output the line for leaf nodes only.
-        label = kid.label
-        if label.type != LabelType.SUBPROOF: # subproof is internal node
-          line_num = "\\pnumb{" + f'{kid.line_num}'+ "} "
-          if label.type == LabelType.FORMULA:
-            vert = "& " + "\\pmvert " * level
-            fmla = "\\pform{" + label.formula.ast.build_infix('latex') + "} "
-            if verbose and not kid.label.is_hyp:
-              check = '& \\chkch ' if kid.validated else '& \\chkx '
+    out = io.StringIO()
+    self.write_fitch_latex(out, verbose)
+    return out.getvalue()
+
+  def write_fitch_latex(self, out, verbose: bool = True) -> None:
+    """ Write the latex source of build_fitch_latex() to the text 
+        stream out, one line at a time. """
+    if self.stale:
+      self.refresh_index()
+    out.write("% \\usepackage{proofmood}\n\\begin{fitchproof}\n")
+    for line_str in iter_items(self, lambda node: 
+                               node.fitch_latex_items(verbose)):
+      out.write(line_str)
+    out.write("\\end{fitchproof}\n")
+
+  def fitch_latex_items(self, verbose: bool = True) -> list:
+    # items for write_fitch_latex(): strings and subproofs to be expanded
+    items = []
+    b_hyp = True
+    level = len(self.index) if self.index else 0 # always >= 1
+    for kid in self.children:
+      # When the line changes from hyp to non-hyp, insert '├─\n'.
+      if b_hyp and not kid.label.is_hyp:
+        b_hyp = False
+        items.append("& " +  "\\pmvert " * (level - 1) + 
+                     "\\pmproves & & & \\\\\n")
+      # Output the line for leaf nodes only.
+      label = kid.label
+      if label.type != LabelType.SUBPROOF: # subproof is internal node
+        line_num = "\\pnumb{" + f'{kid.line_num}'+ "} "
+        if label.type == LabelType.FORMULA:
+          vert = "& " + "\\pmvert " * level
+          fmla = "\\pform{" + label.formula_str('latex') + "} "
+          if verbose and not kid.label.is_hyp:
+            check = '& \\chkch ' if kid.validated else '& \\chkx '
+          else:
+            check = "& \\chknull "
+          # Annotation part
+          if isinstance(label.ann, Ann) and label.ann.rule : 
+            # successfully parsed
+            rule_li = label.ann.rule.value.split() # type: ignore
+            rule_name = rule_li[0]
+            if len(rule_li) == 1:
+              rule_inf = "& \\infrul{" + rule_name + "} "
+            else:
+              assert rule_name in Node.LATEX_DICT
+              rule_latex = Node.LATEX_DICT.get(rule_name)
+              intro_elim = rule_li[1]
+              rule_inf = "& \\infrule{" + rule_latex + "}{" + intro_elim \
+                         + "}"
+            if label.ann.premise:
+              prem = "& \\pmprem{" + ",".join(label.ann.premise) + "} "
             else:
-              check = "& \\chknull "
-            # Annotation part
-            if isinstance(label.ann, Ann) and label.ann.rule : 
-              # successfully parsed
-              rule_li = label.ann.rule.value.split() # type: ignore
-              rule_name = rule_li[0]
-              if len(rule_li) == 1:
-                rule_inf = "& \\infrul{" + rule_name + "} "
-              else:
-                assert rule_name in Node.LATEX_DICT
-                rule_latex = Node.LATEX_DICT.get(rule_name)
-                intro_elim = rule_li[1]
-                rule_inf = "& \\infrule{" + rule_latex + "}{" + intro_elim \
-                           + "}"
-              if label.ann.premise:
-                prem = "& \\pmprem{" + ",".join(label.ann.premise) + "} "
-              else:
-                prem = "& "
-            else: # failed to parse or empty annotation. 
-              # if failed to parse, then label.ann is a string.
-              if isinstance(label.ann, str):
-                ann_str = "\\; ".join(label.ann.split())
-              else:
-                ann_str = ''
-              rule_inf = "&  \\multicolumn{2}{l}{" + "\\infruleErr{" + \
-                ann_str + "}} "
-              prem = ""
-            nl = "\\pmnl\n"
-            ret_str +=  vert + line_num + fmla + check + rule_inf + prem + nl
-          else: # label.type == 'comment.*' | 'blank.*'
-            word_li = kid.label.line.replace("#", "\\#").split()
-            line_str = "\\infrul{" + "\\; ".join(word_li) + "}"
-            vert = "\\pmvert " * level
-            ret_str += "& \\multicolumn{4}{l}{" + vert + line_num + \
-                       line_str + "} " + "\\pmnl\n"
-        else: # recursively call build_fitch_latex_rec() for subproofs
-          ret_str += build_fitch_latex_rec(kid)
-          ret_str += "& " +  "\\pmvert " * level + "& & & \\\\\n"
-      return ret_str
-
-    ret_str = "% \\usepackage{proofmood}\n" + \
-              "\\begin{fitchproof}\n"
-    ret_str += build_fitch_latex_rec(self)
-    ret_str += "\\end{fitchproof}\n"
-    return ret_str
+              prem = "& "
+          else: # failed to parse or empty annotation. 
+            # if failed to parse, then label.ann is a string.
+            if isinstance(label.ann, str):
+              ann_str = "\\; ".join(label.ann.split())
+            else:
+              ann_str = ''
+            rule_inf = "&  \\multicolumn{2}{l}{" + "\\infruleErr{" + \
+              ann_str + "}} "
+            prem = ""
+          nl = "\\pmnl\n"
+          items.append(vert + line_num + fmla + check + rule_inf + prem + nl)
+        else: # label.type == 'comment.*' | 'blank.*'
+          word_li = kid.label.line.replace("#", "\\#").split()
+          line_str = "\\infrul{" + "\\; ".join(word_li) + "}"
+          vert = "\\pmvert " * level
+          items.append("& \\multicolumn{4}{l}{" + vert + line_num + 
+                       line_str + "} " + "\\pmnl\n")
+      else: # subproofs are expanded in their turn
+        items.append(kid)
+        items.append("& " +  "\\pmvert " * level + "& & & \\\\\n")
+    return items
   
+  def build_fitch_html(self, verbose: bool = True) -> str:
+    """ Build a Fitch-style proof as an HTML table with inline SVG scope
+        bars. The output carries its own style sheet and needs neither 
+        TeX nor MathJax. If verbose, validation marks are shown as in 
+        show_fitch_text(). `self` must be a subproof. """
+    out = io.StringIO()
+    self.write_fitch_html(out, verbose)
+    return out.getvalue()
+
+  def write_fitch_html(self, out, verbose: bool = True) -> None:
+    """ Write the HTML of build_fitch_html() to the text stream out, 
+        one row at a time. """
+    if self.stale:
+      self.refresh_index()
+    out.write(f'<style>{FITCH_CSS}</style>\n{FITCH_BAR_DEFS}\n'
+              '<table class="pm-fitch">\n')
+    for row_str in iter_items(self, lambda node: 
+                              node.fitch_html_items(verbose)):
+      out.write(row_str)
+    out.write('</table>\n')
+
+  def fitch_html_items(self, verbose: bool = True) -> list:
+    # items for write_fitch_html(): strings and subproofs to be expanded
+    items = []
+    b_hyp = True
+    level = len(self.index) if self.index else 0 # always >= 1
+    for kid in self.children:
+      # When the line changes from hyp to non-hyp, insert the scope bar.
+      if b_hyp and not kid.label.is_hyp:
+        b_hyp = False
+        items.append('<tr><td></td><td class="pm-line">' + 
+                     scope_bars_svg(level, True) + '</td><td></td></tr>\n')
+      # Output the line for leaf nodes only.
+      if kid.label.type != LabelType.SUBPROOF:
+        items.append(f'<tr><td class="pm-num">{kid.line_num}.</td>'
+                     '<td class="pm-line">' + scope_bars_svg(level) + 
+                     kid.line_html(verbose) + '</td></tr>\n')
+      else: # subproofs are expanded in their turn
+        items.append(kid)
+    return items
+
+  def line_html(self, verbose: bool = True) -> str:
+    # The formula cell and the annotation cell of a leaf row of 
+    # build_fitch_html(), or a single cell for comments and blank lines.
+    label = self.label
+    if label.type != LabelType.FORMULA:
+      return ('<span class="pm-comment">' + html.escape(label.line) + 
+              '</span></td><td>')
+    fmla_str = '' if label.formula_str() == 'top' \
+               else label.formula_str('html')
+    if label.is_hyp:
+      ann_str = 'hyp'
+    else:
+      ann_str = html.escape(f"{label.ann}".strip())
+    if not isinstance(label.ann, Ann):
+      ann_str = f'<span class="pm-err">x {ann_str}</span>'
+    elif verbose and not label.is_hyp:
+      if not self.validated:
+        ann_str = '<span class="pm-err">x</span> ' + ann_str
+      elif fmla_str:
+        ann_str = '<span class="pm-ok">\u2713</span> ' + ann_str
+    return fmla_str + '</td><td>' + ann_str
+
   def build_index(self, p_index: List[int] = [], i: int = 0, 
                   l_num: int = 1) -> int:
-    """ Recursively set self.index and self.line_num.
+    """ Set self.index and self.line_num of self and its descendants.
         Automatically called by the parse_fitch() function, where
         self is the root of the entire proof.
 
@@ -676,33 +901,259 @@ class ProofNode:
         i is the (list)index(: int) of self in the parent's children list. 
         l_num is the line number to be given to self for leaf nodes.
         Return value is the increment of line number for the next leaf.
-        self.index is recursively set from the root to the leaves.
-        self.line_num is recursively set from the leaves to the root. 
+        self.index is set from the root to the leaves, and
+        self.line_num and self.n_lines are set from the leaves to the root. 
     """
     self.index = p_index + [i]
-    if self.children: # subproof case
-      line_inc = 0 # tentative return value
-      for i, kid in enumerate(self.children):
-        line_inc += kid.build_index(self.index, i, l_num + line_inc)
-      self.line_num = f"{l_num}-{l_num + line_inc - 1}"
-    else: # leaf node case
-      self.line_num = str(l_num)
-      line_inc = 1
-
-    return line_inc
+    self.proof_root = self
+    l_next = l_num # line number of the next leaf
+    stack = [[self, 0, l_num]] # [node, next kid to visit, first line]
+    while stack:
+      top = stack[-1]
+      node, k, first = top
+      if k < len(node.children):
+        top[1] += 1
+        kid = node.children[k]
+        kid.index = node.index + [k]
+        kid.proof_root = self
+        kid.parent = node
+        stack.append([kid, 0, l_next])
+      else: # all the kids are done
+        stack.pop()
+        if node.children: # subproof case
+          node.line_num = f"{first}-{l_next - 1}"
+        else: # leaf node case
+          node.line_num = str(l_next)
+          l_next += 1
+        node.n_lines = l_next - first
+        node.line_tree = None
+
+    return l_next - l_num
   
   def build_index_dict(self) -> Dict[str, List[int]]:
-    """ Recursively build a dictionary with line numbers as keys and 
-        corresponding tree indices as values.
+    """ Build a dictionary with line numbers as keys and 
+        corresponding tree indices as values, in preorder.
         Automatically called by the parse_fitch() function after build_index()
         has been called, where self is the root of the whole proof.
         The Return value is saved as proof_root.index_dict.
     """
     ret_dict = {}
-    ret_dict[self.line_num] = self.index
-    for kid in self.children:
-      ret_dict.update(kid.build_index_dict())
+    stack = [self]
+    while stack:
+      p_node = stack.pop()
+      ret_dict[p_node.line_num] = p_node.index
+      stack.extend(reversed(p_node.children))
     return ret_dict
+
+  def refresh_index(self) -> None:
+    """ Renew index, line_num and index_dict of the whole proof after
+        edits which only updated the line counts by splice().
+        self must be the root of the whole proof. """
+    self.stale = False
+    self.build_index()
+    self.index_dict = self.build_index_dict()
+
+  def lines_changed(self, index: List[int]) -> None:
+    """ The kids of the node at tree index `index` have been inserted,
+        deleted or replaced in place. Update n_lines of that node and its
+        ancestors. The edit methods use splice() instead, which does not
+        build the LineTree of the node again.
+        Line numbers are renewed lazily: locate() finds a line from the
+        line counts, and the first access to index_dict calls
+        refresh_index(). self must be the root of the whole proof. """
+    p_node = self.get_p_node(index)
+    for kid in p_node.children:
+      kid.parent = p_node
+    n_lines = sum([kid.n_lines for kid in p_node.children]) \
+              if p_node.children else 1
+    p_node.line_tree = None
+    self.add_lines(p_node, n_lines - p_node.n_lines)
+    self.stale = True
+
+  def splice(self, parent, rank: int, n_del: int, p_node_li) -> list:
+    """ Replace the n_del kids of parent from `rank` on by p_node_li,
+        like parent.children[rank:rank + n_del] = p_node_li, and update 
+        the line counts of parent and its ancestors in 
+        O(depth * log(number of kids)) time, plus the sizes of the kids 
+        inserted and deleted. Return the kids deleted.
+        self must be the root of the whole proof. """
+    removed = parent.children[rank:rank + n_del]
+    n_lines = parent.n_lines if parent.children else 0
+    parent.children[rank:rank + n_del] = p_node_li
+    if parent.line_tree is not None:
+      parent.line_tree.delete(rank, n_del)
+      parent.line_tree.insert(rank, p_node_li)
+    for kid in removed:
+      kid.parent = None
+      kid.slot = None
+      n_lines -= kid.n_lines
+    for kid in p_node_li:
+      kid.parent = parent
+      n_lines += kid.n_lines
+    if not parent.children:
+      n_lines = 1
+    self.add_lines(parent, n_lines - parent.n_lines)
+    self.stale = True
+    return removed
+
+  def add_lines(self, p_node, delta: int) -> None:
+    # add delta to n_lines of p_node and its ancestors
+    if delta == 0:
+      return
+    p_node.n_lines += delta
+    while p_node.parent is not None:
+      up = p_node.parent
+      if up.line_tree is not None:
+        up.line_tree.add(p_node, delta)
+      up.n_lines += delta
+      p_node = up
+
+  def get_line_tree(self): # LineTree type
+    if self.line_tree is None:
+      self.line_tree = LineTree(self.children)
+    return self.line_tree
+
+  def first_line(self, index: List[int]) -> int:
+    """ The first line number of the node at tree index `index`,
+        from the line counts. self must be the root of the whole proof. """
+    l_num = 1
+    p_node = self
+    for i in index[1:]:
+      if i > 0:
+        l_num += p_node.get_line_tree().prefix(i)
+      p_node = p_node.children[i]
+    return l_num
+
+  def locate(self, line_num: str): # ProofNode type
+    """ Find the node with line_num from the line counts, without
+        index_dict. index and line_num of the nodes on the path from
+        the root are set on the way. self must be the root of the whole
+        proof. """
+    s = int(line_num.split('-')[0])
+    offset = s - 1 # offset of line s within p_node
+    if not 0 <= offset < self.n_lines:
+      raise ValueError(f"get_p_node(): line number '{line_num}' not found")
+    p_node = self
+    index = self.index or [0]
+    while True:
+      p_node.index = index
+      if p_node.children:
+        p_node.line_num = f"{s - offset}-{s - offset + p_node.n_lines - 1}"
+      else:
+        p_node.line_num = str(s)
+      if p_node.line_num == line_num:
+        return p_node
+      if not p_node.children:
+        raise ValueError(f"get_p_node(): line number '{line_num}'" 
+                         " not found")
+      k = 0
+      if offset > 0:
+        k, offset = p_node.get_line_tree().search(offset)
+      p_node = p_node.children[k]
+      index = index + [k]
+
+  def place(self, p_node) -> bool:
+    """ Renew index and line_num of p_node from the line counts, going up
+        to the root. Return False if p_node is not in the proof.
+        self must be the root of the whole proof. """
+    ranks = []
+    l_num = 1
+    node = p_node
+    while node is not self:
+      up = node.parent
+      found = up.get_line_tree().rank(node) if up is not None else None
+      if found is None:
+        return False
+      ranks.append(found[0])
+      l_num += found[1]
+      node = up
+    p_node.index = (self.index or [0]) + ranks[::-1]
+    p_node.line_num = f"{l_num}-{l_num + p_node.n_lines - 1}" \
+                      if p_node.children else str(l_num)
+    return True
+
+  def iter_lines(self, start: int = 1):
+    """ Yield the leaves from line number `start` on, in order, with
+        index and line_num renewed from the line counts on the way.
+        self must be the root of the whole proof. """
+    if not 1 <= start <= self.n_lines:
+      return
+    stack = [] # [node, rank of the next kid]
+    p_node = self
+    p_node.index = self.index or [0]
+    offset = start - 1
+    l_num = start - offset
+    while p_node.children: # go down to line `start`
+      p_node.line_num = f"{l_num}-{l_num + p_node.n_lines - 1}"
+      k = 0
+      if offset > 0:
+        k, offset = p_node.get_line_tree().search(offset)
+      stack.append([p_node, k + 1])
+      l_num = start - offset
+      p_node.children[k].index = p_node.index + [k]
+      p_node = p_node.children[k]
+    p_node.line_num = str(start)
+    yield p_node
+    l_num = start + 1
+    while stack:
+      top = stack[-1]
+      node, k = top
+      if k == len(node.children):
+        stack.pop()
+        continue
+      top[1] += 1
+      kid = node.children[k]
+      kid.index = node.index + [k]
+      if kid.children:
+        kid.line_num = f"{l_num}-{l_num + kid.n_lines - 1}"
+        stack.append([kid, 0])
+      else:
+        kid.line_num = str(l_num)
+        l_num += 1
+        yield kid
+
+  def bind_premises(self, p_node_li=None) -> None:
+    """ Replace the node codes in the premises of the annotations by
+        the nodes they refer to, in the subtrees p_node_li, or in the
+        whole proof by default. Node codes which refer to no node are 
+        kept as they are. self must be the root of the whole proof. """
+    stack = list(p_node_li) if p_node_li is not None else [self]
+    while stack:
+      p_node = stack.pop()
+      stack.extend(p_node.children)
+      ann = p_node.label.ann
+      if isinstance(ann, Ann) and ann.premise_refs:
+        ann.premise_refs = [self.premise_node(ref) if isinstance(ref, str)
+                            else ref for ref in ann.premise_refs]
+
+  def premise_node(self, node_code: str): # ProofNode | str type
+    try:
+      return self.get_p_node(node_code)
+    except ValueError:
+      return node_code
+
+  def rebind_premises(self, p_node_li) -> None:
+    """ Bind the premises in the subtrees p_node_li which refer to nodes
+        of another proof to the nodes of self with the same line numbers.
+        This happens when p_node_li was cut from a copy of self. 
+        self must be the root of the whole proof. """
+    inside = set()
+    stack = list(p_node_li)
+    while stack:
+      p_node = stack.pop()
+      stack.extend(p_node.children)
+      inside.add(id(p_node))
+    stack = list(p_node_li)
+    while stack:
+      p_node = stack.pop()
+      stack.extend(p_node.children)
+      ann = p_node.label.ann
+      if isinstance(ann, Ann) and ann.premise_refs:
+        ann.premise_refs = [ref if isinstance(ref, str) or 
+                            id(ref) in inside or ref.proof_root is self or
+                            ref.removed_with is not None
+                            else self.premise_node(ref.line_num)
+                            for ref in ann.premise_refs]
     
   def get_p_node(self, node_code: List[int] | str | int): # ProofNode type
     """ Get and return the p_node specified by node_code, which 
@@ -710,11 +1161,14 @@ class ProofNode:
         Integer node_code is accepted as a line number.
         node_code of the form 's-e' is accepted too of course.
         self must be the root of the whole proof. """
-    assert self.index_dict is not None, "get_p_node(): index_dict is None"
+    assert self.stale or self.index_dict is not None, \
+      "get_p_node(): index_dict is None"
     p_node = self
     if isinstance(node_code, int):
       node_code = str(node_code)
-    if isinstance(node_code, str): # node_code: line_number = str
+    if isinstance(node_code, str) and self.stale:
+      p_node = self.locate(node_code)
+    elif isinstance(node_code, str): # node_code: line_number = str
       index = self.index_dict.get(node_code)
       if index is not None:
         p_node = self.get_p_node(index) 
@@ -722,11 +1176,10 @@ class ProofNode:
         raise ValueError(f"get_p_node(): line number '{node_code}'" 
                          " not found")
     else: # node_code: tree_index = List[int]
-      if node_code == self.index:
-        p_node = self
-      else:
-        for i in node_code[1:]:
-          p_node = p_node.children[i]
+      for i in node_code[1:]:
+        p_node = p_node.children[i]
+      if self.stale:
+        p_node.index = list(node_code)
     return p_node 
   
   def toggle_node_code(self, node_code: List[int] | str) -> str | List[int]:
@@ -752,20 +1205,19 @@ class ProofNode:
       is_earlier(node_code1, node_code2) 
     being True.
     """
-    assert self.index_dict is not None, "get_p_node(): index_dict is None"
+    assert self.stale or self.index_dict is not None, \
+      "is_earlier(): index_dict is None"
     
     # make sure that both node_code1 and node_code2 are of t_idx type
     n_code1 = node_code1
     n_code2 = node_code2
-    t_idx1 = node_code1 if isinstance(node_code1, list) \
-                  else self.index_dict.get(node_code1)
+    t_idx1 = self.tree_index(node_code1)
     if t_idx1 is None:
       if verbose:
         print("is_earlier(): node_code=", Fore.YELLOW, f"'{n_code1}'",
               Fore.RESET, " not found in index_dict\n", sep="")
       return False
-    t_idx2 = node_code2 if isinstance(node_code2, list) \
-                  else self.index_dict.get(node_code2)
+    t_idx2 = self.tree_index(node_code2)
     if t_idx2 is None:
       if verbose:
         print("is_earlier(): node_code=", Fore.YELLOW, f"'{n_code2}'",
@@ -779,6 +1231,17 @@ class ProofNode:
            t_idx1[:-1] == t_idx2[:len1 - 1] and \
            t_idx1[-1] < t_idx2[len1 - 1]
   
+  def tree_index(self, node_code) -> List[int] | None:
+    # node_code as a tree index, or None if there is no such node
+    if isinstance(node_code, list):
+      return node_code
+    if not self.stale:
+      return self.index_dict.get(node_code)
+    try:
+      return self.locate(node_code).index
+    except ValueError:
+      return None
+
   def verified_by(self, conc: str | int, rule_inf: RuleInfer, 
                   premise: List[str] = [], verbose=False) -> bool:
     """ Test if the conclusion with line number conc is verified by 
@@ -786,7 +1249,8 @@ class ProofNode:
         self must be the root of the whole proof. """
     conc = str(conc) # type coercion
     assert bLeafNode(conc), f"verified_by(): line {conc} is not conclusion"
-    assert self.index_dict is not None, "verified_by(): index_dict is None"
+    assert self.stale or self.index_dict is not None, \
+      "verified_by(): index_dict is None"
     p_node = self.get_p_node(conc) # ProofNode type
     assert p_node.label.type == LabelType.FORMULA, \
       f"verified_by(): conclusion='{conc}' is not a formula"
@@ -794,7 +1258,7 @@ class ProofNode:
       return True
     else:
       fmla = p_node.label.formula
-      if f"{fmla}" == 'top':
+      if p_node.label.formula_str() == 'top':
         return True
       conclusion = FormulaProp(fmla.ast) 
       premise_nodes = []
@@ -856,11 +1320,12 @@ class ProofNode:
     """
     conc = str(conc) # type coercion
     assert bLeafNode(conc), f"verified(): line {conc} is not conclusion"
-    assert self.index_dict is not None, "verified_by(): index_dict is None"
+    assert self.stale or self.index_dict is not None, \
+      "verified_by(): index_dict is None"
     p_node = self.get_p_node(conc) # ProofNode type
     if p_node.label.type == LabelType.FORMULA:
       fmla = p_node.label.formula
-      if f"{fmla}" == 'top':
+      if p_node.label.formula_str() == 'top':
         return True
     ann = p_node.label.ann
     if not isinstance(ann, Ann) or not ann.rule:
@@ -887,24 +1352,34 @@ class ProofNode:
     return True
 
   def show_validation_result(self):  
+    print(self.validation_result_str(color=True))
+
+  def validation_result_str(self, color: bool = False) -> str:
+    # The one-line summary printed by show_validation_result().
+    green, red, reset = (Fore.LIGHTGREEN_EX, Fore.LIGHTRED_EX, Fore.RESET) \
+                        if color else ('', '', '')
     if self.verified_all():
-      print("The proof is", Fore.LIGHTGREEN_EX, 
-            " all valid", Fore.RESET, ".\n", sep='')
-    else:
-      print("The proof is", Fore.LIGHTRED_EX, 
-            " invalid", Fore.RESET, ".\n", sep='')
+      return f"The proof is{green} all valid{reset}.\n"
+    return f"The proof is{red} invalid{reset}.\n"
 
-  def validate_all(self) -> None:
-    # set the p_node.validated attribute of each node
-    for node_code in self.index_dict: 
-      if bSubproof(node_code):
-        continue
-      p_node = self.get_p_node(node_code)
-      if (label := p_node.label).type == LabelType.FORMULA and \
-          not label.is_hyp:
-        p_node.validated = self.verified(node_code)
-      else: # hyp, comment, blank are all considered as validated
-        p_node.validated = True 
+  def validate_all(self, start: int = 1) -> None:
+    # set the p_node.validated attribute of each line from line number
+    # `start` on, which are found from the line counts by iter_lines()
+    for p_node in self.iter_lines(start):
+      self.validate_line(p_node)
+
+  def validate_line(self, p_node) -> None:
+    # set p_node.validated of a leaf whose line_num is up to date
+    if (label := p_node.label).type == LabelType.FORMULA and \
+        not label.is_hyp:
+      ann = label.ann
+      if self.stale and isinstance(ann, Ann) and ann.premise_refs:
+        for ref in ann.premise_refs: # renew the premise line numbers
+          if not isinstance(ref, str):
+            self.place(ref)
+      p_node.validated = self.verified(p_node.line_num)
+    else: # hyp, comment, blank are all considered as validated
+      p_node.validated = True 
 
   def num_nodes_hyp(self) -> int:
     """ Return the number of nodes in the hypothesis part. """
@@ -986,6 +1461,7 @@ def parse_fitch(proof_str: str='', validate=True, tabsize: int = 2) \
           Fore.YELLOW, "non-ground level\n" + Fore.RESET, sep="")
   proof_node.build_index()
   proof_node.index_dict = proof_node.build_index_dict()
+  proof_node.bind_premises()
   # Check that in all subproofs, the hypothesis have at least one line
   # and at most one formula.
   for node_code in proof_node.index_dict:
@@ -1039,6 +1515,203 @@ def unique(li: List[bool]) -> bool:
   # test if there is only one True in li
   return eq_n(li, 1)
 
+class LineSlot:
+  # a kid of a ProofNode in the LineTree of its parent
+  __slots__ = ('kid', 'lines', 'size', 'total', 'prio', 'left', 'right', 
+               'up')
+
+  def __init__(self, kid):
+    self.kid = kid
+    kid.slot = self
+    self.lines = kid.n_lines
+    self.size = 1 # number of kids in this subtree
+    self.total = self.lines # number of lines in this subtree
+    self.prio = random.random()
+    self.left = self.right = self.up = None
+
+  def pull(self) -> None:
+    # renew size and total from the two subtrees
+    self.size = 1
+    self.total = self.lines
+    for sub in (self.left, self.right):
+      if sub is not None:
+        sub.up = self
+        self.size += sub.size
+        self.total += sub.total
+
+class LineTree:
+  """ Balanced binary tree(treap) over the kids of a ProofNode in order,
+      where each subtree knows the number of its kids and lines. 
+      A line is found by its offset, and a kid is inserted, deleted, 
+      counted or found by its rank in O(log(number of kids)) time. 
+      Each kid knows its LineSlot, so that its rank is found going up
+      from there. """
+  def __init__(self, kids):
+    self.root = self.build(kids)
+
+  @staticmethod
+  def build(kids): # LineSlot | None type
+    # treap of the kids in O(len(kids)) time
+    stack = [] # the right spine
+    for kid in kids:
+      slot = LineSlot(kid)
+      last = None
+      while stack and stack[-1].prio < slot.prio:
+        last = stack.pop()
+        last.pull()
+      slot.left = last
+      if stack:
+        stack[-1].right = slot
+      stack.append(slot)
+    while len(stack) > 1:
+      stack.pop().pull()
+    if not stack:
+      return None
+    stack[0].pull()
+    stack[0].up = None
+    return stack[0]
+
+  def split(self, slot, k: int) -> tuple:
+    # split the subtree at slot into the first k kids and the others
+    if slot is None:
+      return None, None
+    n_left = slot.left.size if slot.left is not None else 0
+    if k <= n_left:
+      first, slot.left = self.split(slot.left, k)
+      slot.pull()
+      return first, slot
+    slot.right, rest = self.split(slot.right, k - n_left - 1)
+    slot.pull()
+    return slot, rest
+
+  def merge(self, first, rest): # LineSlot | None type
+    if first is None:
+      return rest
+    if rest is None:
+      return first
+    if first.prio > rest.prio:
+      first.right = self.merge(first.right, rest)
+      first.pull()
+      return first
+    rest.left = self.merge(first, rest.left)
+    rest.pull()
+    return rest
+
+  def insert(self, rank: int, kids) -> None:
+    if not kids:
+      return
+    first, rest = self.split(self.root, rank)
+    self.root = self.merge(self.merge(first, self.build(kids)), rest)
+    self.root.up = None
+
+  def delete(self, rank: int, n: int) -> None:
+    if n == 0:
+      return
+    first, rest = self.split(self.root, rank)
+    removed, rest = self.split(rest, n)
+    self.root = self.merge(first, rest)
+    if self.root is not None:
+      self.root.up = None
+    stack = [removed]
+    while stack:
+      slot = stack.pop()
+      if slot is not None:
+        slot.kid.slot = None
+        stack.extend([slot.left, slot.right])
+
+  def add(self, kid, delta: int) -> None:
+    # kid.n_lines has changed by delta
+    slot = kid.slot
+    slot.lines += delta
+    while slot is not None:
+      slot.total += delta
+      slot = slot.up
+
+  def rank(self, kid) -> Tuple[int, int] | None:
+    """ (rank of kid, number of lines of the kids before it), or None if
+        kid is not in the tree. """
+    slot = kid.slot
+    if slot is None:
+      return None
+    rank = slot.left.size if slot.left is not None else 0
+    lines = slot.left.total if slot.left is not None else 0
+    while slot.up is not None:
+      up = slot.up
+      if up.right is slot:
+        rank += 1
+        lines += up.lines
+        if up.left is not None:
+          rank += up.left.size
+          lines += up.left.total
+      slot = up
+    if slot is not self.root:
+      return None
+    return rank, lines
+
+  def prefix(self, k: int) -> int:
+    # number of lines of the first k kids
+    lines = 0
+    slot = self.root
+    while slot is not None and k > 0:
+      n_left = slot.left.size if slot.left is not None else 0
+      if k <= n_left:
+        slot = slot.left
+        continue
+      lines += slot.lines
+      if slot.left is not None:
+        lines += slot.left.total
+      k -= n_left + 1
+      slot = slot.right
+    return lines
+
+  def search(self, offset: int) -> Tuple[int, int]:
+    """ Return (k, r) such that offset = prefix(k) + r, where 
+        0 <= r < the number of lines of the kid k. """
+    k = 0
+    slot = self.root
+    while slot is not None:
+      before = slot.left.total if slot.left is not None else 0
+      n_left = slot.left.size if slot.left is not None else 0
+      if offset < before:
+        slot = slot.left
+      elif offset < before + slot.lines:
+        return k + n_left, offset - before
+      else:
+        offset -= before + slot.lines
+        k += n_left + 1
+        slot = slot.right
+    raise ValueError(f"LineTree.search(): offset out of range")
+
+def infix_html(text: str) -> str:
+  """ HTML of the text form of a formula, with symbols for connectives, 
+      quantifiers and the other words of HTML_DICT. """
+  return HTML_WORD.sub(lambda m: HTML_DICT[m.group(1)], html.escape(text))
+
+@functools.lru_cache(maxsize=None)
+def scope_bars_svg(level: int, proves: bool = False) -> str:
+  """ Inline SVG of the scope bars of a row at the given level. If proves,
+      the innermost bar ends the hypotheses of its subproof. The bars are
+      a single rectangle filled with the pattern FITCH_BAR_DEFS, so that 
+      the size of a row does not grow with its level. """
+  width = BAR_WIDTH * (level + 1 if proves else level)
+  stub = ''
+  if proves:
+    x, y = BAR_WIDTH * (level - 1) + BAR_WIDTH // 2, ROW_HEIGHT // 2
+    stub = f'<line x1="{x}" y1="{y}" x2="{width}" y2="{y}"/>'
+  return (f'<svg width="{width}" height="{ROW_HEIGHT}">'
+          f'<rect width="{BAR_WIDTH * level}" height="{ROW_HEIGHT}" '
+          f'fill="url(#pm-bar)" stroke="none"/>{stub}</svg>')
+
+def rows_delta(old_rows: List[str], new_rows: List[str]) -> dict:
+  """ The change from old_rows to new_rows, both from build_fitch_rows().
+      Only the rows which differ from the row at the same position of 
+      old_rows are given, as [position, row] pairs. The rows beyond 
+      n_rows are gone. """
+  n_old = len(old_rows)
+  changed = [[i, row] for i, row in enumerate(new_rows)
+             if i >= n_old or row != old_rows[i]]
+  return {'n_rows': len(new_rows), 'changed': changed}
+
 def num_nodes(tree, opt='terminal') -> int:
   # opt!='terminal' means count terminal nodes only
   if not tree.children:
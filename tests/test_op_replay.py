@@ -0,0 +1,120 @@
+# Replaying the op records of ProofNodeS.take_ops() on another copy of a
+# proof with apply_ops() must give the same proof, see proof_server /edit.
+
+import json, random
+
+import pytest
+
+from modules.search_prop import ProofNodeS, Ann, Formula, parse_fitch
+
+PROOF = '''A imp B .hyp
+B imp C .hyp
+proves
+  A .hyp
+  proves
+  B .imp elim 1,3
+  C .imp elim 2,4
+A imp C .imp intro 3-5
+A and B .and intro 1,2'''
+
+def check_lines(node) -> int:
+  # every node has a single parent and the line counts add up
+  n_lines = 0
+  for kid in node.children:
+    assert kid.parent is node
+    n_lines += check_lines(kid)
+  if node.children:
+    assert node.n_lines == n_lines
+  return node.n_lines
+
+def state(proof):
+  check_lines(proof)
+  return proof.build_fitch_rows(), proof.verified_all()
+
+def random_edit(proof, rng, clip):
+  """ Apply a random edit to proof. The edits may fail, e.g., when a
+      subproof goes into a hypothesis, and then change nothing.
+      Return the nodes cut out, to be pasted by a later edit. """
+  n = proof.n_lines
+  line = lambda: str(rng.randint(1, n))
+  k = rng.randrange(12)
+  if k == 0:
+    proof.insert_node(int(line()), go_above=rng.random() < 0.5)
+  elif k == 1:
+    proof.delete_nodes(line())
+  elif k == 2:
+    proof.move_node(line(), line(), go_above=rng.random() < 0.5)
+  elif k == 3:
+    proof.replace_node(line(), proof.copy_node(line()))
+  elif k == 4:
+    proof.undo()
+  elif k == 5:
+    proof.redo()
+  elif k == 6:
+    return proof.cut_nodes(line())
+  elif k == 7 and clip:
+    proof.insert_nodes(line(), clip, go_above=rng.random() < 0.5)
+  elif k == 8:
+    with proof.transaction():
+      proof.insert_node(int(line()))
+      proof.annotate(line(), Ann(f"repeat {line()}"))
+  elif k == 9:
+    proof.annotate(line(), Ann(f"and intro {line()},{line()}"))
+  elif k == 10:
+    proof.duplicate_node(line(), line(), go_above=rng.random() < 0.5)
+  else:
+    proof.update_formula(line(), Formula('A imp B'))
+  return clip
+
+@pytest.mark.parametrize('seed', range(8))
+def test_replay_random_edits(seed):
+  rng = random.Random(seed)
+  for _ in range(25):
+    proof = ProofNodeS(parse_fitch(PROOF))
+    replica = ProofNodeS(parse_fitch(PROOF))
+    clip = None
+    for _ in range(20):
+      try:
+        clip = random_edit(proof, rng, clip)
+      except (Exception, AssertionError):
+        pass
+      ops = json.loads(json.dumps(proof.take_ops()))
+      replica.apply_ops(ops)
+      assert state(replica) == state(proof), ops
+
+def test_replay_premise_of_cut_line():
+  # The premise citing line 2 is hidden while line 2 is cut out, and
+  # comes back when it is pasted.
+  proof_str = 'A .hyp\nB .hyp\nproves\nA and B .and intro 1,2'
+  proof = ProofNodeS(parse_fitch(proof_str))
+  replica = ProofNodeS(parse_fitch(proof_str))
+  nodes = proof.cut_nodes('2')
+  proof.replace_node('2', proof.copy_node('2'))
+  proof.insert_nodes('1', nodes, go_above=False)
+  replica.apply_ops(json.loads(json.dumps(proof.take_ops())))
+  assert f"{replica.get_p_node('3').label.ann}" == 'and intro 1,2'
+  assert state(replica) == state(proof)
+  assert proof.verified_all()
+
+@pytest.mark.parametrize('seed', range(4))
+def test_render_delta_random_edits(seed):
+  # The rows kept up to date by render_delta(), as proof_server /edit 
+  # sends them, are the rows of a full render.
+  rng = random.Random(seed)
+  for _ in range(25):
+    proof = ProofNodeS(parse_fitch(PROOF))
+    replica = ProofNodeS(parse_fitch(PROOF))
+    rows = []
+    clip = None
+    for _ in range(20):
+      try:
+        clip = random_edit(proof, rng, clip)
+      except (Exception, AssertionError):
+        pass
+      replica.apply_ops(json.loads(json.dumps(proof.take_ops())))
+      delta = replica.render_delta()
+      del rows[delta['n_rows']:]
+      rows.extend([None] * (delta['n_rows'] - len(rows)))
+      for pos, row in delta['changed']:
+        rows[pos] = row
+      assert (rows, replica.n_invalid == 0) == state(replica)
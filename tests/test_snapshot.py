@@ -0,0 +1,52 @@
+# ProofNodeS.snapshot() copies nothing, but its proof() must give the
+# proof as it was, whatever edits came in between.
+
+import random, sys, threading
+
+import pytest
+
+from modules.search_prop import ProofNodeS, parse_fitch
+from test_op_replay import PROOF, random_edit, state
+
+@pytest.mark.parametrize('seed', range(4))
+def test_snapshot_random_edits(seed):
+  rng = random.Random(seed)
+  for _ in range(25):
+    proof = ProofNodeS(parse_fitch(PROOF))
+    views = []
+    clip = None
+    for _ in range(20):
+      if rng.random() < 0.3:
+        views.append((proof.snapshot(), state(proof)))
+      try:
+        clip = random_edit(proof, rng, clip)
+      except (Exception, AssertionError):
+        pass
+      if views and rng.random() < 0.2:
+        view, old = views.pop(rng.randrange(len(views)))
+        assert state(view.proof()) == old
+    for view, old in views:
+      assert state(view.proof()) == old
+
+def test_snapshot_read_by_thread():
+  # The copy is built by another thread while the proof is edited.
+  rng = random.Random(0)
+  interval = sys.getswitchinterval()
+  sys.setswitchinterval(1e-6)
+  try:
+    for _ in range(20):
+      proof = ProofNodeS(parse_fitch(PROOF + '\nA imp B .repeat 1' * 300))
+      old = state(proof)
+      view = proof.snapshot()
+      reader = threading.Thread(target=view.proof)
+      reader.start()
+      clip = None
+      while reader.is_alive():
+        try:
+          clip = random_edit(proof, rng, clip)
+        except (Exception, AssertionError):
+          pass
+      reader.join()
+      assert state(view.proof()) == old
+  finally:
+    sys.setswitchinterval(interval)